@@ -0,0 +1,169 @@
+import sys
+import socket
+import struct
+import asyncio
+import argparse
+from collections import Counter
+
+from modules.iterative import in_zone, parent_zones
+from modules.protocol.message import Message, ResourceRecord, ResponseType, encode_name, read_name
+
+
+# Stand-in authoritative servers for trying the iterative mode offline:
+#   python -m bench.authoritative -v
+#   sudo python cli.py --iterative --root-hints 127.0.0.1 --ns-port 5300 --no-journal
+# Each server answers for the zones it has an SOA for, with referrals below them.
+# other.com is delegated to a nameserver outside com, which has to be looked up first.
+SERVERS = {
+    '127.0.0.1': '''
+        . 86400 SOA a.root.test. admin.root.test. 1 1800 900 604800 86400
+        com. 172800 NS ns.nic.com.
+        net. 172800 NS ns.nic.com.
+        ns.nic.com. 172800 A 127.0.0.2
+    ''',
+    '127.0.0.2': '''
+        com. 900 SOA ns.nic.com. admin.nic.com. 1 1800 900 604800 900
+        net. 900 SOA ns.nic.com. admin.nic.com. 1 1800 900 604800 900
+        example.com. 172800 NS ns1.example.com.
+        example.com. 172800 NS ns2.example.com.
+        ns1.example.com. 172800 A 127.0.0.3
+        ns2.example.com. 172800 A 127.0.0.3
+        other.com. 172800 NS ns.hosting.net.
+        hosting.net. 172800 NS ns.hosting.net.
+        ns.hosting.net. 172800 A 127.0.0.4
+    ''',
+    '127.0.0.3': '''
+        example.com. 3600 SOA ns1.example.com. admin.example.com. 1 7200 3600 1209600 300
+        example.com. 3600 NS ns1.example.com.
+        example.com. 3600 NS ns2.example.com.
+        ns1.example.com. 3600 A 127.0.0.3
+        ns2.example.com. 3600 A 127.0.0.3
+        www.example.com. 300 A 93.184.216.34
+        alias.example.com. 300 CNAME www.example.com.
+        away.example.com. 300 CNAME www.other.com.
+    ''',
+    '127.0.0.4': '''
+        hosting.net. 3600 SOA ns.hosting.net. admin.hosting.net. 1 7200 3600 1209600 300
+        hosting.net. 3600 NS ns.hosting.net.
+        ns.hosting.net. 3600 A 127.0.0.4
+        other.com. 3600 SOA ns.hosting.net. admin.hosting.net. 1 7200 3600 1209600 300
+        other.com. 3600 NS ns.hosting.net.
+        www.other.com. 300 A 10.0.0.1
+    ''',
+}
+
+TYPES = {'A': 1, 'NS': 2, 'CNAME': 5, 'SOA': 6}
+
+
+def parse_record(line):
+    name, ttl, type_, *data = line.split()
+    if type_ == 'A':
+        rdata = socket.inet_aton(data[0])
+    elif type_ == 'SOA':
+        rdata = encode_name(data[0].encode()) + encode_name(data[1].encode()) + struct.pack(
+            '!5I', *map(int, data[2:]))
+    else:
+        rdata = encode_name(data[0].encode())
+    name = name.encode()
+    return ResourceRecord(
+        name_len=len(encode_name(name)),
+        name=name,
+        type_=struct.pack('!H', TYPES[type_]),
+        class_=b'\x00\x01',
+        ttl=int(ttl),
+        rdata_len=len(rdata),
+        rdata=rdata,
+        decompressed_rdata=rdata
+    )
+
+
+class AuthoritativeServer:
+    def __init__(self, zone_text, counter, verbose):
+        # owner name -> records
+        self.records = {}
+        for line in zone_text.strip().splitlines():
+            resource_record = parse_record(line)
+            self.records.setdefault(resource_record.name, []).append(resource_record)
+        self.zones = {name for name, records in self.records.items() if self.find(name, 'SOA')}
+        self.counter = counter
+        self.verbose = verbose
+
+    def find(self, name, type_):
+        return [rr for rr in self.records.get(name, ()) if rr.type == struct.pack('!H', TYPES[type_])]
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        query = Message.from_bytes(data)
+        if query is None or len(query.question.entries) != 1:
+            return
+        address = self.transport.get_extra_info('sockname')[0]
+        self.counter[address] += 1
+        question_entry = query.question.entries[0]
+        if self.verbose:
+            print(address, question_entry.qname.decode(), int.from_bytes(question_entry.qtype, 'big'))
+        self.transport.sendto(self.answer(query, question_entry).to_bytes(), addr)
+
+    def answer(self, query, question_entry):
+        name = question_entry.qname.lower()
+        zones = [zone for zone in parent_zones(name) if zone in self.zones]
+        if not zones:
+            return Message.response_from_query(query, [], [], [], ResponseType.REFUSED)
+        zone = zones[0]
+        # a zone cut between the zone apex and the name means a referral,
+        # with glue for nameservers inside this zone
+        cuts = []
+        for cut in parent_zones(name):
+            if cut == zone:
+                break
+            cuts.append(cut)
+        for cut in reversed(cuts):
+            ns_records = self.find(cut, 'NS')
+            if ns_records:
+                targets = [read_name(rr.decompressed_rdata, 0)[0] for rr in ns_records]
+                glue = [rr for target in targets if in_zone(target, zone) for rr in self.find(target, 'A')]
+                return Message.response_from_query(query, [], ns_records, glue)
+        records = self.records.get(name, [])
+        answer = [rr for rr in records if rr.type == question_entry.qtype] or self.find(name, 'CNAME')
+        if answer:
+            response = Message.response_from_query(query, answer, [], [])
+        elif records:
+            response = Message.response_from_query(query, [], self.find(zone, 'SOA'), [])
+        else:
+            response = Message.response_from_query(
+                query, [], self.find(zone, 'SOA'), [], ResponseType.NAME_ERROR)
+        response.authoritative_answer = True
+        response.recursion_availible = False
+        return response
+
+    def error_received(self, exc):
+        pass
+
+    def connection_lost(self, exc):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-p', '--port', type=int, default=5300)
+    parser.add_argument('-v', '--verbose', action='store_true')
+    namespace = parser.parse_args(sys.argv[1:])
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    counter = Counter()
+    for address, zone_text in SERVERS.items():
+        loop.run_until_complete(loop.create_datagram_endpoint(
+            lambda zone_text=zone_text: AuthoritativeServer(zone_text, counter, namespace.verbose),
+            local_addr=(address, namespace.port)
+        ))
+    print('Serving {} on port {}'.format(', '.join(SERVERS), namespace.port))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    print('queries per server:', dict(counter))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+import sys
+import timeit
+import argparse
+
+from modules.cache import Cache
+from modules.protocol.message import Message, QEntry
+from bench.protocol import SAMPLES
+
+
+def fill_cache(entries, wire):
+    # the same answer under many names, looked up by the key of the last one
+    cache = Cache(max_entries=entries, wire=wire)
+    template = Message.from_bytes(dict(SAMPLES)['small response'])
+    question_entry = template.question.entries[0]
+    for i in range(entries):
+        entry = QEntry(
+            question_entry.qname_len + len(str(i)) + 1,
+            b'%d.' % i + question_entry.qname,
+            question_entry.qtype,
+            question_entry.qclass
+        )
+        cache.update(entry, template.get_response_records())
+    return cache, entry
+
+
+def measure(number, entries=10000):
+    results = {}
+    cache, question_entry = fill_cache(entries, wire=True)
+    key = question_entry.key
+    missing = b'\x07missing' + key
+    question = question_entry.to_bytes()
+    results['get_response_records hit'] = timeit.timeit(
+        lambda: cache.get_response_records(key), number=number) / number
+    results['get_response_records miss'] = timeit.timeit(
+        lambda: cache.get_response_records(missing), number=number) / number
+    results['get_response_bytes hit'] = timeit.timeit(
+        lambda: cache.get_response_bytes(key, 1, True, question), number=number) / number
+    results['update'] = timeit.timeit(
+        lambda: cache.update(question_entry, cache.map[key].response_records), number=number // 10
+    ) / (number // 10)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--number', type=int, default=20000)
+    parser.add_argument('--entries', type=int, default=10000)
+    namespace = parser.parse_args(sys.argv[1:])
+    for case, seconds in measure(namespace.number, namespace.entries).items():
+        print(f'{case:28} {seconds * 1e6:8.2f} us')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+import sys
+import time
+import random
+import struct
+import asyncio
+import argparse
+import itertools
+from collections import deque
+
+
+# Closed loop load generator: `concurrency` clients each send a query and wait
+# for its answer (or the timeout) before sending the next one. Names are drawn
+# from `names` distinct ones with Zipf popularity, like real resolver traffic.
+#   python -m bench.load -p 55555 --duration 10 --concurrency 64 --zipf 1.1
+
+
+def encode_query(id_, name):
+    question = b''.join(bytes([len(label)]) + label for label in name.split(b'.')) + b'\x00'
+    return struct.pack('!6H', id_, 0x0100, 1, 0, 0, 0) + question + b'\x00\x01\x00\x01'
+
+
+class ZipfNames:
+    def __init__(self, names, exponent, seed=0):
+        self.random = random.Random(seed)
+        self.names = [b'host%d.bench.test' % i for i in range(names)]
+        self.cum_weights = list(itertools.accumulate(1 / (rank + 1) ** exponent for rank in range(names)))
+
+    def sample(self):
+        return self.random.choices(self.names, cum_weights=self.cum_weights)[0]
+
+
+class LoadClient:
+    def __init__(self):
+        # id -> future with the receive time
+        self.pending = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        future = self.pending.get(struct.unpack_from('!H', data)[0])
+        if future is not None and not future.done():
+            future.set_result(time.perf_counter())
+
+    def error_received(self, exc):
+        pass
+
+    def connection_lost(self, exc):
+        pass
+
+
+def percentile(sorted_samples, share):
+    if not sorted_samples:
+        return None
+    return sorted_samples[min(int(share * len(sorted_samples)), len(sorted_samples) - 1)]
+
+
+async def run_load(addr, duration, concurrency, names, timeout=2.0):
+    loop = asyncio.get_event_loop()
+    transport, client = await loop.create_datagram_endpoint(LoadClient, remote_addr=addr)
+    # ids are reused least recently first, so late answers can't be taken for new ones
+    free_ids = deque(random.sample(range(2**16), 2**16))
+    latencies = []
+    timeouts = 0
+    deadline = time.perf_counter() + duration
+
+    async def worker():
+        nonlocal timeouts
+        while time.perf_counter() < deadline:
+            id_ = free_ids.popleft()
+            future = client.pending[id_] = loop.create_future()
+            sent = time.perf_counter()
+            transport.sendto(encode_query(id_, names.sample()))
+            try:
+                received = await asyncio.wait_for(future, timeout)
+                latencies.append(received - sent)
+            except asyncio.TimeoutError:
+                timeouts += 1
+            finally:
+                del client.pending[id_]
+                free_ids.append(id_)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    transport.close()
+    latencies.sort()
+    return {
+        'queries': len(latencies) + timeouts,
+        'timeouts': timeouts,
+        'qps': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 3) if latencies else None,
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3) if latencies else None,
+        'p999_ms': round(percentile(latencies, 0.999) * 1000, 3) if latencies else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-a', '--address', default='127.0.0.1')
+    parser.add_argument('-p', '--port', type=int, default=55555)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--names', type=int, default=10000)
+    parser.add_argument('--zipf', type=float, default=1.1, help='popularity exponent')
+    parser.add_argument('--timeout', type=float, default=2.0)
+    parser.add_argument('--seed', type=int, default=0)
+    namespace = parser.parse_args(sys.argv[1:])
+    names = ZipfNames(namespace.names, namespace.zipf, namespace.seed)
+    result = asyncio.run(run_load(
+        (namespace.address, namespace.port), namespace.duration,
+        namespace.concurrency, names, namespace.timeout
+    ))
+    for metric, value in result.items():
+        print(f'{metric:10} {value}')
+
+
+if __name__ == '__main__':
+    main()
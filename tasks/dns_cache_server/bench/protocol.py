@@ -0,0 +1,86 @@
+import sys
+import struct
+import timeit
+import argparse
+import importlib.util
+
+from modules.protocol import message
+
+
+QUESTION = b'\x03www\x07example\x03com\x00\x00\x01\x00\x01'
+
+
+def build_response(a_count, ns_count):
+    # www.example.com CNAME cdn.example.com, then A records, NS records and glue,
+    # all names compressed the way upstream resolvers send them
+    records = [b'\xc0\x0c' + struct.pack('!HHIH', 5, 1, 300, 6) + b'\x03cdn\xc0\x10']
+    for i in range(a_count):
+        records.append(b'\xc0\x2d' + struct.pack('!HHIH', 1, 1, 60, 4) + bytes([10, 0, i // 256, i % 256]))
+    for i in range(ns_count):
+        records.append(b'\xc0\x10' + struct.pack('!HHIH', 2, 1, 3600, 6) + b'\x03ns%d\xc0\x10' % (i % 10))
+    header = struct.pack('!6H', 1, 0x8180, 1, a_count + 1, ns_count, 0)
+    return header + QUESTION + b''.join(records)
+
+
+SAMPLES = [
+    ('query', struct.pack('!6H', 1, 0x0100, 1, 0, 0, 0) + QUESTION),
+    ('small response', build_response(2, 0)),
+    ('large response', build_response(40, 4)),
+]
+
+
+def load_module(path):
+    spec = importlib.util.spec_from_file_location('compared_message', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def measure(module, number):
+    results = {}
+    for name, data in SAMPLES:
+        parsed = module.Message.from_bytes(data)
+        results[f'from_bytes {name}'] = timeit.timeit(
+            lambda: module.Message.from_bytes(data), number=number) / number
+        results[f'to_bytes {name}'] = timeit.timeit(parsed.to_bytes, number=number) / number
+    data = SAMPLES[-1][1]
+    # the last NS target is a label followed by a pointer
+    start = len(data) - 6
+    results['read_name pointer'] = timeit.timeit(
+        lambda: module.read_name(data, start), number=number) / number
+    return results
+
+
+def print_sizes():
+    print(f'{"encoded size":28} {"received":>8} {"plain":>8} {"compressed":>10}')
+    for name, data in SAMPLES:
+        parsed = message.Message.from_bytes(data)
+        sections = (parsed.question, parsed.answer, parsed.authority, parsed.additional)
+        plain = message.Message.HEADER_LEN + sum(len(section.to_bytes()) for section in sections)
+        print(f'{name:28} {len(data):8} {plain:8} {len(parsed.to_bytes()):10}')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--number', type=int, default=20000)
+    parser.add_argument(
+        '--compare', metavar='PATH',
+        help='another message.py to measure against, e.g. one from git show'
+    )
+    namespace = parser.parse_args(sys.argv[1:])
+
+    print_sizes()
+    print()
+    current = measure(message, namespace.number)
+    if namespace.compare is None:
+        for case, seconds in current.items():
+            print(f'{case:28} {seconds * 1e6:8.2f} us')
+        return
+    other = measure(load_module(namespace.compare), namespace.number)
+    print(f'{"":28} {"compared":>11} {"current":>11} {"speedup":>8}')
+    for case, seconds in current.items():
+        print(f'{case:28} {other[case] * 1e6:8.2f} us {seconds * 1e6:8.2f} us {other[case] / seconds:7.2f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+import os
+import sys
+import json
+import time
+import shlex
+import signal
+import socket
+import asyncio
+import argparse
+import platform
+import subprocess
+
+from bench import cache, protocol
+from bench.load import ZipfNames, encode_query, run_load
+from modules.protocol import message
+
+
+# Runs the stub upstream and the server as subprocesses, drives the server with
+# the load generator, runs the micro benchmarks and compares everything with a
+# stored baseline (run from this directory):
+#   python -m bench.suite [--save-baseline]
+# Baselines only make sense on the machine they were recorded on.
+BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+# metrics where a bigger number is better, for everything else smaller is
+HIGHER_IS_BETTER = {'qps', 'queries'}
+
+
+def wait_for_server(addr, timeout=10):
+    deadline = time.monotonic() + timeout
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(0.2)
+        while time.monotonic() < deadline:
+            sock.sendto(encode_query(1, b'ready.bench.test'), addr)
+            try:
+                sock.recv(512)
+                return
+            except OSError:
+                time.sleep(0.1)
+    raise RuntimeError('server did not come up')
+
+
+def read_memory(pid):
+    # peak and current resident set size in KiB, Linux only
+    memory = {}
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith(('VmHWM', 'VmRSS')):
+                    name, value = line.split(':')
+                    memory[f'{name.lower()}_kb'] = int(value.split()[0])
+    except OSError:
+        pass
+    return memory
+
+
+def run_server_benchmark(namespace):
+    upstream_port = namespace.port + 1
+    upstream = subprocess.Popen([
+        sys.executable, '-m', 'bench.upstream', '-p', str(upstream_port),
+        '--latency', str(namespace.latency), '--jitter', str(namespace.jitter),
+        '--loss', str(namespace.loss)
+    ], stdout=subprocess.DEVNULL)
+    server = subprocess.Popen([
+        sys.executable, 'cli.py', '-lp', str(namespace.port),
+        '-ra', f'127.0.0.1:{upstream_port}', '--no-journal',
+        *shlex.split(namespace.server_args)
+    ], stdout=subprocess.DEVNULL)
+    try:
+        addr = ('127.0.0.1', namespace.port)
+        wait_for_server(addr)
+        names = ZipfNames(namespace.names, namespace.zipf)
+        result = asyncio.run(run_load(addr, namespace.duration, namespace.concurrency, names))
+        result.update(read_memory(server.pid))
+        return result
+    finally:
+        for process in (server, upstream):
+            process.send_signal(signal.SIGINT)
+        for process in (server, upstream):
+            try:
+                process.wait(5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+def run_micro_benchmarks(number):
+    results = {}
+    for case, seconds in protocol.measure(message, number).items():
+        results[f'{case} us'] = round(seconds * 1e6, 3)
+    for case, seconds in cache.measure(number).items():
+        results[f'{case} us'] = round(seconds * 1e6, 3)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    # prints results next to the baseline, returns the regressed metrics
+    regressions = []
+    print(f'{"metric":34} {"baseline":>12} {"current":>12} {"change":>8}')
+    for metric, value in results.items():
+        previous = baseline.get(metric)
+        if not isinstance(value, (int, float)) or not isinstance(previous, (int, float)) or not previous:
+            print(f'{metric:34} {"":>12} {value!s:>12}')
+            continue
+        change = value / previous - 1
+        worse = -change if metric in HIGHER_IS_BETTER else change
+        mark = ' REGRESSION' if worse > tolerance else ''
+        if mark:
+            regressions.append(metric)
+        print(f'{metric:34} {previous:12} {value:12} {change:+8.1%}{mark}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-p', '--port', type=int, default=55600, help='server port, upstream gets the next one')
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--names', type=int, default=10000)
+    parser.add_argument('--zipf', type=float, default=1.1)
+    parser.add_argument('--latency', type=float, default=0.02, help='upstream latency, seconds')
+    parser.add_argument('--jitter', type=float, default=0.005)
+    parser.add_argument('--loss', type=float, default=0.0)
+    parser.add_argument('--server-args', default='', help='extra cli.py arguments, e.g. "--wire-cache"')
+    parser.add_argument('-n', '--number', type=int, default=20000, help='micro benchmark iterations')
+    parser.add_argument('--micro-only', action='store_true')
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed change before a regression')
+    namespace = parser.parse_args(sys.argv[1:])
+
+    results = {}
+    if not namespace.micro_only:
+        results.update(run_server_benchmark(namespace))
+    results.update(run_micro_benchmarks(namespace.number))
+
+    baseline = {}
+    if os.path.exists(namespace.baseline):
+        with open(namespace.baseline) as f:
+            baseline = json.load(f)['results']
+    regressions = compare(results, baseline, namespace.tolerance)
+    if namespace.save_baseline:
+        with open(namespace.baseline, 'w') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'options': {
+                    key: value for key, value in vars(namespace).items()
+                    if key not in ('baseline', 'save_baseline')
+                },
+                'results': results,
+            }, f, indent=2)
+            f.write('\n')
+        print(f'baseline saved to {namespace.baseline}')
+    elif regressions:
+        print(f'{len(regressions)} regressions above {namespace.tolerance:.0%}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
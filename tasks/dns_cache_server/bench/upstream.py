@@ -0,0 +1,74 @@
+import sys
+import random
+import struct
+import asyncio
+import argparse
+
+
+# Stub recursive resolver answering every A question with two records,
+# after latency +- jitter seconds and dropping a share of queries:
+#   python -m bench.upstream -p 5353 --latency 0.02 --loss 0.01
+
+
+class StubUpstream:
+    def __init__(self, latency, jitter, loss, ttl):
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.ttl = ttl
+        self.queries = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.queries += 1
+        if len(data) < 17 or random.random() < self.loss:
+            return
+        delay = max(self.latency + random.uniform(-self.jitter, self.jitter), 0)
+        if delay:
+            asyncio.get_event_loop().call_later(delay, self.reply, data, addr)
+        else:
+            self.reply(data, addr)
+
+    def reply(self, data, addr):
+        id_, _, _, _, _, _ = struct.unpack_from('!6H', data)
+        question_end = data.index(0, 12) + 5
+        records = b''.join(
+            b'\xc0\x0c' + struct.pack('!HHIH', 1, 1, self.ttl, 4) + bytes([10, 0, 0, i])
+            for i in (1, 2)
+        )
+        header = struct.pack('!6H', id_, 0x8180, 1, 2, 0, 0)
+        self.transport.sendto(header + data[12:question_end] + records, addr)
+
+    def error_received(self, exc):
+        pass
+
+    def connection_lost(self, exc):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-a', '--address', default='127.0.0.1')
+    parser.add_argument('-p', '--port', type=int, default=5353)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds')
+    parser.add_argument('--jitter', type=float, default=0.0, help='seconds')
+    parser.add_argument('--loss', type=float, default=0.0, help='share of queries dropped')
+    parser.add_argument('--ttl', type=int, default=300)
+    namespace = parser.parse_args(sys.argv[1:])
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    upstream = StubUpstream(namespace.latency, namespace.jitter, namespace.loss, namespace.ttl)
+    loop.run_until_complete(loop.create_datagram_endpoint(
+        lambda: upstream, local_addr=(namespace.address, namespace.port)))
+    print('Stub upstream on {}:{}'.format(namespace.address, namespace.port), flush=True)
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    print('queries:', upstream.queries, flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,19 +2,81 @@ import sys
 import argparse
 
 from modules.server import DNSServer
+from modules.iterative import ROOT_HINTS
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('-la', '--localaddress', default='127.0.0.1')
     parser.add_argument('-lp', '--localport', type=int, default=55555)
-    parser.add_argument('-ra', '--remoteaddress', default='8.8.8.8')
+    parser.add_argument(
+        '-ra', '--remoteaddress', nargs='+', default=['8.8.8.8'],
+        help='upstream resolvers as address or address:port'
+    )
     parser.add_argument('-rp', '--remoteport', type=int, default=53)
+    parser.add_argument('--cache-entries', type=int, default=10000)
+    parser.add_argument('--cache-bytes', type=int, default=32 * 2**20)
+    parser.add_argument('--wire-cache', action='store_true')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--shared-cache-slots', type=int, default=16384)
+    parser.add_argument('--journal', default='cache.journal')
+    parser.add_argument('--no-journal', dest='journal', action='store_const', const=None)
+    parser.add_argument('--prefetch-ratio', type=float, default=0.9)
+    parser.add_argument('--prefetch-min-hits', type=int, default=5)
+    parser.add_argument(
+        '--max-stale', type=int, default=24 * 3600,
+        help='seconds past expiry an answer may be served while upstream fails, 0 disables'
+    )
+    parser.add_argument('--stale-answer-timeout', type=float, default=1.8)
+    parser.add_argument(
+        '--iterative', action='store_true',
+        help='resolve from the root servers instead of asking remoteaddress'
+    )
+    parser.add_argument('--root-hints', nargs='+', default=ROOT_HINTS)
+    parser.add_argument('--ns-port', type=int, default=53)
+    parser.add_argument(
+        '--stats-port', type=int,
+        help='serve stats as JSON over HTTP, worker N listens on port + N'
+    )
+    parser.add_argument('--stats-interval', type=float, help='write stats to stderr every N seconds')
+    parser.add_argument(
+        '--profile-every', type=int, default=0,
+        help='profile one in N received datagrams, stats are saved to --profile-path on exit'
+    )
+    parser.add_argument('--profile-path', default='dns.prof')
+    parser.add_argument('--query-log', metavar='PATH', help='log every answered query')
+    parser.add_argument('--query-log-binary', action='store_true', help='compact binary records instead of JSONL')
+    parser.add_argument('--query-log-max-bytes', type=int, default=64 * 2**20)
+    parser.add_argument('--query-log-rotate-interval', type=float, default=3600)
     namespace = parser.parse_args(sys.argv[1:])
+    upstreams = []
+    for remote_addr in namespace.remoteaddress:
+        addr, _, port = remote_addr.partition(':')
+        upstreams.append((addr, int(port) if port else namespace.remoteport))
     server = DNSServer(
         addr=namespace.localaddress,
         port=namespace.localport,
-        remote_addr=namespace.remoteaddress,
-        remote_port=namespace.remoteport)
+        upstreams=upstreams,
+        cache_entries=namespace.cache_entries,
+        cache_bytes=namespace.cache_bytes,
+        wire_cache=namespace.wire_cache,
+        workers=namespace.workers,
+        shared_cache_slots=namespace.shared_cache_slots,
+        journal=namespace.journal,
+        prefetch_ratio=namespace.prefetch_ratio,
+        prefetch_min_hits=namespace.prefetch_min_hits,
+        max_stale=namespace.max_stale,
+        stale_answer_timeout=namespace.stale_answer_timeout,
+        iterative=namespace.iterative,
+        root_hints=namespace.root_hints,
+        ns_port=namespace.ns_port,
+        stats_port=namespace.stats_port,
+        stats_interval=namespace.stats_interval,
+        profile_every=namespace.profile_every,
+        profile_path=namespace.profile_path,
+        query_log=namespace.query_log,
+        query_log_binary=namespace.query_log_binary,
+        query_log_max_bytes=namespace.query_log_max_bytes,
+        query_log_rotate_interval=namespace.query_log_rotate_interval)
     print('Running on {}:{}'.format(server.addr, server.port))
     server.start()
@@ -1,40 +1,254 @@
-import datetime
-import pickle
+import heapq
+import itertools
+import struct
+import time
+from collections import OrderedDict
+
+from modules.protocol.message import Message, ResponseType, RESPONSE_TYPES, SOA_TYPE
+
+
+class CacheEntry:
+    # rough per-record bookkeeping cost on top of the wire size
+    RECORD_OVERHEAD = 200
+    # ttl of answers served past expiry (RFC 8767)
+    STALE_TTL = 30
+
+    __slots__ = (
+        'question', 'response_type', 'records', 'deadline', 'inserted', 'size',
+        'wire', 'ttls', 'hits', 'refresh_at'
+    )
+
+    def __init__(self, question_entry, response_type, response_records, deadline, inserted):
+        self.question = question_entry
+        self.response_type = response_type
+        self.records = response_records
+        self.deadline = deadline
+        self.inserted = inserted
+        self.hits = 0
+        # when a popular entry is worth refreshing ahead of expiry, set by the cache
+        self.refresh_at = deadline
+        self.size = sum(
+            len(rr.name) + 10 + len(rr.decompressed_rdata) + self.RECORD_OVERHEAD
+            for section in response_records for rr in section
+        )
+        self.wire = None
+        self.ttls = None
+
+    @classmethod
+    def from_wire(cls, wire, ttls, deadline, inserted):
+        # restored entries are parsed only once something needs their records
+        entry = cls(None, RESPONSE_TYPES[wire[3] & 15], ((), (), ()), deadline, inserted)
+        entry.records = None
+        entry.wire = wire
+        entry.ttls = ttls
+        entry.size = len(wire) + len(ttls) * cls.RECORD_OVERHEAD
+        return entry
+
+    @property
+    def question_entry(self):
+        if self.question is None:
+            self.parse_wire()
+        return self.question
+
+    @property
+    def response_records(self):
+        if self.records is None:
+            self.parse_wire()
+        return self.records
+
+    def parse_wire(self):
+        message = Message.from_bytes(self.wire)
+        self.question = message.question.entries[0]
+        self.records = message.get_response_records()
+
+    def build_wire(self):
+        # serialized response with zero id and clear RD bit, patched per client on hit
+        self.wire, ttl_offsets = self.build_response().to_wire()
+        ttls = (rr.ttl for section in self.response_records for rr in section)
+        self.ttls = list(zip(ttl_offsets, ttls))
+        self.size += len(self.wire)
+
+    def build_response(self):
+        return Message.response_from_question(
+            self.question_entry, *self.response_records, response_type=self.response_type)
+
+    def get_stale_answer(self):
+        records = tuple(
+            [rr.with_ttl(self.STALE_TTL) for rr in section]
+            for section in self.response_records
+        )
+        return self.response_type, records
+
+    def get_response_bytes(self, id_, recursion_desired, question, now):
+        if self.wire is None:
+            return patch_response(
+                self.build_response().to_bytes(), (), 0, id_, recursion_desired, question)
+        return patch_response(
+            self.wire, self.ttls, int(now - self.inserted), id_, recursion_desired, question)
+
+
+def patch_response(wire, ttls, elapsed, id_, recursion_desired, question):
+    data = bytearray(wire)
+    for offset, ttl in ttls:
+        struct.pack_into('!I', data, offset, ttl - elapsed)
+    struct.pack_into('!H', data, 0, id_)
+    if recursion_desired:
+        data[2] |= 1
+    # echo the question exactly as the client spelled it
+    data[12:12+len(question)] = question
+    return data
+
+
+def soa_minimum(resource_record):
+    # the last of the five 32 bit fields closing SOA rdata
+    return struct.unpack('!I', resource_record.decompressed_rdata[-4:])[0]
 
 
 class Cache:
-    def __init__(self):
-        self.map = {}
+    # negative answers are kept at most this long whatever the SOA says (RFC 2308)
+    MAX_NEGATIVE_TTL = 3 * 3600
+
+    def __init__(
+        self, max_entries=10000, max_bytes=32 * 2**20, wire=False, store=None,
+        prefetch_ratio=0.9, prefetch_min_hits=5, max_stale=24 * 3600
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # how long expired entries are kept around to be served stale, 0 turns it off
+        self.max_stale = max_stale
+        # share of the ttl after which entries with enough hits are refreshed,
+        # 0 turns prefetching off
+        self.prefetch_ratio = prefetch_ratio
+        self.prefetch_min_hits = prefetch_min_hits
+        # called with the question entry to refresh, set by the server
+        self.prefetch = None
+        # keep serialized answers for the get_response_bytes fast path
+        self.wire = wire
+        # CacheStore journaling every insert, it needs the serialized answers too
+        self.store = store
+        # question key -> CacheEntry, least recently used first
+        self.map = OrderedDict()
+        # heap of (deadline, seq, question key); outdated items are skipped on purge
+        self.expiry = []
+        self.seq = itertools.count()
+        self.bytes = 0
+        self.evictions = 0
+        # lookups by outcome; fast path misses aren't counted, the full path that follows counts them
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
 
-    def __contains__(self, question_entry):
-        return question_entry in self.map
+    def __contains__(self, key):
+        return key in self.map
 
-    def get_response_records(self, question_entry):
-        value = self.map.get(question_entry, None)
-        if value is None:
+    def __len__(self):
+        return len(self.map)
+
+    def get_response_records(self, key):
+        # (response type, response records) of a fresh entry
+        entry = self.map.get(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+        now = time.monotonic()
+        if entry.deadline <= now:
+            self.expired += 1
             return None
+        self.hit(key, entry, now)
+        return entry.response_type, entry.response_records
 
-        response_records, updated = value
-        for section in response_records:
-            for resource_record in section:
-                passed = (datetime.datetime.now() - updated).total_seconds()
-                if resource_record.ttl < passed:
-                    return None
-        return response_records
+    def get_stale_response_records(self, key):
+        entry = self.map.get(key, None)
+        if entry is None or entry.deadline + self.max_stale <= time.monotonic():
+            return None
+        return entry.get_stale_answer()
 
-    def update(self, question_entry, response_records):
-        self.map[question_entry] = (response_records, datetime.datetime.now())
+    def get_response_bytes(self, key, id_, recursion_desired, question, touch=True):
+        # touch=False when the lookup was already accounted for by get_response_records
+        entry = self.map.get(key, None)
+        if entry is None:
+            return None
+        now = time.monotonic()
+        if entry.deadline <= now:
+            return None
+        if touch:
+            self.hit(key, entry, now)
+        return entry.get_response_bytes(id_, recursion_desired, question, now)
 
+    def hit(self, key, entry, now):
+        self.hits += 1
+        self.map.move_to_end(key)
+        entry.hits += 1
+        if now >= entry.refresh_at and entry.hits >= self.prefetch_min_hits and self.prefetch is not None:
+            # once per entry, the refreshed answer replaces it
+            entry.refresh_at = entry.deadline
+            self.prefetch(entry.question_entry)
 
-    def save(self):
-        with open('cache.pickle', 'wb') as f:
-            pickle.dump(self, f)
+    def update(self, question_entry, response_records, response_type=ResponseType.NO_ERROR):
+        answer, authority, _ = response_records
+        ttl = min(
+            (rr.ttl for section in response_records for rr in section),
+            default=0
+        )
+        if response_type == ResponseType.NAME_ERROR or not answer:
+            # negative answer, kept for the SOA minimum capped by the SOA's own ttl;
+            # without an SOA it isn't cached at all (RFC 2308)
+            negative_ttl = min(
+                (soa_minimum(rr) for rr in authority if rr.type == SOA_TYPE),
+                default=0
+            )
+            ttl = min(ttl, negative_ttl, self.MAX_NEGATIVE_TTL)
+        return self.insert(question_entry, response_type, response_records, ttl)
 
-    @classmethod
-    def load(cls):
-        try:
-            with open('cache.pickle', 'rb') as f:
-                return pickle.load(f)
-        except (FileNotFoundError, EOFError):
-            return cls()
+    def insert(self, question_entry, response_type, response_records, ttl):
+        key = question_entry.key
+        self.remove(key)
+        if ttl <= 0:
+            return None
+        now = time.monotonic()
+        entry = CacheEntry(question_entry, response_type, response_records, now + ttl, now)
+        if self.wire or self.store is not None:
+            entry.build_wire()
+        if self.store is not None:
+            self.store.append(key, entry)
+        self.add(key, entry)
+        return entry
+
+    def restore(self, key, entry):
+        self.remove(key)
+        self.add(key, entry)
+
+    def add(self, key, entry):
+        if self.prefetch_ratio:
+            entry.refresh_at = entry.inserted + (entry.deadline - entry.inserted) * self.prefetch_ratio
+        self.map[key] = entry
+        self.bytes += entry.size
+        heapq.heappush(self.expiry, (entry.deadline, next(self.seq), key))
+        self.evict()
+
+    def remove(self, key):
+        entry = self.map.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry.size
+
+    def evict(self):
+        while self.map and (len(self.map) > self.max_entries or self.bytes > self.max_bytes):
+            _, entry = self.map.popitem(last=False)
+            self.bytes -= entry.size
+            self.evictions += 1
 
+    def purge(self):
+        # entries stay past their deadline for as long as they may be served stale
+        now = time.monotonic() - self.max_stale
+        while self.expiry and self.expiry[0][0] <= now:
+            deadline, _, key = heapq.heappop(self.expiry)
+            entry = self.map.get(key)
+            if entry is not None and entry.deadline == deadline:
+                self.remove(key)
+        # updates and evictions leave dead heap items behind, rebuild when they pile up
+        if len(self.expiry) > 2 * len(self.map) + 1024:
+            self.expiry = [
+                (entry.deadline, next(self.seq), key)
+                for key, entry in self.map.items()
+            ]
+            heapq.heapify(self.expiry)
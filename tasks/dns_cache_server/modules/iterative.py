@@ -0,0 +1,199 @@
+import time
+import socket
+
+from modules.resolver import Resolver, Upstream
+from modules.protocol.message import Message, QEntry, ResponseType, OPT_TYPE, encode_name, read_name
+
+
+A_TYPE = b'\x00\x01'
+NS_TYPE = b'\x00\x02'
+CNAME_TYPE = b'\x00\x05'
+
+# a.root-servers.net through m.root-servers.net
+ROOT_HINTS = [
+    '198.41.0.4', '170.247.170.2', '192.33.4.12', '199.7.91.13', '192.203.230.10',
+    '192.5.5.241', '192.112.36.4', '198.97.190.53', '192.36.148.17', '192.58.128.30',
+    '193.0.14.129', '199.7.83.42', '202.12.27.33'
+]
+
+
+def in_zone(name, zone):
+    return zone == b'.' or name == zone or name.endswith(b'.' + zone)
+
+
+def parent_zones(name):
+    # the name itself first, the root last
+    yield name
+    while name != b'.':
+        name = name.split(b'.', 1)[1] or b'.'
+        yield name
+
+
+def make_question(name, qtype, qclass=b'\x00\x01'):
+    return QEntry(len(encode_name(name)), name, qtype, qclass)
+
+
+def cname_target(answer, question_entry):
+    # name where the answer's CNAME chain stops short of the asked type, None if it doesn't
+    owners = {}
+    for resource_record in answer:
+        owners.setdefault(resource_record.name.lower(), []).append(resource_record)
+    start = name = question_entry.qname.lower()
+    for _ in range(IterativeResolver.MAX_CNAMES):
+        records = owners.get(name, ())
+        if any(rr.type == question_entry.qtype for rr in records):
+            return None
+        cnames = [rr for rr in records if rr.type == CNAME_TYPE]
+        if not cnames:
+            break
+        name = read_name(cnames[0].decompressed_rdata, 0)[0].lower()
+    return None if name == start else name
+
+
+class IterativeResolver(Resolver):
+    # Resolves from the root down following referrals instead of forwarding.
+    # NS sets from referrals are kept as delegation points along with their glue,
+    # so a lookup starts from the closest zone cut known rather than the root.
+    recursion_desired = False
+    MAX_REFERRALS = 16
+    MAX_CNAMES = 8
+    # nested lookups of nameserver addresses that came without glue
+    MAX_DEPTH = 3
+    MAX_DELEGATIONS = 10000
+
+    def __init__(self, root_hints=ROOT_HINTS, port=53, timeout=2):
+        super().__init__([], timeout)
+        self.port = port
+        self.root_servers = [self.get_server(addr) for addr in root_hints]
+        # lowercased zone name -> (deadline, nameserver names)
+        self.delegations = {}
+        # lowercased nameserver name -> (deadline, servers)
+        self.addresses = {}
+
+    def get_server(self, addr):
+        # one Upstream per address, so rtts and failures follow a server across zones
+        upstream = self.by_addr.get((addr, self.port))
+        if upstream is None:
+            upstream = Upstream(addr, self.port)
+            self.by_addr[upstream.addr] = upstream
+        return upstream
+
+    async def resolve(self, question_entry):
+        # chases CNAMEs leading out of the zone, the response answers the original question
+        answer = []
+        curr = question_entry
+        for _ in range(self.MAX_CNAMES):
+            response = await self.lookup(curr, self.MAX_DEPTH)
+            if response is None:
+                return None
+            answer.extend(response.answer.entries)
+            if question_entry.qtype == CNAME_TYPE:
+                break
+            target = cname_target(response.answer.entries, curr)
+            if target is None:
+                break
+            curr = make_question(target, question_entry.qtype, question_entry.qclass)
+        else:
+            return None
+        _, authority, additional = response.get_response_records()
+        return Message.response_from_question(
+            question_entry, answer, authority, additional, response.response_type)
+
+    async def lookup(self, question_entry, depth):
+        name = question_entry.qname.lower()
+        zone, servers = await self.closest_servers(name, depth)
+        for _ in range(self.MAX_REFERRALS):
+            response = await self.query(question_entry, servers)
+            if response is None:
+                return None
+            if response.response_type != ResponseType.NO_ERROR or response.answer.entries:
+                return response
+            child = self.add_delegation(response, zone, name)
+            if child is None:
+                # no data from the zone itself, anything else is a lame or upward referral
+                return response if response.authoritative_answer else None
+            self.stats['referrals'] += 1
+            zone = child
+            servers = await self.get_servers(zone, depth)
+            if not servers:
+                return None
+        return None
+
+    async def closest_servers(self, name, depth):
+        now = time.monotonic()
+        for zone in parent_zones(name):
+            if zone == b'.':
+                return zone, self.root_servers
+            delegation = self.delegations.get(zone)
+            if delegation is None:
+                continue
+            if delegation[0] <= now:
+                del self.delegations[zone]
+                continue
+            servers = await self.get_servers(zone, depth)
+            if servers:
+                return zone, servers
+
+    async def get_servers(self, zone, depth):
+        _, names = self.delegations[zone]
+        servers = [server for ns_name in names for server in self.get_addresses(ns_name)]
+        if servers or depth == 0:
+            return servers
+        # no glue, look the nameservers up; ones inside the zone can't be reached that way
+        for ns_name in names:
+            if in_zone(ns_name, zone):
+                continue
+            response = await self.lookup(make_question(ns_name, A_TYPE), depth - 1)
+            if response is not None:
+                self.add_addresses(ns_name, response.answer.entries)
+            servers = self.get_addresses(ns_name)
+            if servers:
+                return servers
+        return []
+
+    def get_addresses(self, ns_name):
+        addresses = self.addresses.get(ns_name)
+        if addresses is None or addresses[0] <= time.monotonic():
+            return []
+        return addresses[1]
+
+    def add_addresses(self, ns_name, resource_records):
+        records = [rr for rr in resource_records if rr.type == A_TYPE and rr.name.lower() == ns_name]
+        if not records:
+            return
+        self.addresses[ns_name] = (
+            time.monotonic() + min(rr.ttl for rr in records),
+            [self.get_server(socket.inet_ntoa(rr.decompressed_rdata)) for rr in records]
+        )
+
+    def add_delegation(self, response, zone, name):
+        # caches a referral to a zone below the one asked, returns that zone
+        ns_records = [rr for rr in response.authority.entries if rr.type == NS_TYPE]
+        if not ns_records:
+            return None
+        child = ns_records[0].name.lower()
+        if child == zone or not in_zone(child, zone) or not in_zone(name, child):
+            return None
+        ns_records = [rr for rr in ns_records if rr.name.lower() == child]
+        names = [read_name(rr.decompressed_rdata, 0)[0].lower() for rr in ns_records]
+        # glue is only trusted for names the referring zone is authoritative for
+        glue = [
+            rr for rr in response.additional.entries
+            if rr.type != OPT_TYPE and in_zone(rr.name.lower(), zone)
+        ]
+        for ns_name in names:
+            self.add_addresses(ns_name, glue)
+        self.delegations[child] = (time.monotonic() + min(rr.ttl for rr in ns_records), names)
+        self.trim()
+        return child
+
+    def trim(self):
+        if len(self.delegations) <= self.MAX_DELEGATIONS:
+            return
+        now = time.monotonic()
+        for cache in (self.delegations, self.addresses):
+            for key in [key for key, (deadline, _) in cache.items() if deadline <= now]:
+                del cache[key]
+        # oldest first
+        while len(self.delegations) > self.MAX_DELEGATIONS:
+            del self.delegations[next(iter(self.delegations))]
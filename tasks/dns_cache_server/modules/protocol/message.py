@@ -1,5 +1,6 @@
 import struct
 import random
+import functools
 from enum import Enum
 
 from modules.protocol import utils
@@ -25,9 +26,26 @@ class ResponseType(Enum):
     REFUSED = 5
 
 
+MESSAGE_TYPES = {t.value: t for t in MessageType}
+QUERY_TYPES = {t.value: t for t in QueryType}
+RESPONSE_TYPES = {t.value: t for t in ResponseType}
+
+SOA_TYPE = b'\x00\x06'
+OPT_TYPE = b'\x00\x29'
+# plain DNS limit, and what we advertise with EDNS0 (small enough to avoid fragmentation)
+MAX_UDP_SIZE = 512
+EDNS_UDP_SIZE = 1232
+
+
 class Message:
     HEADER_LEN = 12
 
+    __slots__ = (
+        'id', 'type', 'query_type', 'authoritative_answer', 'tructation',
+        'recursion_desired', 'recursion_availible', 'response_type',
+        'question', 'answer', 'authority', 'additional'
+    )
+
     def __init__(
         self, id_, type_, query_type, authoritative_answer,
         tructation, recursion_desired, recursion_availible, response_type
@@ -45,49 +63,34 @@ class Message:
     def from_bytes(cls, bytes_):
         if len(bytes_) < cls.HEADER_LEN:
             return None
+        try:
+            return cls.parse(memoryview(bytes_))
+        except (ValueError, IndexError, KeyError, struct.error):
+            return None
 
-        header = struct.unpack('!HHHHHH', bytes_[:cls.HEADER_LEN])
-        id_, flags, qdcount, ancount, nscount, arcount = header
+    @classmethod
+    def parse(cls, view):
+        id_, flags, qdcount, ancount, nscount, arcount = struct.unpack_from('!HHHHHH', view)
 
         message = cls(
             id_=id_,
-            type_=MessageType(flags >> 15),
-            query_type=QueryType(flags >> 11 & 15),
+            type_=MESSAGE_TYPES[flags >> 15],
+            query_type=QUERY_TYPES[flags >> 11 & 15],
             authoritative_answer=flags & 1024 != 0,
             tructation=flags & 512 != 0,
             recursion_desired=flags & 256 != 0,
             recursion_availible=flags & 128 != 0,
-            response_type=ResponseType(flags & 15)
-        )
-
-        message.question = Section.from_bytes(
-            bytes_=bytes_,
-            start=cls.HEADER_LEN,
-            entry_class=QEntry,
-            count=qdcount
-        )
-
-        message.answer = Section.from_bytes(
-            bytes_=bytes_,
-            start=cls.HEADER_LEN+len(message.question),
-            entry_class=ResourceRecord,
-            count=ancount
-        )
-
-        message.authority = Section.from_bytes(
-            bytes_=bytes_,
-            start=cls.HEADER_LEN+len(message.question)+len(message.answer),
-            entry_class=ResourceRecord,
-            count=nscount
-        )
-
-        message.additional = Section.from_bytes(
-            bytes_=bytes_,
-            start=cls.HEADER_LEN+len(message.question)+len(message.answer)+len(message.authority),
-            entry_class=ResourceRecord,
-            count=arcount
+            response_type=RESPONSE_TYPES[flags & 15]
         )
 
+        curr = cls.HEADER_LEN
+        message.question = Section.from_bytes(view, curr, QEntry, qdcount)
+        curr += len(message.question)
+        message.answer = Section.from_bytes(view, curr, ResourceRecord, ancount)
+        curr += len(message.answer)
+        message.authority = Section.from_bytes(view, curr, ResourceRecord, nscount)
+        curr += len(message.authority)
+        message.additional = Section.from_bytes(view, curr, ResourceRecord, arcount)
         return message
 
     @classmethod
@@ -111,25 +114,55 @@ class Message:
         response.additional = Section(additional)
         return response
 
+    @classmethod
+    def response_from_question(
+        cls, question_entry, answer, authority,
+        additional, response_type=ResponseType.NO_ERROR
+    ):
+        response = cls(
+            id_=0,
+            type_=MessageType.RESPONSE,
+            query_type=QueryType.QUERY,
+            authoritative_answer=False,
+            tructation=False,
+            recursion_desired=False,
+            recursion_availible=True,
+            response_type=response_type
+        )
+        response.question = Section([question_entry])
+        response.answer = Section(answer)
+        response.authority = Section(authority)
+        response.additional = Section(additional)
+        return response
+
     def get_response_records(self):
-        return self.answer.entries, self.authority.entries, self.additional.entries
+        # the OPT pseudo-record belongs to this hop only, it's never cached or passed on
+        additional = [rr for rr in self.additional.entries if rr.type != OPT_TYPE]
+        return self.answer.entries, self.authority.entries, additional
+
+    def get_udp_size(self):
+        # payload size the sender can take over UDP, None without EDNS
+        for resource_record in self.additional.entries:
+            if resource_record.type == OPT_TYPE:
+                return max(utils.int_from_bytes(resource_record.class_), MAX_UDP_SIZE)
+        return None
 
     @classmethod
-    def build_query(cls, *entries):
+    def build_query(cls, *entries, id_=None, udp_size=EDNS_UDP_SIZE, recursion_desired=True):
         query = cls(
-            id_=cls.generate_id(),
+            id_=cls.generate_id() if id_ is None else id_,
             type_=MessageType.QUERY,
             query_type=QueryType.QUERY,
             authoritative_answer=False,
             tructation=False,
-            recursion_desired=True,
+            recursion_desired=recursion_desired,
             recursion_availible=False,
             response_type=ResponseType.NO_ERROR
         )
         query.question = Section(entries)
         query.answer = Section()
         query.authority = Section()
-        query.additional = Section()
+        query.additional = Section([] if udp_size is None else [opt_record(udp_size)])
         return query.to_bytes()
 
     @staticmethod
@@ -137,6 +170,10 @@ class Message:
         return random.getrandbits(16)
 
     def to_bytes(self):
+        return self.to_wire()[0]
+
+    def to_wire(self):
+        # message bytes and the offset of every resource record ttl field in them
         flags = (
             (self.type.value << 15) +
             (self.query_type.value << 11) +
@@ -156,32 +193,43 @@ class Message:
             len(self.additional.entries)
         )
 
-        return (
-            header +
-            self.question.to_bytes() +
-            self.answer.to_bytes() +
-            self.authority.to_bytes() +
-            self.additional.to_bytes()
-        )
+        buf = bytearray(header)
+        # lowercased name suffix -> offset of its first occurrence, for compression
+        name_offsets = {}
+        for question_entry in self.question.entries:
+            question_entry.write(buf, name_offsets)
+        ttl_offsets = []
+        for section in (self.answer, self.authority, self.additional):
+            for resource_record in section.entries:
+                ttl_offsets.append(resource_record.write(buf, name_offsets))
+        return bytes(buf), ttl_offsets
 
 
 class Section:
+    __slots__ = ('entries', 'length')
+
     def __init__(self, entries=None):
         if entries is None:
             self.entries = []
         else:
             self.entries = entries
+        # wire length, known up front only for parsed sections
+        self.length = None
 
     def __len__(self):
-        return sum(map(len, self.entries))
+        if self.length is None:
+            return sum(map(len, self.entries))
+        return self.length
 
     @classmethod
     def from_bytes(cls, bytes_, start, entry_class, count):
         section = cls([])
+        curr = start
         for i in range(count):
-            section.entries.append(
-                entry_class.from_bytes(bytes_, start+len(section))
-            )
+            entry = entry_class.from_bytes(bytes_, curr)
+            section.entries.append(entry)
+            curr += len(entry)
+        section.length = curr - start
         return section
 
     def to_bytes(self):
@@ -189,11 +237,15 @@ class Section:
 
 
 class QEntry:
+    __slots__ = ('qname_len', 'qname', 'qtype', 'qclass', 'key')
+
     def __init__(self, qname_len, qname, qtype, qclass):
         self.qname = qname
         self.qtype = qtype
         self.qclass = qclass
         self.qname_len = qname_len
+        # lowercased uncompressed question, same as read_query_key produces
+        self.key = encode_name(qname.lower()) + qtype + qclass
 
     def __len__(self):
         return self.qname_len + 4
@@ -202,12 +254,13 @@ class QEntry:
     def from_bytes(cls, bytes_, start):
         qname, qname_len = read_name(bytes_, start)
         type_start = start + qname_len
-        qtype, qclass = struct.unpack('!2s2s', bytes_[type_start:type_start+4])
+        if type_start + 4 > len(bytes_):
+            raise ValueError('question entry is out of bounds')
         return cls(
             qname_len=qname_len,
             qname=qname,
-            qtype=qtype,
-            qclass=qclass,
+            qtype=bytes(bytes_[type_start:type_start+2]),
+            qclass=bytes(bytes_[type_start+2:type_start+4]),
         )
 
     def to_bytes(self):
@@ -217,18 +270,24 @@ class QEntry:
             self.qclass
         )
 
+    def write(self, buf, name_offsets):
+        write_name(buf, name_offsets, self.qname)
+        buf += self.qtype
+        buf += self.qclass
+
     def __hash__(self):
-        return hash((self.qname, self.qtype, self.qclass))
+        return hash(self.key)
 
     def __eq__(self, other):
-        return (
-            self.qname == other.qname and
-            self.qtype == other.qtype and
-            self.qclass == other.qclass
-        )
+        return self.key == other.key
 
 
 class ResourceRecord:
+    __slots__ = (
+        'name_len', 'name', 'type', 'class_', 'ttl',
+        'rdata_len', 'rdata', 'decompressed_rdata'
+    )
+
     def __init__(self, name_len, name, type_, class_, ttl, rdata_len, rdata, decompressed_rdata):
         self.name_len = name_len
         self.name = name
@@ -247,17 +306,20 @@ class ResourceRecord:
         name, name_len = read_name(bytes_, start)
         type_start = start + name_len
         data_start = type_start + 10
-        type_, class_, ttl, rdata_len = struct.unpack(
-            '!2s2sIH',
-            bytes_[type_start:data_start]
-        )
-        rdata = bytes_[data_start:data_start+rdata_len]
-        decompressed_rdata = decompress_rdata(type_, bytes_, data_start, rdata_len)
+        ttl, rdata_len = struct.unpack_from('!IH', bytes_, type_start + 4)
+        if data_start + rdata_len > len(bytes_):
+            raise ValueError('resource record data is out of bounds')
+        type_ = bytes(bytes_[type_start:type_start+2])
+        rdata = bytes(bytes_[data_start:data_start+rdata_len])
+        if type_ in COMPRESSIBLE_TYPES:
+            decompressed_rdata = decompress_rdata(type_, bytes_, data_start, rdata_len)
+        else:
+            decompressed_rdata = rdata
         return cls(
             name_len=name_len,
             name=name,
             type_=type_,
-            class_=class_,
+            class_=bytes(bytes_[type_start+2:type_start+4]),
             ttl=ttl,
             rdata_len=rdata_len,
             rdata=rdata,
@@ -274,6 +336,46 @@ class ResourceRecord:
             self.decompressed_rdata
         )
 
+    def with_ttl(self, ttl):
+        return ResourceRecord(
+            self.name_len, self.name, self.type, self.class_, ttl,
+            self.rdata_len, self.rdata, self.decompressed_rdata
+        )
+
+    def write(self, buf, name_offsets):
+        # appends the record with compressed names, returns the offset of its ttl
+        write_name(buf, name_offsets, self.name)
+        buf += self.type
+        buf += self.class_
+        ttl_offset = len(buf)
+        buf += struct.pack('!IH', self.ttl, 0)
+        rdata_start = len(buf)
+        if self.type in COMPRESSIBLE_TYPES:
+            write_rdata(buf, name_offsets, self.type, self.decompressed_rdata)
+        else:
+            buf += self.decompressed_rdata
+        struct.pack_into('!H', buf, ttl_offset + 4, len(buf) - rdata_start)
+        return ttl_offset
+
+
+def opt_record(udp_size=EDNS_UDP_SIZE):
+    # EDNS0 pseudo-record (RFC 6891): the class carries the UDP payload size,
+    # the ttl extended rcode, version and flags
+    return ResourceRecord(
+        name_len=1,
+        name=b'.',
+        type_=OPT_TYPE,
+        class_=utils.int_to_bytes(udp_size, 2),
+        ttl=0,
+        rdata_len=0,
+        rdata=b'',
+        decompressed_rdata=b''
+    )
+
+
+# NS, CNAME, PTR, MX and SOA carry names that may point into the message
+COMPRESSIBLE_TYPES = {b'\x00\x02', b'\x00\x05', b'\x00\x0c', b'\x00\x0f', b'\x00\x06'}
+
 
 def decompress_rdata(type_, bytes_, start, rdata_len):
     type_val = utils.int_from_bytes(type_)
@@ -281,46 +383,136 @@ def decompress_rdata(type_, bytes_, start, rdata_len):
     if type_val in {2, 5, 12}:
         return encode_name(read_name(bytes_, start)[0])
     elif type_val == 15:
-        return bytes_[start:start+2] + encode_name(read_name(bytes_, start+2)[0])
+        return bytes(bytes_[start:start+2]) + encode_name(read_name(bytes_, start+2)[0])
     elif type_val == 6:
         mname, mname_len = read_name(bytes_, start)
         rname, rname_len = read_name(bytes_, start+mname_len)
         fix_start = start + mname_len + rname_len
-        return encode_name(mname) + encode_name(rname) + bytes_[fix_start:fix_start+20]
-    return bytes_[start: start+rdata_len]
+        return encode_name(mname) + encode_name(rname) + bytes(bytes_[fix_start:fix_start+20])
+    return bytes(bytes_[start: start+rdata_len])
+
+
+def write_rdata(buf, name_offsets, type_, rdata):
+    type_val = utils.int_from_bytes(type_)
+
+    if type_val in {2, 5, 12}:
+        write_name(buf, name_offsets, read_name(rdata, 0)[0])
+    elif type_val == 15:
+        buf += rdata[:2]
+        write_name(buf, name_offsets, read_name(rdata, 2)[0])
+    elif type_val == 6:
+        mname, mname_len = read_name(rdata, 0)
+        rname, rname_len = read_name(rdata, mname_len)
+        write_name(buf, name_offsets, mname)
+        write_name(buf, name_offsets, rname)
+        buf += rdata[mname_len+rname_len:]
+
+
+def read_query_key(bytes_):
+    # id, flags, normalized question key, raw question and EDNS0 udp size of a plain
+    # single question query, None for anything that needs the full Message.from_bytes
+    end = len(bytes_)
+    if end < Message.HEADER_LEN + 5:
+        return None
+    id_, flags, qdcount, ancount, nscount, arcount = struct.unpack_from('!HHHHHH', bytes_)
+    if flags & 0xF800 or qdcount != 1 or ancount or nscount or arcount > 1:
+        return None
+    curr = Message.HEADER_LEN
+    while True:
+        label_len = bytes_[curr]
+        if label_len == 0:
+            break
+        if label_len & 0xC0:
+            return None
+        curr += label_len + 1
+        if curr >= end:
+            return None
+    question_end = curr + 5
+    if question_end > end:
+        return None
+    udp_size = None
+    if arcount:
+        # only a bare OPT record with the root name is expected here
+        if question_end + 11 > end or bytes_[question_end] != 0:
+            return None
+        type_, udp_size = struct.unpack_from('!HH', bytes_, question_end + 1)
+        if type_ != 41:
+            return None
+        udp_size = max(udp_size, MAX_UDP_SIZE)
+    view = memoryview(bytes_)
+    key = bytes(view[Message.HEADER_LEN:curr+1]).lower() + view[curr+1:question_end]
+    return id_, flags, key, view[Message.HEADER_LEN:question_end], udp_size
 
 
 def read_name(bytes_, start):
     labels, bytes_read = read_labels(bytes_, start)
-    name = b'.'.join(labels)
-    if not name.endswith(b'.'):
-        name += b'.'
-    return name, bytes_read
+    return b'.'.join(labels) + b'.', bytes_read
+
+
+MAX_NAME_LEN = 255
 
 
 def read_labels(bytes_, start):
+    # follows compression pointers iteratively; every pointer has to point
+    # before itself and the name can't outgrow 255 bytes, so loops are cut off
     labels = []
-    bytes_read = 0
+    bytes_read = None
+    name_len = 0
+    curr = start
     while True:
-        curr = start + bytes_read
-        code = utils.int_from_bytes(bytes_[curr:curr+1]) >> 6
-        if code == 0:
-            bytes_read += 1
-            label_len = utils.int_from_bytes(bytes_[curr:curr+1])
-            if label_len == 0:
-                break
-            label = bytes_[curr+1:curr+1+label_len]
-            labels.append(label)
-            bytes_read += label_len
-        else:
-            bytes_read += 2
-            pointer = utils.int_from_bytes(bytes_[curr:curr+2]) & (2**14 - 1)
-            pointer_labels, _ = read_labels(bytes_, pointer)
-            labels.extend(pointer_labels)
+        label_len = bytes_[curr]
+        if label_len == 0:
             break
+        if label_len < 64:
+            labels.append(bytes(bytes_[curr+1:curr+1+label_len]))
+            name_len += label_len + 1
+            curr += label_len + 1
+        elif label_len >= 192:
+            pointer = (label_len & 63) << 8 | bytes_[curr+1]
+            if bytes_read is None:
+                bytes_read = curr + 2 - start
+            if pointer >= curr:
+                raise ValueError('compression pointer does not point backwards')
+            curr = pointer
+            name_len += 1
+        else:
+            raise ValueError('unknown label type')
+        if name_len > MAX_NAME_LEN:
+            raise ValueError('name is too long')
+    if bytes_read is None:
+        bytes_read = curr + 1 - start
     return labels, bytes_read
 
 
+@functools.lru_cache(maxsize=4096)
 def encode_name(name):
-    labels = name.split(b'.')
-    return b''.join(utils.int_to_bytes(len(label), 1) + label for label in labels)
+    return b''.join(
+        utils.int_to_bytes(len(label), 1) + label
+        for label in name.split(b'.') if label
+    ) + b'\x00'
+
+
+@functools.lru_cache(maxsize=4096)
+def name_suffixes(name):
+    # (lowercased suffix, encoded first label of the suffix) from the longest suffix down
+    labels = [label for label in name.split(b'.') if label]
+    return tuple(
+        (b'.'.join(labels[i:]).lower(), utils.int_to_bytes(len(labels[i]), 1) + labels[i])
+        for i in range(len(labels))
+    )
+
+
+# compression pointers have 14 bits for the offset
+MAX_POINTER = 0x3FFF
+
+
+def write_name(buf, name_offsets, name):
+    for suffix, label in name_suffixes(name):
+        pointer = name_offsets.get(suffix)
+        if pointer is not None:
+            buf += struct.pack('!H', 0xC000 | pointer)
+            return
+        if len(buf) <= MAX_POINTER:
+            name_offsets[suffix] = len(buf)
+        buf += label
+    buf.append(0)
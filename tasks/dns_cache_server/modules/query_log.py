@@ -0,0 +1,185 @@
+import os
+import sys
+import json
+import time
+import socket
+import struct
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from modules.protocol.message import read_name
+
+
+# where an answer came from: the cache, upstream, a fetch already in flight
+# for the same question, or an expired entry while upstream was failing
+OUTCOMES = ('hit', 'miss', 'coalesced', 'stale')
+
+
+class QueryLog:
+    # Every answered query is appended to a batch on the loop, batches are formatted
+    # and written by one background thread. With max_pending records not written yet
+    # new ones are dropped and counted rather than letting the server wait on disk.
+    # The file is rotated to path.1 .. path.<max_files> by size and by age.
+
+    # time, latency in microseconds, client port, qtype, rcode, outcome, address length,
+    # followed by the packed client address, name length and the name
+    RECORD = struct.Struct('!dIHHBBB')
+
+    def __init__(
+        self, path, binary=False, max_bytes=64 * 2**20, rotate_interval=3600, max_files=10,
+        flush_interval=1, batch_size=4096, max_pending=65536
+    ):
+        self.path = path
+        self.binary = binary
+        self.max_bytes = max_bytes
+        self.rotate_interval = rotate_interval
+        self.max_files = max_files
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.batch = []
+        # records handed to the writer thread and not written yet
+        self.pending = 0
+        self.written = 0
+        self.dropped = 0
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        # owned by the writer thread
+        self.file = None
+        self.opened_at = None
+
+    def start(self):
+        asyncio.get_event_loop().call_later(self.flush_interval, self.flush_periodically)
+
+    def log(self, client, response, outcome, latency):
+        # response is the answer sent, only its header and question are read, in the writer
+        if self.pending + len(self.batch) >= self.max_pending:
+            self.dropped += 1
+            return
+        self.batch.append((time.time(), client, response, outcome, latency))
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush_periodically(self):
+        self.flush()
+        asyncio.get_event_loop().call_later(self.flush_interval, self.flush_periodically)
+
+    def flush(self):
+        if not self.batch:
+            return
+        batch, self.batch = self.batch, []
+        self.pending += len(batch)
+        future = asyncio.get_event_loop().run_in_executor(self.executor, self.write, batch)
+        future.add_done_callback(lambda future: self.finish_write(future, len(batch)))
+
+    def finish_write(self, future, count):
+        self.pending -= count
+        if future.exception() is not None:
+            self.dropped += count
+        else:
+            self.written += count
+
+    def close(self):
+        # writes what's left, called once the loop has stopped
+        if self.batch:
+            self.executor.submit(self.write, self.batch)
+            self.batch = []
+        self.executor.shutdown(wait=True)
+        if self.file is not None:
+            self.file.close()
+
+    def write(self, batch):
+        now = time.time()
+        self.rotate(now)
+        if self.binary:
+            data = b''.join(map(self.encode_binary, batch))
+        else:
+            data = ''.join(json.dumps(self.to_dict(record)) + '\n' for record in batch).encode()
+        self.file.write(data)
+        self.file.flush()
+
+    def rotate(self, now):
+        if self.file is not None:
+            if self.file.tell() < self.max_bytes and now - self.opened_at < self.rotate_interval:
+                return
+            # forgotten before renaming, a failed rename leaves no closed file behind
+            # and the next write opens the path again
+            file, self.file = self.file, None
+            file.close()
+            for i in range(self.max_files - 1, 0, -1):
+                if os.path.exists(f'{self.path}.{i}'):
+                    os.replace(f'{self.path}.{i}', f'{self.path}.{i + 1}')
+            os.replace(self.path, f'{self.path}.1')
+        self.file = open(self.path, 'ab')
+        self.opened_at = now
+
+    @staticmethod
+    def read_question(response):
+        # an empty name and qtype 0 when there's no question to read, e.g. in the
+        # bare header answering a query without one, so the record is still written
+        rcode = response[3] & 15 if len(response) >= 4 else 0
+        try:
+            if struct.unpack_from('!H', response, 4)[0] == 0:
+                return b'', 0, rcode
+            name, name_len = read_name(response, 12)
+            qtype = struct.unpack_from('!H', response, 12 + name_len)[0]
+        except (ValueError, IndexError, struct.error):
+            return b'', 0, rcode
+        return name, qtype, rcode
+
+    def to_dict(self, record):
+        timestamp, (address, port, *_), response, outcome, latency = record
+        name, qtype, rcode = self.read_question(response)
+        return {
+            'time': round(timestamp, 6),
+            'client': address,
+            'port': port,
+            'name': name.decode(errors='replace'),
+            'type': qtype,
+            'rcode': rcode,
+            'outcome': outcome,
+            'latency_ms': round(latency * 1000, 3),
+        }
+
+    def encode_binary(self, record):
+        timestamp, (address, port, *_), response, outcome, latency = record
+        name, qtype, rcode = self.read_question(response)
+        packed = socket.inet_pton(socket.AF_INET6 if ':' in address else socket.AF_INET, address)
+        return b''.join([
+            self.RECORD.pack(
+                timestamp, min(int(latency * 1e6), 2**32 - 1), port, qtype, rcode,
+                OUTCOMES.index(outcome), len(packed)
+            ),
+            packed,
+            bytes([len(name)]),
+            name
+        ])
+
+
+def read_binary(path):
+    # records of a binary log as the dicts the JSONL format has
+    with open(path, 'rb') as f:
+        data = f.read()
+    curr = 0
+    while curr + QueryLog.RECORD.size <= len(data):
+        timestamp, latency, port, qtype, rcode, outcome, address_len = QueryLog.RECORD.unpack_from(data, curr)
+        curr += QueryLog.RECORD.size
+        address = data[curr:curr+address_len]
+        curr += address_len
+        name = data[curr+1:curr+1+data[curr]]
+        curr += 1 + data[curr]
+        yield {
+            'time': round(timestamp, 6),
+            'client': socket.inet_ntop(socket.AF_INET6 if address_len == 16 else socket.AF_INET, address),
+            'port': port,
+            'name': name.decode(errors='replace'),
+            'type': qtype,
+            'rcode': rcode,
+            'outcome': OUTCOMES[outcome],
+            'latency_ms': round(latency / 1000, 3),
+        }
+
+
+if __name__ == '__main__':
+    # python -m modules.query_log querylog.bin > querylog.jsonl
+    for record in read_binary(sys.argv[1]):
+        print(json.dumps(record))
@@ -1,17 +1,243 @@
+import time
 import socket
+import struct
+import asyncio
+from collections import Counter, deque
 
+from modules.stats import Histogram
+from modules.protocol.message import Message
 
-class Resolver:
-    def __init__(self, server_addr, server_port):
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.sock.settimeout(5)
-        self.server_addr = server_addr
-        self.server_port = server_port
-
-    def resolve(self, message):
-        self.sock.sendto(message, (self.server_addr, self.server_port))
+
+class Upstream:
+    # recent rtts kept for the hedging percentile
+    SAMPLES = 64
+    HEDGE_PERCENTILE = 0.95
+    # hedge delay until there are enough samples to trust the percentile
+    DEFAULT_HEDGE_DELAY = 0.5
+    MIN_HEDGE_DELAY = 0.01
+    # consecutive failures that mark an upstream down, and for how long
+    MAX_FAILURES = 3
+    DOWN_TIME = 30
+
+    def __init__(self, addr, port):
+        # replies are matched by source address, so names are resolved up front
+        self.addr = (socket.gethostbyname(addr), port)
+        # smoothed rtt and its variation, updated the way TCP does it (RFC 6298)
+        self.srtt = None
+        self.rttvar = None
+        self.samples = deque(maxlen=self.SAMPLES)
+        self.rtt = Histogram()
+        self.failures = 0
+        self.down_until = 0
+
+    def __repr__(self):
+        return '{}:{}'.format(*self.addr)
+
+    def record_rtt(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.samples.append(rtt)
+        self.rtt.observe(rtt)
+        self.failures = 0
+        self.down_until = 0
+
+    def record_failure(self, now):
+        self.failures += 1
+        if self.failures >= self.MAX_FAILURES:
+            # probed again once this passes, a single failure then puts it back down
+            self.down_until = now + self.DOWN_TIME
+
+    def is_up(self, now):
+        return self.down_until <= now
+
+    def to_dict(self):
+        return {
+            'srtt': None if self.srtt is None else round(self.srtt * 1000, 3),
+            'up': self.is_up(time.monotonic()),
+            'failures': self.failures,
+            'rtt': self.rtt.to_dict(),
+        }
+
+    def hedge_delay(self, timeout):
+        if len(self.samples) < 8:
+            return min(self.DEFAULT_HEDGE_DELAY, timeout / 2)
+        samples = sorted(self.samples)
+        delay = samples[int(self.HEDGE_PERCENTILE * (len(samples) - 1))]
+        return min(max(delay, self.MIN_HEDGE_DELAY), timeout / 2)
+
+
+class TCPConnection:
+    # persistent connection to one upstream carrying pipelined queries (RFC 7766),
+    # reopened on demand after the upstream closes it
+    def __init__(self, addr, recursion_desired=True):
+        self.addr = addr
+        self.recursion_desired = recursion_desired
+        self.writer = None
+        self.lock = asyncio.Lock()
+        # (id, question entry) -> future with the response message
+        self.pending = {}
+
+    async def query(self, question_entry, timeout):
+        loop = asyncio.get_event_loop()
+        id_ = Message.generate_id()
+        while (id_, question_entry) in self.pending:
+            id_ = Message.generate_id()
+        key = (id_, question_entry)
+        future = loop.create_future()
+        self.pending[key] = future
         try:
-            data = self.sock.recv(1024)
-        except socket.timeout:
+            writer = await asyncio.wait_for(self.connect(), timeout)
+            query = Message.build_query(
+                question_entry, id_=id_, udp_size=None, recursion_desired=self.recursion_desired)
+            writer.write(struct.pack('!H', len(query)) + query)
+            return await asyncio.wait_for(future, timeout)
+        except (asyncio.TimeoutError, OSError):
             return None
-        return data
+        finally:
+            del self.pending[key]
+
+    async def connect(self):
+        async with self.lock:
+            if self.writer is None or self.writer.is_closing():
+                reader, self.writer = await asyncio.open_connection(*self.addr)
+                asyncio.ensure_future(self.read_responses(reader, self.writer))
+            return self.writer
+
+    async def read_responses(self, reader, writer):
+        try:
+            while True:
+                header = await reader.readexactly(2)
+                response = Message.from_bytes(await reader.readexactly(struct.unpack('!H', header)[0]))
+                if response is None or not response.question.entries:
+                    continue
+                future = self.pending.get((response.id, response.question.entries[0]))
+                if future is not None and not future.done():
+                    future.set_result(response)
+        except (asyncio.IncompleteReadError, OSError):
+            pass
+        finally:
+            writer.close()
+            # queries sent on this connection won't be answered anymore
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_result(None)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+class Resolver:
+    # forwards queries to recursive resolvers
+    recursion_desired = True
+
+    def __init__(self, upstreams, timeout=5):
+        self.upstreams = [Upstream(addr, port) for addr, port in upstreams]
+        self.by_addr = {upstream.addr: upstream for upstream in self.upstreams}
+        self.timeout = timeout
+        self.transport = None
+        # (id, question entry) -> (future with (response, upstream), {upstream: send time})
+        self.pending = {}
+        # upstream -> TCPConnection for answers that don't fit into UDP
+        self.tcp = {}
+        self.stats = Counter()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        response = Message.from_bytes(data)
+        if response is None or not response.question.entries:
+            return
+        pending = self.pending.get((response.id, response.question.entries[0]))
+        if pending is None:
+            return
+        future, sent = pending
+        upstream = self.by_addr.get(addr[:2])
+        if upstream not in sent:
+            return
+        sent_at = sent.pop(upstream)
+        upstream.record_rtt(time.monotonic() - sent_at)
+        if not future.done():
+            future.set_result((response, upstream))
+            # upstreams asked after the winner weren't given a fair chance
+            for other, other_sent_at in list(sent.items()):
+                if other_sent_at >= sent_at:
+                    del sent[other]
+
+    def error_received(self, exc):
+        pass
+
+    def connection_lost(self, exc):
+        for future, _ in self.pending.values():
+            if not future.done():
+                future.set_result((None, None))
+        for connection in self.tcp.values():
+            connection.close()
+
+    def ranked_upstreams(self, upstreams):
+        # healthy ones fastest first, unmeasured ones get tried early;
+        # when everything is down, the one due for a probe soonest
+        now = time.monotonic()
+        healthy = [upstream for upstream in upstreams if upstream.is_up(now)]
+        if not healthy:
+            return sorted(upstreams, key=lambda upstream: upstream.down_until)
+        return sorted(healthy, key=lambda upstream: upstream.srtt or 0)
+
+    async def resolve(self, question_entry):
+        return await self.query(question_entry, self.upstreams)
+
+    async def query(self, question_entry, upstreams):
+        response, upstream = await self.query_udp(question_entry, self.ranked_upstreams(upstreams))
+        if response is None or not response.tructation:
+            return response
+        # the answer didn't fit even the EDNS0 payload size, ask again over TCP
+        self.stats['tcp_queries'] += 1
+        connection = self.tcp.get(upstream)
+        if connection is None:
+            connection = self.tcp[upstream] = TCPConnection(upstream.addr, self.recursion_desired)
+        return await connection.query(question_entry, self.timeout)
+
+    async def query_udp(self, question_entry, upstreams):
+        loop = asyncio.get_event_loop()
+        id_ = Message.generate_id()
+        while (id_, question_entry) in self.pending:
+            id_ = Message.generate_id()
+        key = (id_, question_entry)
+        future = loop.create_future()
+        sent = {}
+        self.pending[key] = (future, sent)
+        query = Message.build_query(question_entry, id_=id_, recursion_desired=self.recursion_desired)
+        started = time.monotonic()
+        try:
+            # every hedge delay without an answer the next upstream is asked too,
+            # a single one gets a retransmit
+            schedule = upstreams if len(upstreams) > 1 else upstreams * 2
+            for i, upstream in enumerate(schedule):
+                if i:
+                    self.stats['hedged_queries'] += 1
+                self.send(query, upstream, sent)
+                if i + 1 == len(schedule) or time.monotonic() - started >= self.timeout:
+                    break
+                await asyncio.wait({future}, timeout=upstream.hedge_delay(self.timeout))
+                if future.done():
+                    break
+            remaining = self.timeout - (time.monotonic() - started)
+            return await asyncio.wait_for(future, remaining)
+        except (asyncio.TimeoutError, OSError):
+            self.stats['timeouts'] += 1
+            return None, None
+        finally:
+            del self.pending[key]
+            # whoever was asked before the winner and is still silent counts as failed
+            now = time.monotonic()
+            for upstream in sent:
+                upstream.record_failure(now)
+
+    def send(self, query, upstream, sent):
+        sent.setdefault(upstream, time.monotonic())
+        self.transport.sendto(query, upstream.addr)
@@ -1,87 +1,468 @@
+import os
+import time
+import signal
+import struct
 import asyncio
+import multiprocessing
+from collections import Counter
 
 from modules.cache import Cache
+from modules.store import CacheStore
 from modules.resolver import Resolver
-from modules.protocol.message import Message, ResponseType
+from modules.iterative import IterativeResolver, ROOT_HINTS
+from modules.query_log import QueryLog
+from modules.shared_cache import SharedCache
+from modules.stats import Histogram, SamplingProfiler, StatsReporter
+from modules.protocol.message import (
+    Message, ResponseType, MAX_UDP_SIZE, opt_record, read_query_key
+)
+
+
+OPT_RECORD = opt_record().to_bytes()
+
+
+def fit_response(data, question_end, udp_size, tcp):
+    # adds our OPT record for EDNS0 clients, and for UDP cuts a response that
+    # doesn't fit the client's payload size down to the question with TC set
+    if udp_size is not None:
+        data += OPT_RECORD
+        struct.pack_into('!H', data, 10, struct.unpack_from('!H', data, 10)[0] + 1)
+    if tcp or len(data) <= (udp_size or MAX_UDP_SIZE):
+        return data
+    del data[question_end:]
+    data[2] |= 2
+    struct.pack_into('!HHH', data, 6, 0, 0, 0)
+    if udp_size is not None:
+        data += OPT_RECORD
+        struct.pack_into('!H', data, 10, 1)
+    return data
+
+
+def is_cacheable(answer):
+    # answers and negative answers are, server failures and refusals aren't
+    return answer is not None and answer[0] in (ResponseType.NO_ERROR, ResponseType.NAME_ERROR)
+
+
+def write_tcp_message(writer, data):
+    writer.write(struct.pack('!H', len(data)) + data)
 
 
 class DNSServerProtocol:
-    def __init__(self, cache, remote_addr, remote_port):
+    TCP_IDLE_TIMEOUT = 10
+
+    def __init__(
+        self, cache, resolver, shared_cache=None, stale_answer_timeout=1.8,
+        profiler=None, query_log=None
+    ):
         self.cache = cache
-        self.remote_addr = remote_addr
-        self.remote_port = remote_port
+        self.resolver = resolver
+        self.shared_cache = shared_cache
+        # how long a query with an expired answer at hand waits for upstream
+        self.stale_answer_timeout = stale_answer_timeout
+        # question entry -> task fetching its records from upstream
+        self.in_flight = {}
+        self.stats = Counter()
+        # seconds from receiving a query to sending its answer, and spent parsing queries
+        self.latency = Histogram()
+        self.parse_time = Histogram()
+        self.query_log = query_log
+        self.cache.prefetch = self.prefetch
+        if profiler is not None:
+            self.datagram_received = profiler.wrap(self.datagram_received)
 
     def connection_made(self, transport):
         self.transport = transport
 
     def datagram_received(self, data, addr):
+        received = time.perf_counter()
+        self.stats['queries'] += 1
+        response = self.get_cached_answer(data, tcp=False)
+        if response is not None:
+            self.transport.sendto(response, addr)
+            self.answered(addr, response, 'hit', received)
+            return
+        asyncio.ensure_future(self.respond(data, addr, received))
+
+    async def respond(self, data, addr, received):
+        answer = await self.answer(data, tcp=False)
+        if answer is not None:
+            response, outcome = answer
+            self.transport.sendto(response, addr)
+            self.answered(addr, response, outcome, received)
+
+    def answered(self, addr, response, outcome, received):
+        latency = time.perf_counter() - received
+        self.latency.observe(latency)
+        if self.query_log is not None:
+            self.query_log.log(addr, response, outcome, latency)
+
+    async def handle_tcp_client(self, reader, writer):
+        # DNS over TCP (RFC 7766): length prefixed messages on a persistent connection,
+        # pipelined queries are answered as they complete
+        tasks = set()
+        try:
+            while True:
+                header = await asyncio.wait_for(reader.readexactly(2), self.TCP_IDLE_TIMEOUT)
+                data = await reader.readexactly(struct.unpack('!H', header)[0])
+                received = time.perf_counter()
+                self.stats['queries'] += 1
+                self.stats['tcp_queries'] += 1
+                response = self.get_cached_answer(data, tcp=True)
+                if response is not None:
+                    write_tcp_message(writer, response)
+                    self.answered(writer.get_extra_info('peername'), response, 'hit', received)
+                    continue
+                task = asyncio.ensure_future(self.respond_tcp(data, writer, received))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, OSError):
+            pass
+        finally:
+            if tasks:
+                await asyncio.wait(tasks)
+            writer.close()
+
+    async def respond_tcp(self, data, writer, received):
+        answer = await self.answer(data, tcp=True)
+        if answer is not None and not writer.is_closing():
+            response, outcome = answer
+            write_tcp_message(writer, response)
+            self.answered(writer.get_extra_info('peername'), response, outcome, received)
+
+    def get_cached_answer(self, data, tcp):
+        # header-and-question-only fast path, None when the query needs the full one
+        started = time.perf_counter()
+        parsed = read_query_key(data)
+        self.parse_time.observe(time.perf_counter() - started)
+        if parsed is None:
+            return None
+        id_, flags, key, question, udp_size = parsed
+        response = self.cache.get_response_bytes(key, id_, flags & 256, question)
+        if response is None and self.shared_cache is not None:
+            response = self.shared_cache.get_response_bytes(key, id_, flags & 256, question)
+            if response is not None:
+                self.stats['shared_cache_hits'] += 1
+        if response is None:
+            return None
+        return fit_response(response, Message.HEADER_LEN + len(question), udp_size, tcp)
+
+    async def answer(self, data, tcp):
+        # (response bytes, outcome as in query_log.OUTCOMES), None for garbage
+        started = time.perf_counter()
         query = Message.from_bytes(data)
+        self.parse_time.observe(time.perf_counter() - started)
         if query is None:
-            return
-        response = self.get_response(query)
-        self.transport.sendto(response.to_bytes(), addr)
+            return None
+        response, outcome = await self.get_response(query)
+        udp_size = query.get_udp_size()
+        data = self.get_cached_response_bytes(query, udp_size, tcp)
+        if data is not None:
+            return data, outcome
+        if udp_size is not None:
+            response.additional.entries.append(opt_record())
+        data = response.to_bytes()
+        if tcp or len(data) <= (udp_size or MAX_UDP_SIZE):
+            return data, outcome
+        response = Message.response_from_query(query, [], [], response.additional.entries[-1:] if udp_size else [])
+        response.tructation = True
+        return response.to_bytes(), outcome
 
-    def get_response(self, query):
+    def get_cached_response_bytes(self, query, udp_size, tcp):
+        if not self.cache.wire or len(query.question.entries) != 1:
+            return None
+        question_entry = query.question.entries[0]
+        question = question_entry.to_bytes()
+        response = self.cache.get_response_bytes(
+            question_entry.key,
+            query.id,
+            query.recursion_desired,
+            question,
+            touch=False
+        )
+        if response is None:
+            return None
+        return fit_response(response, Message.HEADER_LEN + len(question), udp_size, tcp)
+
+    async def get_response(self, query):
+        # the response and its outcome, that of the last question not answered from the cache
         # answer, authority and additional entries
         response_records = ([], [], [])
+        response_type = ResponseType.NO_ERROR
+        outcome = 'hit'
         for question_entry in query.question.entries:
-            next_response_records = self.get_response_records(question_entry)
-            if next_response_records is None:
+            answer, next_outcome = await self.get_response_records(question_entry)
+            if next_outcome != 'hit':
+                outcome = next_outcome
+            if answer is None:
                 return Message.response_from_query(
                     query=query,
                     response_type=ResponseType.SERVER_FAILURE,
                     answer=[],
                     authority=[],
                     additional=[]
-                )
+                ), outcome
+            next_response_type, next_response_records = answer
+            if next_response_type != ResponseType.NO_ERROR:
+                response_type = next_response_type
             for curr, nxt in zip(response_records, next_response_records):
                 curr.extend(nxt)
-        return Message.response_from_query(query, *response_records)
+        return Message.response_from_query(query, *response_records, response_type=response_type), outcome
 
-    def get_response_records(self, question_entry):
-        cache_records = self.cache.get_response_records(question_entry)
-        if cache_records is not None:
-            return cache_records
+    async def get_response_records(self, question_entry):
+        # (response type, response records) or None when there is nothing to answer with,
+        # and the outcome
+        cache_answer = self.cache.get_response_records(question_entry.key)
+        if cache_answer is not None:
+            return cache_answer, 'hit'
 
-        response_records = self.ask_remote_addr(question_entry)
-        if response_records is None:
-            return None
+        task = self.in_flight.get(question_entry)
+        if task is None:
+            task = self.start_fetch(question_entry)
+            outcome = 'miss'
+        else:
+            self.stats['coalesced_queries'] += 1
+            outcome = 'coalesced'
+        stale_answer = self.cache.get_stale_response_records(question_entry.key)
+        if stale_answer is None:
+            return await asyncio.shield(task), outcome
 
-        self.cache.update(question_entry, response_records)
-        return response_records
+        # an expired answer is still around, wait for upstream only so long (RFC 8767)
+        # and let the fetch finish in the background to refresh the cache
+        await asyncio.wait({task}, timeout=self.stale_answer_timeout)
+        if task.done() and is_cacheable(task.result()):
+            return task.result(), outcome
+        self.stats['stale_answers'] += 1
+        return stale_answer, 'stale'
 
-    def ask_remote_addr(self, question_entry):
-        resolver = Resolver(self.remote_addr, self.remote_port)
-        query = Message.build_query(question_entry)
-        try:
-            data = resolver.resolve(query)
-        except Exception:
-            return None
-        if data is None:
+    def prefetch(self, question_entry):
+        # refresh a popular entry in the background before it expires
+        if question_entry in self.in_flight:
+            return
+        self.stats['prefetches'] += 1
+        self.start_fetch(question_entry)
+
+    def start_fetch(self, question_entry):
+        self.stats['upstream_queries'] += 1
+        task = asyncio.ensure_future(self.fetch_response_records(question_entry))
+        self.in_flight[question_entry] = task
+        task.add_done_callback(lambda _: self.in_flight.pop(question_entry, None))
+        return task
+
+    async def fetch_response_records(self, question_entry):
+        answer = await self.ask_remote_addr(question_entry)
+        if not is_cacheable(answer):
+            return answer
+
+        response_type, response_records = answer
+        entry = self.cache.update(question_entry, response_records, response_type)
+        if entry is not None and self.shared_cache is not None:
+            self.shared_cache.put(question_entry.key, entry)
+        return answer
+
+    async def ask_remote_addr(self, question_entry):
+        response = await self.resolver.resolve(question_entry)
+        if response is None:
             return None
-        response = Message.from_bytes(data)
-        return response.get_response_records()
+        return response.response_type, response.get_response_records()
+
+    def get_stats(self):
+        cache = self.cache
+        lookups = cache.hits + cache.misses + cache.expired or 1
+        return {
+            'queries': self.stats['queries'],
+            'server': dict(self.stats),
+            'resolver': dict(self.resolver.stats),
+            'cache': {
+                'entries': len(cache),
+                'bytes': cache.bytes,
+                'evictions': cache.evictions,
+                'hits': cache.hits,
+                'misses': cache.misses,
+                'expired': cache.expired,
+                'hit_ratio': round(cache.hits / lookups, 4),
+                'miss_ratio': round(cache.misses / lookups, 4),
+                'expired_ratio': round(cache.expired / lookups, 4),
+            },
+            'latency_ms': self.latency.to_dict(),
+            'parse_time_ms': self.parse_time.to_dict(),
+            'upstreams': {
+                repr(upstream): upstream.to_dict()
+                for upstream in self.resolver.by_addr.values()
+            },
+            'query_log': None if self.query_log is None else {
+                'written': self.query_log.written,
+                'pending': self.query_log.pending + len(self.query_log.batch),
+                'dropped': self.query_log.dropped,
+            },
+        }
 
 
 class DNSServer:
-    def __init__(self, addr, port, remote_addr, remote_port):
+    PURGE_INTERVAL = 10
+
+    def __init__(
+        self, addr, port, upstreams,
+        cache_entries=10000, cache_bytes=32 * 2**20, wire_cache=False,
+        workers=1, shared_cache_slots=16384, journal='cache.journal',
+        prefetch_ratio=0.9, prefetch_min_hits=5,
+        max_stale=24 * 3600, stale_answer_timeout=1.8,
+        iterative=False, root_hints=ROOT_HINTS, ns_port=53,
+        stats_port=None, stats_interval=None, profile_every=0, profile_path='dns.prof',
+        query_log=None, query_log_binary=False, query_log_max_bytes=64 * 2**20,
+        query_log_rotate_interval=3600
+    ):
         self.addr = addr
         self.port = port
-        self.remote_addr = remote_addr
-        self.remote_port = remote_port
-        self.cache = Cache.load()
+        # (address, port) of every upstream resolver
+        self.upstreams = upstreams
+        # resolve from root_hints down instead of forwarding to upstreams,
+        # asking nameservers on ns_port
+        self.iterative = iterative
+        self.root_hints = root_hints
+        self.ns_port = ns_port
+        self.cache_entries = cache_entries
+        self.cache_bytes = cache_bytes
+        self.workers = workers
+        self.journal = journal
+        self.prefetch_ratio = prefetch_ratio
+        self.prefetch_min_hits = prefetch_min_hits
+        self.max_stale = max_stale
+        self.stale_answer_timeout = stale_answer_timeout
+        # HTTP stats endpoint on stats_port (plus the worker number), stats written
+        # to stderr every stats_interval seconds, one in profile_every queries profiled
+        self.stats_port = stats_port
+        self.stats_interval = stats_interval
+        self.profile_every = profile_every
+        self.profile_path = profile_path
+        # path of the query log, None to keep none
+        self.query_log = query_log
+        self.query_log_binary = query_log_binary
+        self.query_log_max_bytes = query_log_max_bytes
+        self.query_log_rotate_interval = query_log_rotate_interval
+        self.shared_cache = None
+        if workers > 1:
+            # workers exchange serialized answers, so they need the wire cache
+            wire_cache = True
+            self.shared_cache = SharedCache(shared_cache_slots)
+        self.wire_cache = wire_cache
+        self.cache = None
+        self.store = None
+
+    def open_cache(self, worker):
+        if self.journal is not None:
+            # one journal per worker, each only ever appended to by its owner
+            path = self.journal if self.workers == 1 else f'{self.journal}.{worker}'
+            self.store = CacheStore(path)
+        self.cache = Cache(
+            self.cache_entries, self.cache_bytes, self.wire_cache, self.store,
+            self.prefetch_ratio, self.prefetch_min_hits, self.max_stale
+        )
+        if self.store is not None:
+            self.store.load(self.cache)
+
+    def open_query_log(self, worker):
+        if self.query_log is None:
+            return None
+        path = self.query_log
+        if self.workers > 1:
+            # the rotated files get a numeric suffix, the worker number goes before the extension
+            root, ext = os.path.splitext(path)
+            path = f'{root}.{worker}{ext}'
+        query_log = QueryLog(
+            path, self.query_log_binary, self.query_log_max_bytes, self.query_log_rotate_interval)
+        query_log.start()
+        return query_log
+
+    def make_resolver(self):
+        if self.iterative:
+            return IterativeResolver(self.root_hints, self.ns_port)
+        return Resolver(self.upstreams)
+
+    def maintain_cache(self):
+        self.cache.purge()
+        if self.store is not None:
+            self.store.flush()
+            if self.store.needs_compaction(self.cache):
+                self.store.compact(self.cache)
+        asyncio.get_event_loop().call_later(self.PURGE_INTERVAL, self.maintain_cache)
 
     def start(self):
-        loop = asyncio.get_event_loop()
+        if self.workers == 1:
+            self.serve()
+            return
+        # fork, so that workers inherit the shared cache mapping and its lock
+        context = multiprocessing.get_context('fork')
+        processes = [
+            context.Process(target=self.serve, args=(worker,))
+            for worker in range(self.workers)
+        ]
+        for process in processes:
+            process.start()
+        try:
+            for process in processes:
+                process.join()
+        except KeyboardInterrupt:
+            # a terminal interrupt reaches the workers too, otherwise pass it on
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            for process in processes:
+                process.join(1)
+                if process.is_alive():
+                    os.kill(process.pid, signal.SIGINT)
+                    process.join()
+
+    def serve(self, worker=0):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self.open_cache(worker)
+        loop.call_later(self.PURGE_INTERVAL, self.maintain_cache)
+        connect = loop.create_datagram_endpoint(
+            self.make_resolver,
+            local_addr=('0.0.0.0', 0)
+        )
+        resolver_transport, resolver = loop.run_until_complete(connect)
+        profiler = SamplingProfiler(self.profile_every) if self.profile_every else None
+        query_log = self.open_query_log(worker)
         listen = loop.create_datagram_endpoint(
-            lambda: DNSServerProtocol(self.cache, self.remote_addr, self.remote_port),
-            local_addr=(self.addr, self.port)
+            lambda: DNSServerProtocol(
+                self.cache, resolver, self.shared_cache, self.stale_answer_timeout,
+                profiler, query_log),
+            local_addr=(self.addr, self.port),
+            reuse_port=self.workers > 1
         )
         transport, protocol = loop.run_until_complete(listen)
+        tcp_listen = asyncio.start_server(
+            protocol.handle_tcp_client,
+            self.addr,
+            self.port,
+            reuse_port=self.workers > 1
+        )
+        tcp_server = loop.run_until_complete(tcp_listen)
+        started = time.monotonic()
+        reporter = StatsReporter(
+            lambda: dict(worker=worker, uptime=round(time.monotonic() - started), **protocol.get_stats()),
+            profiler
+        )
+        stats_server = None
+        if self.stats_port is not None:
+            stats_listen = asyncio.start_server(
+                reporter.handle_http_client, self.addr, self.stats_port + worker)
+            stats_server = loop.run_until_complete(stats_listen)
+        if self.stats_interval:
+            loop.call_later(self.stats_interval, reporter.dump, self.stats_interval)
         try:
             loop.run_forever()
         except KeyboardInterrupt:
             pass
+        if query_log is not None:
+            query_log.close()
+        if profiler is not None:
+            path = self.profile_path if self.workers == 1 else f'{self.profile_path}.{worker}'
+            profiler.profile.dump_stats(path)
+        if stats_server is not None:
+            stats_server.close()
+        tcp_server.close()
         transport.close()
+        resolver_transport.close()
         loop.close()
-        self.cache.save()
+        if self.store is not None:
+            self.store.close()
@@ -0,0 +1,94 @@
+import mmap
+import time
+import zlib
+import struct
+import multiprocessing
+
+from modules.cache import patch_response
+
+
+class SharedCache:
+    # Open addressing hash table of serialized answers in an anonymous shared
+    # mapping, inherited by forked workers. Writers serialize on a lock, readers
+    # don't lock at all and instead check the slot sequence number before and
+    # after copying: odd means a write is in progress, a change means it raced.
+
+    # seq, deadline, inserted, key length, data length, ttl count
+    HEADER = struct.Struct('!IddHHH')
+    # the header after seq, written before it
+    FIELDS = struct.Struct('!ddHHH')
+    TTL = struct.Struct('!HI')
+    PROBES = 4
+
+    def __init__(self, slots=16384, slot_size=1024):
+        self.slots = slots
+        self.slot_size = slot_size
+        self.map = mmap.mmap(-1, slots * slot_size)
+        self.lock = multiprocessing.get_context('fork').Lock()
+
+    def get_response_bytes(self, key, id_, recursion_desired, question):
+        now = time.monotonic()
+        for start in self.probe(key):
+            seq, deadline, inserted, key_len, data_len, ttl_count = self.HEADER.unpack_from(self.map, start)
+            if seq & 1 or key_len != len(key):
+                continue
+            key_start = start + self.HEADER.size
+            if self.map[key_start:key_start+key_len] != key:
+                continue
+            if deadline <= now:
+                return None
+            data_start = key_start + key_len
+            ttls_start = data_start + data_len
+            # lengths from a write racing this read may point past the slot
+            if ttls_start + ttl_count * self.TTL.size > start + self.slot_size:
+                return None
+            wire = self.map[data_start:ttls_start]
+            ttls = [
+                self.TTL.unpack_from(self.map, ttls_start + i * self.TTL.size)
+                for i in range(ttl_count)
+            ]
+            if self.HEADER.unpack_from(self.map, start)[0] != seq:
+                return None
+            return patch_response(wire, ttls, int(now - inserted), id_, recursion_desired, question)
+        return None
+
+    def put(self, key, entry):
+        size = self.HEADER.size + len(key) + len(entry.wire) + len(entry.ttls) * self.TTL.size
+        if size > self.slot_size:
+            return
+        with self.lock:
+            start = self.choose_slot(key)
+            seq = self.HEADER.unpack_from(self.map, start)[0]
+            struct.pack_into('!I', self.map, start, seq + 1)
+            curr = start + self.HEADER.size
+            self.map[curr:curr+len(key)] = key
+            curr += len(key)
+            self.map[curr:curr+len(entry.wire)] = entry.wire
+            curr += len(entry.wire)
+            for offset, ttl in entry.ttls:
+                self.TTL.pack_into(self.map, curr, offset, ttl)
+                curr += self.TTL.size
+            self.FIELDS.pack_into(
+                self.map, start + 4, entry.deadline, entry.inserted,
+                len(key), len(entry.wire), len(entry.ttls)
+            )
+            # last and on its own, so a reader never sees it with the old lengths
+            struct.pack_into('!I', self.map, start, (seq + 2) & 0xFFFFFFFF)
+
+    def choose_slot(self, key):
+        # the slot already holding the key, else the one expiring first;
+        # free slots have a zero deadline and expired ones are in the past
+        victim, victim_deadline = None, None
+        for start in self.probe(key):
+            _, deadline, _, key_len, _, _ = self.HEADER.unpack_from(self.map, start)
+            key_start = start + self.HEADER.size
+            if key_len == len(key) and self.map[key_start:key_start+key_len] == key:
+                return start
+            if victim is None or deadline < victim_deadline:
+                victim, victim_deadline = start, deadline
+        return victim
+
+    def probe(self, key):
+        index = zlib.crc32(key) % self.slots
+        for i in range(self.PROBES):
+            yield (index + i) % self.slots * self.slot_size
@@ -0,0 +1,132 @@
+import io
+import sys
+import json
+import math
+import time
+import pstats
+import asyncio
+import cProfile
+
+
+class Histogram:
+    # durations in log spaced buckets, four per doubling from a microsecond up,
+    # so observing is a few float operations and percentiles are within 12%
+    SUBBUCKETS = 4
+    BUCKETS = 40 * SUBBUCKETS
+
+    __slots__ = ('counts', 'count', 'total')
+
+    def __init__(self):
+        self.counts = [0] * self.BUCKETS
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, seconds):
+        self.count += 1
+        self.total += seconds
+        mantissa, exponent = math.frexp(seconds * 1e6)
+        index = exponent * self.SUBBUCKETS + int((mantissa - 0.5) * 2 * self.SUBBUCKETS)
+        self.counts[min(max(index, 0), self.BUCKETS - 1)] += 1
+
+    def upper_bound(self, index):
+        exponent, subbucket = divmod(index, self.SUBBUCKETS)
+        return math.ldexp(0.5 + (subbucket + 1) / (2 * self.SUBBUCKETS), exponent) / 1e6
+
+    def percentile(self, share):
+        target = share * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= target:
+                return self.upper_bound(index)
+        return 0.0
+
+    def to_dict(self):
+        # milliseconds
+        if not self.count:
+            return {'count': 0}
+        return {
+            'count': self.count,
+            'mean': round(self.total / self.count * 1000, 3),
+            'p50': round(self.percentile(0.5) * 1000, 3),
+            'p90': round(self.percentile(0.9) * 1000, 3),
+            'p99': round(self.percentile(0.99) * 1000, 3),
+            'p999': round(self.percentile(0.999) * 1000, 3),
+        }
+
+
+class SamplingProfiler:
+    # runs one call in every `every` under cProfile, cheap enough to leave on
+    def __init__(self, every):
+        self.every = every
+        self.calls = 0
+        self.profile = cProfile.Profile()
+
+    def wrap(self, function):
+        def sampled(*args):
+            self.calls += 1
+            if self.calls % self.every:
+                return function(*args)
+            self.profile.enable()
+            try:
+                return function(*args)
+            finally:
+                self.profile.disable()
+        return sampled
+
+    def report(self, limit=30):
+        stream = io.StringIO()
+        try:
+            pstats.Stats(self.profile, stream=stream).sort_stats('cumulative').print_stats(limit)
+        except TypeError:
+            # nothing sampled yet
+            return 'no samples\n'
+        return stream.getvalue()
+
+
+class StatsReporter:
+    # serves collect() as JSON over HTTP (GET / and, with a profiler, GET /profile)
+    # and/or writes it to stderr as a JSON line every interval seconds; qps is since
+    # the consumer's previous snapshot, so polling doesn't shorten the dump's window
+    def __init__(self, collect, profiler=None):
+        self.collect = collect
+        self.profiler = profiler
+        # consumer -> (time, queries) of its previous snapshot
+        self.last = {}
+
+    def snapshot(self, consumer):
+        stats = self.collect()
+        now = time.monotonic()
+        last = self.last.get(consumer)
+        if last is not None and now > last[0]:
+            stats['qps'] = round((stats['queries'] - last[1]) / (now - last[0]), 1)
+        self.last[consumer] = (now, stats['queries'])
+        return stats
+
+    def dump(self, interval):
+        print(json.dumps(self.snapshot('dump')), file=sys.stderr, flush=True)
+        asyncio.get_event_loop().call_later(interval, self.dump, interval)
+
+    async def handle_http_client(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 5)
+            while (await asyncio.wait_for(reader.readline(), 5)).strip():
+                pass
+            path = request_line.split()[1] if len(request_line.split()) > 1 else b'/'
+            if path == b'/':
+                status, content_type = '200 OK', 'application/json'
+                body = json.dumps(self.snapshot('http'), indent=2).encode()
+            elif path == b'/profile' and self.profiler is not None:
+                status, content_type = '200 OK', 'text/plain'
+                body = self.profiler.report().encode()
+            else:
+                status, content_type, body = '404 Not Found', 'text/plain', b'not found\n'
+            writer.write(
+                f'HTTP/1.0 {status}\r\nContent-Type: {content_type}\r\n'
+                f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, OSError):
+            pass
+        finally:
+            writer.close()
@@ -0,0 +1,119 @@
+import os
+import mmap
+import time
+import struct
+import asyncio
+
+from modules.cache import CacheEntry
+
+
+class CacheStore:
+    # Append-only journal of cache inserts. A record is a header followed by
+    # the question key, the serialized answer and its (ttl offset, ttl) table.
+    # Times are wall clock so that they survive restarts; later records for
+    # the same key win and ones too old to be served even stale are skipped on load.
+
+    # expires, inserted, key length, answer length, ttl count
+    HEADER = struct.Struct('!ddHIH')
+    TTL = struct.Struct('!HI')
+
+    def __init__(self, path='cache.journal'):
+        self.path = path
+        self.file = open(path, 'ab')
+        self.records = 0
+        # records appended while a compaction is running, None otherwise
+        self.pending = None
+
+    def load(self, cache):
+        # scans headers through mmap, only live records are copied out
+        index = {}
+        with open(self.path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as view:
+                curr = 0
+                while curr + self.HEADER.size <= len(view):
+                    expires, inserted, key_len, wire_len, ttl_count = self.HEADER.unpack_from(view, curr)
+                    key_start = curr + self.HEADER.size
+                    end = key_start + key_len + wire_len + ttl_count * self.TTL.size
+                    if end > len(view):
+                        # torn tail after a crash
+                        break
+                    index[bytes(view[key_start:key_start+key_len])] = curr
+                    self.records += 1
+                    curr = end
+
+                now = time.time()
+                offset = time.monotonic() - now
+                for key, curr in index.items():
+                    expires, inserted, key_len, wire_len, ttl_count = self.HEADER.unpack_from(view, curr)
+                    if expires + cache.max_stale <= now:
+                        continue
+                    wire_start = curr + self.HEADER.size + key_len
+                    ttls_start = wire_start + wire_len
+                    ttls = [
+                        self.TTL.unpack_from(view, ttls_start + i * self.TTL.size)
+                        for i in range(ttl_count)
+                    ]
+                    cache.restore(key, CacheEntry.from_wire(
+                        bytes(view[wire_start:ttls_start]),
+                        ttls,
+                        expires + offset,
+                        inserted + offset
+                    ))
+
+    def append(self, key, entry):
+        record = self.pack(key, entry.wire, entry.ttls, entry.deadline, entry.inserted, time.time() - time.monotonic())
+        self.file.write(record)
+        self.records += 1
+        if self.pending is not None:
+            self.pending.append(record)
+
+    def pack(self, key, wire, ttls, deadline, inserted, offset):
+        return b''.join([
+            self.HEADER.pack(deadline + offset, inserted + offset, len(key), len(wire), len(ttls)),
+            key,
+            wire,
+            b''.join(self.TTL.pack(ttl_offset, ttl) for ttl_offset, ttl in ttls)
+        ])
+
+    def flush(self):
+        self.file.flush()
+
+    def needs_compaction(self, cache):
+        return self.pending is None and self.records > 2 * len(cache) + 1024
+
+    def compact(self, cache):
+        # snapshot live entries here, write them out in a thread, then swap files
+        # in the loop and replay whatever was appended in the meantime
+        entries = [
+            (key, entry.wire, entry.ttls, entry.deadline, entry.inserted)
+            for key, entry in cache.map.items()
+        ]
+        self.pending = []
+        loop = asyncio.get_event_loop()
+        future = loop.run_in_executor(None, self.write_snapshot, entries)
+        future.add_done_callback(self.finish_compaction)
+
+    def write_snapshot(self, entries):
+        offset = time.time() - time.monotonic()
+        with open(self.path + '.tmp', 'wb') as f:
+            for entry in entries:
+                f.write(self.pack(*entry, offset))
+        return len(entries)
+
+    def finish_compaction(self, future):
+        pending, self.pending = self.pending, None
+        if future.exception() is not None:
+            return
+        with open(self.path + '.tmp', 'ab') as f:
+            f.write(b''.join(pending))
+            f.flush()
+            os.fsync(f.fileno())
+        self.file.close()
+        os.replace(self.path + '.tmp', self.path)
+        self.file = open(self.path, 'ab')
+        self.records = future.result() + len(pending)
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,130 @@
+import os
+import sys
+import json
+import threading
+
+
+class AccessLog:
+    # One JSON line per finished request. Records are only appended to a batch by
+    # the serving threads or coroutines, a background thread formats and writes them
+    # every flush_interval seconds or once batch_size have piled up. With max_pending
+    # records not written yet new ones are dropped and counted rather than letting
+    # requests wait on disk. The file is rotated to path.1 .. path.<max_files> by size,
+    # '-' writes to stdout.
+    def __init__(
+        self, path, max_bytes=64 * 2**20, max_files=10, flush_interval=1, batch_size=4096,
+        max_pending=65536
+    ):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.batch = []
+        # records taken by the writer and not written yet
+        self.pending = 0
+        self.written = 0
+        self.dropped = 0
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.closed = False
+        self.thread = None
+        # owned by the writer thread
+        self.file = None
+
+    def start(self):
+        # in the process that logs, the thread wouldn't survive a fork
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def log(self, record):
+        with self.lock:
+            if self.pending + len(self.batch) >= self.max_pending:
+                self.dropped += 1
+                return
+            self.batch.append(record)
+            full = len(self.batch) >= self.batch_size
+        if full:
+            self.wakeup.set()
+
+    def run(self):
+        while not self.closed:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                # the batch is counted as dropped, the next one may still get written
+                pass
+
+    def flush(self):
+        with self.lock:
+            batch, self.batch = self.batch, []
+            self.pending += len(batch)
+        if not batch:
+            return
+        written, dropped = 0, len(batch)
+        try:
+            self.write(batch)
+            written, dropped = len(batch), 0
+        except (OSError, ValueError):
+            pass
+        finally:
+            with self.lock:
+                self.pending -= len(batch)
+                self.written += written
+                self.dropped += dropped
+
+    def close(self):
+        # writes what's left
+        self.closed = True
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.flush()
+        if self.file is not None and self.file is not sys.stdout.buffer:
+            self.file.close()
+
+    def write(self, batch):
+        self.rotate()
+        self.file.write(''.join(json.dumps(self.to_dict(record)) + '\n' for record in batch).encode())
+        self.file.flush()
+
+    def rotate(self):
+        if self.path == '-':
+            self.file = sys.stdout.buffer
+            return
+        if self.file is not None:
+            if self.file.tell() < self.max_bytes:
+                return
+            # forgotten before renaming, a failed rename leaves no closed file behind
+            # and the next write opens the path again
+            file, self.file = self.file, None
+            file.close()
+            for i in range(self.max_files - 1, 0, -1):
+                if os.path.exists(f'{self.path}.{i}'):
+                    os.replace(f'{self.path}.{i}', f'{self.path}.{i + 1}')
+            os.replace(self.path, f'{self.path}.1')
+        self.file = open(self.path, 'ab')
+
+    @staticmethod
+    def to_dict(record):
+        def ms(seconds):
+            return None if seconds is None else round(seconds * 1000, 3)
+
+        return {
+            'time': round(record['time'], 6),
+            'client': record['client'],
+            'method': record['method'],
+            'url': record['url'],
+            'status': record['status'],
+            'bytes_in': record['bytes_in'],
+            'bytes_out': record['bytes_out'],
+            'duration_ms': ms(record['duration']),
+            'ttfb_ms': ms(record['ttfb']),
+            'upstream_connect_ms': ms(record['connect']),
+            'reused': record['reused'],
+            'cache': record['cache'],
+            'injected': record['injected'],
+        }
@@ -0,0 +1,294 @@
+import os
+import time
+import signal
+import socket
+import asyncio
+import multiprocessing
+from collections import deque
+
+import http_utils
+import streaming
+import response_cache
+from http_parser import HTTPParser, ParseError
+from proxy_server import ProxyServer
+from tunnel import Tunnel
+from connection_pool import AsyncConnectionPool
+
+
+class AsyncProxyServer(ProxyServer):
+    # Same proxy on asyncio streams: a connection costs a coroutine instead of
+    # a thread, so idle keep-alive clients don't hold anyone else up.
+    # With workers > 1 the listening socket is shared by forked processes,
+    # each accepting on it with its own event loop.
+    TIMEOUT = 10
+
+    def __init__(self, host, port, workers=1, **kwargs):
+        super().__init__(host, port, **kwargs)
+        self.workers = workers
+
+    def make_pool(self, max_idle, idle_timeout):
+        return AsyncConnectionPool(max_idle, idle_timeout)
+
+    def start(self):
+        self.sock.bind((self.host, self.port))
+        self.sock.listen(1024)
+        self.sock.setblocking(False)
+        print(f'Listening on {self.host}:{self.port}...')
+        if self.workers == 1:
+            self.serve()
+            return
+        context = multiprocessing.get_context('fork')
+        processes = [context.Process(target=self.serve, args=(worker,)) for worker in range(self.workers)]
+        for process in processes:
+            process.start()
+        try:
+            for process in processes:
+                process.join()
+        except KeyboardInterrupt:
+            # a terminal interrupt reaches the workers too, otherwise pass it on
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            for process in processes:
+                process.join(1)
+                if process.is_alive():
+                    os.kill(process.pid, signal.SIGINT)
+                    process.join()
+
+    def serve(self, worker=None):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        server = loop.run_until_complete(asyncio.start_server(self.handle_client, sock=self.sock))
+        self.start_reporting(worker)
+        try:
+            loop.run_forever()
+        except KeyboardInterrupt:
+            pass
+        server.close()
+        loop.close()
+        self.stop_reporting()
+
+    async def handle_client(self, reader, writer):
+        parser = HTTPParser()
+        events = deque()
+        address = writer.get_extra_info('peername')
+        # asyncio sets it only for sockets created with proto IPPROTO_TCP, accepted ones have 0
+        self.set_nodelay(writer.get_extra_info('socket'))
+        self.metrics.connection_opened()
+        try:
+            while True:
+                event = await self.read_event_async(reader, parser, events)
+                if event is None:
+                    break
+                request = event[1]
+                record = self.start_record(address, request)
+                try:
+                    if request['method'] == 'CONNECT':
+                        await self.open_tunnel_async(reader, writer, request, events, record)
+                        break
+                    if not await self.relay_async(reader, writer, parser, events, request, record):
+                        break
+                finally:
+                    self.finish_record(record)
+        except (OSError, ParseError, asyncio.TimeoutError):
+            pass
+        finally:
+            self.metrics.connection_closed()
+            writer.close()
+
+    async def read_event_async(self, reader, parser, events):
+        while not events:
+            data = await asyncio.wait_for(reader.read(self.BUFF_SIZE), self.TIMEOUT)
+            events.extend(parser.feed(data) if data else parser.feed_eof())
+            if not data and not events:
+                return None
+        return events.popleft()
+
+    async def send_async(self, writer, buffers):
+        # waits while the transport's buffer is full, so a slow reader holds
+        # the relay back instead of piling the body up in memory, returns the bytes sent
+        buffers = [buffer for buffer in buffers if len(buffer)]
+        writer.writelines(buffers)
+        await writer.drain()
+        return sum(map(len, buffers))
+
+    async def get_upstream_addr_async(self, host):
+        # resolves in a thread only when the host isn't cached
+        name, _, port = host.partition(':')
+        address = self.host_cache.get(name)
+        if address is None:
+            address = await asyncio.get_event_loop().run_in_executor(None, self.host_cache.resolve, name)
+        return address, int(port or 80)
+
+    async def open_tunnel_async(self, reader, writer, request, events, record):
+        authority = self.get_tunnel_addr(request)
+        if authority is None:
+            record['status'] = 403
+            record['bytes_out'] += await self.send_async(writer, [self.FORBIDDEN])
+            return
+        # whatever the client sends from here on belongs to the tunnel, the transport
+        # stops reading so it stays in the socket or in reader's buffer
+        writer.transport.pause_reading()
+        loop = asyncio.get_event_loop()
+        upstream = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        upstream.setblocking(False)
+        try:
+            addr = await self.get_upstream_addr_async(authority)
+            started = time.monotonic()
+            await asyncio.wait_for(loop.sock_connect(upstream, addr), self.TIMEOUT)
+            record['connect'] = time.monotonic() - started
+        except (OSError, ValueError, asyncio.TimeoutError):
+            upstream.close()
+            record['status'] = 502
+            record['bytes_out'] += await self.send_async(writer, [self.BAD_GATEWAY])
+            return
+        record['status'] = 200
+        # the tunnel works on the client socket itself, so the transport lets go of a
+        # duplicate of it; what it read before the pause is still in reader, ending
+        # the reader makes read() return all of that at once
+        reader.feed_eof()
+        buffered = await reader.read()
+        client = socket.socket(fileno=os.dup(writer.get_extra_info('socket').fileno()))
+        client.setblocking(False)
+        writer.transport.abort()
+        try:
+            await loop.sock_sendall(client, self.ESTABLISHED)
+            early = [data for kind, data in events if kind == 'data'] + [buffered]
+            events.clear()
+            for data in early:
+                if data:
+                    record['bytes_in'] += len(data)
+                    await loop.sock_sendall(upstream, data)
+        except OSError:
+            client.close()
+            upstream.close()
+            return
+        tunnel = Tunnel(client, upstream, self.splice, self.tunnel_idle_timeout)
+        self.metrics.tunnel_opened()
+        try:
+            await tunnel.run_async()
+        finally:
+            self.metrics.tunnel_closed()
+            self.count_tunnel(tunnel, record)
+
+    async def lookup_async(self, request):
+        # the disk tier is read in a thread
+        cached = self.cache.lookup(request, read_disk=False)
+        if cached is response_cache.ON_DISK:
+            cached = await asyncio.get_event_loop().run_in_executor(None, self.cache.lookup, request)
+        return cached
+
+    async def relay_async(self, client_reader, client_writer, client_parser, client_events, request, record):
+        cached = await self.lookup_async(request) if self.cache is not None else None
+        if cached is not None and cached.is_fresh(request, time.time()):
+            record['cache'] = 'hit'
+            return await self.send_cached_async(client_writer, request, cached, record)
+        if self.cache is not None:
+            record['cache'] = 'miss'
+        upstream_request = request
+        if cached is not None:
+            upstream_request = self.cache.conditional_request(request, cached)
+            if upstream_request is None:
+                cached, upstream_request = None, request
+
+        host = request['header_fields'].get('Host')
+        if host is None:
+            return False
+        try:
+            addr = await self.get_upstream_addr_async(host)
+        except (OSError, ValueError):
+            return False
+        request_time = time.time()
+        head = http_utils.build_head(upstream_request)
+        retrying = False
+        while True:
+            connection = self.pool.get(addr)
+            reused = connection is not None
+            parser = HTTPParser(response=True)
+            events = deque()
+            try:
+                if connection is None:
+                    started = time.monotonic()
+                    connection = await asyncio.wait_for(asyncio.open_connection(*addr), self.TIMEOUT)
+                    record['connect'] = time.monotonic() - started
+                record['reused'] = reused
+                if retrying:
+                    await self.send_async(connection[1], [head])
+                else:
+                    retrying = True
+                    await self.send_request_async(
+                        connection[1], head, request, client_reader, client_parser, client_events, record)
+                response = await self.read_response_async(connection[0], parser, events, request)
+            except (OSError, ParseError, asyncio.TimeoutError):
+                response = None
+            if response is not None:
+                break
+            if connection is not None:
+                connection[1].close()
+            # the server may have closed a pooled connection just as it was reused,
+            # the request can be sent again unless its body is gone already
+            if not reused or request['framing'] != 'none':
+                return False
+        record['ttfb'] = time.monotonic() - record['start']
+
+        stream = None
+        if cached is None or response['status_code'] != '304':
+            recorder = self.cache.record(request, response, request_time) if self.cache is not None else None
+            stream = streaming.ResponseStream(
+                request, response, recorder=recorder, compress=self.compress, level=self.compression_level)
+            record['status'] = int(response['status_code'])
+        else:
+            record['cache'] = 'revalidated'
+        try:
+            if stream is not None:
+                record['bytes_out'] += await self.send_async(client_writer, [stream.head])
+            while True:
+                kind, piece = await self.read_event_async(connection[0], parser, events)
+                if kind == 'end':
+                    if stream is not None:
+                        record['bytes_out'] += await self.send_async(client_writer, stream.end())
+                        record['injected'] = stream.injected
+                    break
+                record['bytes_out'] += await self.send_async(client_writer, stream.body(piece))
+        except (OSError, ParseError, asyncio.TimeoutError):
+            connection[1].close()
+            return False
+        if http_utils.keeps_alive(response) and not events and parser.is_idle():
+            self.pool.put(addr, connection)
+        else:
+            connection[1].close()
+        if stream is None:
+            cached = self.cache.update(request, cached, response, request_time)
+            return await self.send_cached_async(client_writer, request, cached, record)
+        return not stream.close
+
+    async def send_cached_async(self, client_writer, request, cached, record):
+        response = cached.to_response(request, time.time())
+        stream = streaming.ResponseStream(
+            request, response, inject=not cached.injected, compress=self.compress, level=self.compression_level)
+        body = stream.body(cached.body) if response['framing'] == 'length' else []
+        record['status'] = int(response['status_code'])
+        record['bytes_out'] += await self.send_async(client_writer, [stream.head, *body, *stream.end()])
+        record['injected'] = stream.injected
+        return not stream.close
+
+    async def send_request_async(self, writer, head, request, client_reader, client_parser, client_events, record):
+        chunked = request['framing'] == 'chunked'
+        buffers = [head]
+        while True:
+            kind, piece = await self.read_event_async(client_reader, client_parser, client_events)
+            if kind == 'end':
+                break
+            record['bytes_in'] += len(piece)
+            await self.send_async(writer, buffers + streaming.frame([piece], chunked))
+            buffers = []
+        await self.send_async(writer, buffers + [streaming.LAST_CHUNK] if chunked else buffers)
+
+    async def read_response_async(self, reader, parser, events, request):
+        while True:
+            parser.expect(request['method'])
+            event = await self.read_event_async(reader, parser, events)
+            if event is None:
+                return None
+            response = event[1]
+            if not response['status_code'].startswith('1') or response['status_code'] == '101':
+                return response
+            await self.read_event_async(reader, parser, events)
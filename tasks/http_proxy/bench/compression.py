@@ -0,0 +1,114 @@
+import sys
+import time
+import random
+import argparse
+
+import compression
+from http_parser import HTTPParser
+from streaming import ResponseStream
+
+
+# CPU spent on the header injection against bytes sent, for plain pages, compressed
+# pages that are decoded and encoded again, and plain pages compressed on the way
+# (--compress), at several levels; run from the proxy directory:
+#   python -m bench.compression [--size 200] [--levels 1,6,9]
+WORDS = (
+    'the of and to in is for on with as by at from that this be are or an it was not '
+    'page news article home about contact menu search login item price cart more'
+).split()
+
+
+def make_page(size, seed=1):
+    # markup repeated the way templates do, around text that compresses less well
+    rand = random.Random(seed)
+    parts = ['<!DOCTYPE html><html><head><title>bench</title></head><body>']
+    length = len(parts[0])
+    while length < size:
+        text = ' '.join(rand.choice(WORDS) for _ in range(rand.randint(5, 40)))
+        part = (
+            f'<div class="item item-{rand.randint(1, 50)}"><a href="/item/{rand.randint(1, 10**6)}">'
+            f'{text}</a><span class="price">{rand.randint(1, 999)}.{rand.randint(0, 99):02}</span></div>\n'
+        )
+        parts.append(part)
+        length += len(part)
+    parts.append('</body></html>')
+    return ''.join(parts).encode()
+
+
+def encode(page, encoding):
+    encoder = compression.Encoder(encoding, 6)
+    return encoder.compress(page) + encoder.flush()
+
+
+def make_response(body, encoding, piece_size):
+    head = b'HTTP/1.1 200 OK\r\nContent-Type: text/html\r\nContent-Length: %d\r\n' % len(body)
+    if encoding != 'identity':
+        head += b'Content-Encoding: %s\r\n' % encoding.encode()
+    data = head + b'\r\n' + body
+    return [data[i:i+piece_size] for i in range(0, len(data), piece_size)]
+
+
+def relay(pieces, request, **options):
+    # bytes the client would get
+    parser = HTTPParser(response=True)
+    sent = 0
+    for piece in pieces:
+        for kind, value in parser.feed(piece):
+            if kind == 'headers':
+                stream = ResponseStream(request, value, **options)
+                sent += len(stream.head)
+            elif kind == 'body':
+                sent += sum(map(len, stream.body(value)))
+            else:
+                sent += sum(map(len, stream.end()))
+    return sent
+
+
+def measure(pieces, request, number, **options):
+    start = time.process_time()
+    for _ in range(number):
+        sent = relay(pieces, request, **options)
+    return (time.process_time() - start) / number, sent
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=200, help='page size, KiB')
+    parser.add_argument('--levels', default='1,6,9')
+    parser.add_argument('-n', '--number', type=int, default=50)
+    parser.add_argument('--piece-size', type=int, default=64 * 1024)
+    namespace = parser.parse_args(sys.argv[1:])
+    levels = [int(level) for level in namespace.levels.split(',')]
+
+    page = make_page(namespace.size * 1024)
+    request = HTTPParser().feed(
+        b'GET / HTTP/1.1\r\nHost: bench\r\nAccept-Encoding: %s\r\n\r\n' % ', '.join(compression.ENCODINGS).encode()
+    )[0][1]
+    cases = [('identity page', 'identity', {})]
+    for encoding in compression.ENCODINGS:
+        # what relaying the page costs when nothing is injected
+        cases.append((f'{encoding} page, passed through', encoding, {'inject': False}))
+        for level in levels:
+            cases.append((f'{encoding} page, level {level}', encoding, {'level': level}))
+    for level in levels:
+        cases.append((f'identity page compressed, level {level}', 'identity', {'compress': True, 'level': level}))
+
+    print(f'page {len(page)} bytes')
+    print(f'{"case":34} {"CPU ms":>8} {"MB/s":>8} {"sent":>9} {"of page":>8} {"KB saved/CPU ms":>16}')
+    baseline = None
+    for name, encoding, options in cases:
+        body = page if encoding == 'identity' else encode(page, encoding)
+        seconds, sent = measure(make_response(body, encoding, namespace.piece_size), request, namespace.number, **options)
+        if baseline is None:
+            baseline = (seconds, sent)
+        extra_cpu = (seconds - baseline[0]) * 1000
+        saved = (baseline[1] - sent) / 1000
+        efficiency = f'{saved / extra_cpu:16.1f}' if extra_cpu > 0 and saved > 0 else f'{"-":>16}'
+        print(
+            f'{name:34} {seconds * 1000:8.2f} {len(page) / seconds / 1e6:8.1f} {sent:9} '
+            f'{sent / len(page):8.1%} {efficiency}'
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+import os
+import sys
+import time
+import signal
+import socket
+import asyncio
+import argparse
+import subprocess
+import multiprocessing
+
+from http_parser import HTTPParser
+from bench.tunnel import wait_for_port
+
+
+# Requests per second and latency percentiles of the proxy engines side by side.
+# A local keep-alive origin serves one HTML page, client processes keep
+# --connections keep-alive connections busy through the proxy for --duration
+# seconds each, run from the proxy directory:
+#   python -m bench.load [--engines threads,asyncio,asyncio:4] [--connections 64]
+# asyncio:N is the asyncio engine with N workers, --proxy-args is passed to
+# every proxy, e.g. '--cache-size 64' or '--access-log /tmp/access.jsonl'.
+
+
+def make_response(size):
+    body = b'<html><body>' + b'x' * max(size - 26, 0) + b'</body></html>'
+    head = b'HTTP/1.1 200 OK\r\nContent-Type: text/html\r\nContent-Length: %d\r\n\r\n' % len(body)
+    return head + body
+
+
+def serve_origin(sock, response):
+    async def handle(reader, writer):
+        parser = HTTPParser()
+        try:
+            while True:
+                data = await reader.read(64 * 1024)
+                if not data:
+                    break
+                for kind, _ in parser.feed(data):
+                    if kind == 'end':
+                        writer.write(response)
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def main():
+        server = await asyncio.start_server(handle, sock=sock)
+        await server.serve_forever()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
+
+
+async def run_connection(proxy_addr, request, warmup_end, deadline, latencies, counts):
+    # one keep-alive connection sending a request as soon as the last response is in,
+    # reconnecting when the proxy closes it
+    connection = None
+    parser = None
+    while time.monotonic() < deadline:
+        try:
+            if connection is None:
+                connection = await asyncio.open_connection(*proxy_addr)
+                parser = HTTPParser(response=True)
+            reader, writer = connection
+            start = time.perf_counter()
+            writer.write(request)
+            parser.expect('GET')
+            status = None
+            done = False
+            while not done:
+                data = await reader.read(64 * 1024)
+                if not data:
+                    raise ConnectionError('proxy closed the connection')
+                for kind, message in parser.feed(data):
+                    if kind == 'headers':
+                        status = message['status_code']
+                    elif kind == 'end':
+                        done = True
+            if time.monotonic() < warmup_end:
+                continue
+            if status == '200':
+                latencies.append(time.perf_counter() - start)
+            else:
+                counts['errors'] += 1
+        except (OSError, ConnectionError):
+            counts['errors'] += 1
+            if connection is not None:
+                connection[1].close()
+            connection = None
+            await asyncio.sleep(0.01)
+    if connection is not None:
+        connection[1].close()
+
+
+def run_client(proxy_addr, request, connections, warmup, duration, results):
+    async def main():
+        now = time.monotonic()
+        latencies = []
+        counts = {'errors': 0}
+        await asyncio.gather(*(
+            run_connection(proxy_addr, request, now + warmup, now + warmup + duration, latencies, counts)
+            for _ in range(connections)
+        ))
+        return latencies, counts['errors']
+
+    results.put(asyncio.run(main()))
+
+
+def percentile(ordered, share):
+    if not ordered:
+        return 0.0
+    return ordered[min(int(share * len(ordered)), len(ordered) - 1)]
+
+
+def run_case(engine, namespace, origin_port):
+    name, _, workers = engine.partition(':')
+    proxy = subprocess.Popen([
+        sys.executable, 'cli.py', '-p', str(namespace.port), '--engine', name,
+        *(['--workers', workers] if workers else []), *namespace.proxy_args.split()
+    ], stdout=subprocess.DEVNULL, start_new_session=True)
+    try:
+        addr = ('localhost', namespace.port)
+        wait_for_port(addr)
+        url = f'http://127.0.0.1:{origin_port}/page'
+        request = f'GET {url} HTTP/1.1\r\nHost: 127.0.0.1:{origin_port}\r\nUser-Agent: bench\r\n\r\n'.encode()
+        context = multiprocessing.get_context('fork')
+        results = context.Queue()
+        per_process = [
+            namespace.connections // namespace.clients + (i < namespace.connections % namespace.clients)
+            for i in range(namespace.clients)
+        ]
+        clients = [
+            context.Process(
+                target=run_client,
+                args=(addr, request, connections, namespace.warmup, namespace.duration, results))
+            for connections in per_process if connections
+        ]
+        for client in clients:
+            client.start()
+        latencies = []
+        errors = 0
+        for _ in clients:
+            client_latencies, client_errors = results.get()
+            latencies += client_latencies
+            errors += client_errors
+        for client in clients:
+            client.join()
+    finally:
+        # the workers too
+        os.killpg(proxy.pid, signal.SIGTERM)
+        proxy.wait()
+    latencies.sort()
+    return {
+        'rps': len(latencies) / namespace.duration,
+        'p50': percentile(latencies, 0.5),
+        'p90': percentile(latencies, 0.9),
+        'p99': percentile(latencies, 0.99),
+        'max': latencies[-1] if latencies else 0.0,
+        'errors': errors,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-p', '--port', type=int, default=55710, help='proxy port')
+    parser.add_argument('--engines', default='threads,asyncio', help='comma separated, asyncio:N for N workers')
+    parser.add_argument('--connections', type=int, default=64, help='concurrent keep-alive client connections')
+    parser.add_argument('--clients', type=int, default=2, help='client processes the connections are spread over')
+    parser.add_argument('--duration', type=float, default=10, help='seconds measured per engine')
+    parser.add_argument('--warmup', type=float, default=1, help='seconds before measuring')
+    parser.add_argument('--body-size', type=int, default=4096, help='bytes of the page served by the origin')
+    parser.add_argument('--origin-workers', type=int, default=2)
+    parser.add_argument('--proxy-args', default='', help='extra options for every proxy')
+    namespace = parser.parse_args(sys.argv[1:])
+
+    origin_sock = socket.create_server(('127.0.0.1', 0), backlog=1024)
+    origin_port = origin_sock.getsockname()[1]
+    context = multiprocessing.get_context('fork')
+    origins = [
+        context.Process(target=serve_origin, args=(origin_sock, make_response(namespace.body_size)), daemon=True)
+        for _ in range(namespace.origin_workers)
+    ]
+    for origin in origins:
+        origin.start()
+
+    print(
+        f'{namespace.connections} connections, {namespace.body_size} byte page, {namespace.duration:g} s per engine')
+    print(f'{"engine":12} {"req/s":>9} {"p50 ms":>8} {"p90 ms":>8} {"p99 ms":>8} {"max ms":>8} {"errors":>7}')
+    try:
+        for engine in namespace.engines.split(','):
+            result = run_case(engine, namespace, origin_port)
+            print(
+                f'{engine:12} {result["rps"]:9.0f} {result["p50"] * 1000:8.2f} {result["p90"] * 1000:8.2f}'
+                f' {result["p99"] * 1000:8.2f} {result["max"] * 1000:8.2f} {result["errors"]:7}', flush=True)
+    finally:
+        for origin in origins:
+            origin.terminate()
+
+
+if __name__ == '__main__':
+    main()
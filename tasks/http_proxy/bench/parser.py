@@ -0,0 +1,115 @@
+import sys
+import time
+import argparse
+
+import http_utils
+import streaming
+from http_parser import HTTPParser
+
+
+# Compares the incremental parser with the old whole-message path (http_utils.parse_*
+# over the body gathered with +=, then find and re-slice for the injection), run from
+# the proxy directory:
+#   python -m bench.parser [-n 2000]
+REQUEST = (
+    b'GET http://example.com/index.html HTTP/1.1\r\n'
+    b'Host: example.com\r\n'
+    b'User-Agent: bench/1.0\r\n'
+    b'Accept: text/html,application/xhtml+xml\r\n'
+    b'Accept-Encoding: gzip, deflate\r\n'
+    b'Cookie: session=0123456789abcdef; theme=dark\r\n\r\n'
+)
+
+
+def make_response(size):
+    body = b'<html><body>' + b'x' * (size - 26) + b'</body></html>'
+    head = b'HTTP/1.1 200 OK\r\nContent-Type: text/html\r\nContent-Length: %d\r\n\r\n' % len(body)
+    return head + body
+
+
+def make_chunked_response(size, chunk_size):
+    body = b'<html><body>' + b'x' * (size - 26) + b'</body></html>'
+    chunks = [body[i:i+chunk_size] for i in range(0, len(body), chunk_size)]
+    return b'HTTP/1.1 200 OK\r\nContent-Type: text/html\r\nTransfer-Encoding: chunked\r\n\r\n' + b''.join(
+        b'%x\r\n%s\r\n' % (len(chunk), chunk) for chunk in chunks) + b'0\r\n\r\n'
+
+
+def split(data, size):
+    return [data[i:i+size] for i in range(0, len(data), size)]
+
+
+def old_request(pieces):
+    return http_utils.parse_request(pieces[0])
+
+
+def old_response(pieces):
+    # what ProxyServer.get_message and get_modified_response did
+    response = http_utils.parse_response(pieces[0])
+    for piece in pieces[1:]:
+        response['body'] += piece
+    header_fields = '<br>'.join(f'{k}: {v}' for k, v in response['header_fields'].items())
+    i = response['body'].find(b'</body>')
+    response['body'] = response['body'][:i] + header_fields.encode() + response['body'][i:]
+    response['header_fields']['Content-Length'] = str(len(response['body']))
+    return http_utils.build_response(response)
+
+
+def new_messages(pieces, response=False):
+    parser = HTTPParser(response=response)
+    count = 0
+    for piece in pieces:
+        for kind, _ in parser.feed(piece):
+            count += kind == 'end'
+    return count
+
+
+def new_response(pieces):
+    parser = HTTPParser(response=True)
+    size = 0
+    for piece in pieces:
+        for kind, value in parser.feed(piece):
+            if kind == 'headers':
+                stream = streaming.ResponseStream({'protocol': 'HTTP/1.1', 'header_fields': value['header_fields']}, value)
+                size += len(stream.head)
+            elif kind == 'body':
+                size += sum(map(len, stream.body(value)))
+            else:
+                size += sum(map(len, stream.end()))
+    return size
+
+
+def measure(function, args, number):
+    start = time.perf_counter()
+    for _ in range(number):
+        function(*args)
+    return (time.perf_counter() - start) / number
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--number', type=int, default=2000)
+    parser.add_argument('--piece-size', type=int, default=64 * 1024, help='bytes per recv')
+    namespace = parser.parse_args(sys.argv[1:])
+    number, piece_size = namespace.number, namespace.piece_size
+
+    # name, old path or None when it can't handle the case, new path, recv'd pieces, iterations
+    cases = [
+        ('request', old_request, new_messages, [REQUEST], number),
+        ('16 pipelined requests', None, new_messages, [REQUEST * 16], number),
+    ]
+    for size in (64 * 1024, 1024 * 1024, 8 * 1024 * 1024):
+        pieces = split(make_response(size), piece_size)
+        cases.append((f'{size >> 10} KiB response', old_response, new_response, pieces, max(number * 8192 // size, 5)))
+    pieces = split(make_chunked_response(1024 * 1024, 4096), piece_size)
+    cases.append(('1 MiB response, 4K chunks', None, new_response, pieces, max(number // 128, 5)))
+
+    print(f'{"case":26} {"old us":>10} {"new us":>10} {"new MB/s":>10}')
+    for name, old, new, pieces, n in cases:
+        size = sum(map(len, pieces))
+        old_time = f'{measure(old, [pieces], n) * 1e6:10.1f}' if old is not None else f'{"-":>10}'
+        new_time = measure(new, [pieces], n)
+        print(f'{name:26} {old_time} {new_time * 1e6:10.1f} {size / new_time / 1e6:10.1f}')
+
+
+if __name__ == '__main__':
+    main()
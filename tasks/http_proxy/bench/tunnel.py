@@ -0,0 +1,147 @@
+import os
+import sys
+import time
+import socket
+import argparse
+import threading
+import subprocess
+
+
+# Throughput of CONNECT tunnels and the proxy's CPU time for it, for each engine with
+# os.splice and with the buffer fallback. Data goes through the tunnel to a local
+# echo server and back, run from the proxy directory:
+#   python -m bench.tunnel [--megabytes 512] [--streams 4]
+CHUNK = 256 * 1024
+
+
+def serve_echo(sock):
+    while True:
+        conn, _ = sock.accept()
+        threading.Thread(target=echo, args=(conn,), daemon=True).start()
+
+
+def echo(conn):
+    buffer = memoryview(bytearray(CHUNK))
+    with conn:
+        while True:
+            n = conn.recv_into(buffer)
+            if not n:
+                conn.shutdown(socket.SHUT_WR)
+                return
+            conn.sendall(buffer[:n])
+
+
+def open_tunnel(proxy_addr, target_port):
+    sock = socket.create_connection(proxy_addr)
+    sock.sendall(b'CONNECT 127.0.0.1:%d HTTP/1.1\r\nHost: 127.0.0.1:%d\r\n\r\n' % (target_port, target_port))
+    response = b''
+    while not response.endswith(b'\r\n\r\n'):
+        data = sock.recv(1)
+        if not data:
+            raise RuntimeError('proxy closed the connection')
+        response += data
+    if not response.startswith(b'HTTP/1.1 200'):
+        raise RuntimeError(response.decode(errors='replace'))
+    return sock
+
+
+def run_stream(proxy_addr, target_port, size, received):
+    sock = open_tunnel(proxy_addr, target_port)
+    data = memoryview(os.urandom(CHUNK))
+
+    def send():
+        left = size
+        while left > 0:
+            n = min(left, CHUNK)
+            sock.sendall(data[:n])
+            left -= n
+        sock.shutdown(socket.SHUT_WR)
+
+    sender = threading.Thread(target=send)
+    sender.start()
+    buffer = memoryview(bytearray(CHUNK))
+    total = 0
+    while True:
+        n = sock.recv_into(buffer)
+        if not n:
+            break
+        total += n
+    sender.join()
+    sock.close()
+    received.append(total)
+
+
+def read_cpu(pid):
+    # user and system time of a process, seconds
+    with open(f'/proc/{pid}/stat') as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def wait_for_port(addr, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(addr).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError('proxy did not come up')
+
+
+def run_case(engine, splice, namespace, echo_port):
+    proxy = subprocess.Popen([
+        sys.executable, 'cli.py', '-p', str(namespace.port), '--engine', engine,
+        '--connect-ports', str(echo_port), *([] if splice else ['--no-splice'])
+    ], stdout=subprocess.DEVNULL)
+    try:
+        addr = ('localhost', namespace.port)
+        wait_for_port(addr)
+        cpu = read_cpu(proxy.pid)
+        size = namespace.megabytes * 2**20 // namespace.streams
+        received = []
+        start = time.perf_counter()
+        streams = [
+            threading.Thread(target=run_stream, args=(addr, echo_port, size, received))
+            for _ in range(namespace.streams)
+        ]
+        for stream in streams:
+            stream.start()
+        for stream in streams:
+            stream.join()
+        seconds = time.perf_counter() - start
+        cpu = read_cpu(proxy.pid) - cpu
+    finally:
+        proxy.terminate()
+        proxy.wait()
+    # every byte crosses the proxy twice, there and back
+    moved = 2 * sum(received)
+    if sum(received) != size * namespace.streams:
+        print(f'lost data: {sum(received)} of {size * namespace.streams} bytes came back')
+    return moved / seconds / 1e6, cpu, cpu / (moved / 1e9)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-p', '--port', type=int, default=55700, help='proxy port')
+    parser.add_argument('--megabytes', type=int, default=512, help='sent through all the tunnels together')
+    parser.add_argument('--streams', type=int, default=4)
+    parser.add_argument('--engines', default='asyncio,threads')
+    namespace = parser.parse_args(sys.argv[1:])
+
+    echo_sock = socket.create_server(('127.0.0.1', 0))
+    echo_port = echo_sock.getsockname()[1]
+    threading.Thread(target=serve_echo, args=(echo_sock,), daemon=True).start()
+
+    print(f'{"engine":10} {"relay":8} {"MB/s":>9} {"proxy CPU s":>12} {"CPU s/GB":>9}')
+    for engine in namespace.engines.split(','):
+        for splice in (True, False):
+            if splice and not hasattr(os, 'splice'):
+                continue
+            throughput, cpu, cpu_per_gb = run_case(engine, splice, namespace, echo_port)
+            relay = 'splice' if splice else 'buffer'
+            print(f'{engine:10} {relay:8} {throughput:9.1f} {cpu:12.2f} {cpu_per_gb:9.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,84 @@
 #!/usr/bin/env python3
 
+import argparse
+
+import tunnel
 from proxy_server import ProxyServer
+from async_proxy_server import AsyncProxyServer
 
 def main():
-    proxy_server = ProxyServer('localhost', 8080)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('-p', '--port', type=int, default=8080)
+    parser.add_argument(
+        '--engine', choices=['asyncio', 'threads'], default='asyncio',
+        help='asyncio serves every connection from one event loop per process, '
+             'threads gives each connection a thread from a pool of 20'
+    )
+    parser.add_argument('--workers', type=int, default=1, help='accepting processes, asyncio engine only')
+    parser.add_argument('--pool-max-idle', type=int, default=8, help='idle upstream connections kept per host')
+    parser.add_argument('--pool-idle-timeout', type=float, default=30)
+    parser.add_argument('--dns-ttl', type=float, default=60, help='seconds a resolved upstream host is cached')
+    parser.add_argument('--cache-size', type=float, default=0, help='response cache in memory, MiB, 0 turns it off')
+    parser.add_argument('--cache-max-entry', type=float, default=8, help='largest response cached, MiB')
+    parser.add_argument('--cache-dir', help='directory for responses that no longer fit in memory')
+    parser.add_argument('--cache-disk-size', type=float, default=1024, help='MiB')
+    parser.add_argument(
+        '--cache-injected', action='store_true',
+        help='cache bodies with the header fields already injected instead of injecting on every hit'
+    )
+    parser.add_argument(
+        '--compress', action='store_true',
+        help='gzip (or br) uncompressed text responses for clients that accept it'
+    )
+    parser.add_argument(
+        '--compression-level', type=int, default=6,
+        help='for --compress and for compressed pages re-encoded after the injection, 1-9 (br up to 11)'
+    )
+    parser.add_argument(
+        '--connect-ports', default='443',
+        help='comma separated ports CONNECT tunnels may go to, * for any'
+    )
+    parser.add_argument(
+        '--no-splice', action='store_true',
+        help='relay tunnels through a buffer instead of os.splice'
+    )
+    parser.add_argument('--tunnel-idle-timeout', type=float, default=300)
+    parser.add_argument(
+        '--access-log',
+        help='file for a JSON line per request, - for stdout; with several workers each writes <name>.<worker><ext>'
+    )
+    parser.add_argument('--access-log-max-bytes', type=float, default=64, help='MiB before the log is rotated')
+    parser.add_argument(
+        '--stats-port', type=int,
+        help='serve the metrics as JSON over HTTP on this port, worker n on port + n'
+    )
+    parser.add_argument('--stats-interval', type=float, help='write the metrics to stderr every this many seconds')
+    args = parser.parse_args()
+    options = dict(
+        pool_max_idle=args.pool_max_idle,
+        pool_idle_timeout=args.pool_idle_timeout,
+        dns_ttl=args.dns_ttl,
+        cache_size=int(args.cache_size * 2**20),
+        cache_max_entry=int(args.cache_max_entry * 2**20),
+        cache_dir=args.cache_dir,
+        cache_disk_size=int(args.cache_disk_size * 2**20),
+        cache_injected=args.cache_injected,
+        compress=args.compress,
+        compression_level=args.compression_level,
+        connect_ports=None if args.connect_ports == '*' else {int(port) for port in args.connect_ports.split(',')},
+        splice=tunnel.SPLICE and not args.no_splice,
+        tunnel_idle_timeout=args.tunnel_idle_timeout,
+        access_log=args.access_log,
+        access_log_max_bytes=int(args.access_log_max_bytes * 2**20),
+        stats_port=args.stats_port,
+        stats_interval=args.stats_interval
+    )
+    if args.engine == 'asyncio':
+        proxy_server = AsyncProxyServer(args.host, args.port, args.workers, **options)
+    else:
+        proxy_server = ProxyServer(args.host, args.port, **options)
     proxy_server.start()
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
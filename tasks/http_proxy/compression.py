@@ -0,0 +1,105 @@
+import zlib
+
+from http_parser import ParseError
+
+try:
+    import brotli
+    DECODE_ERRORS = (zlib.error, brotli.error)
+except ImportError:
+    brotli = None
+    DECODE_ERRORS = (zlib.error,)
+
+# brotli 1.2+ can stop decompressing at an output size
+BROTLI_OUTPUT_LIMIT = brotli is not None and hasattr(brotli.Decompressor, 'can_accept_more_data')
+
+
+# content codings bodies can be decoded from and encoded to, br needs the brotli package
+ENCODINGS = ('gzip', 'deflate', 'br') if brotli is not None else ('gzip', 'deflate')
+# decoded data comes out in pieces of at most about this size, br stops at the buffer
+# block past it and before brotli 1.2 not at all
+MAX_PIECE = 64 * 1024
+
+
+def choose_encoding(headers):
+    # the first of ENCODINGS the request's Accept-Encoding allows, gzip is
+    # preferred to br as it's much cheaper to compress at similar levels
+    accepted = {}
+    for value in headers.get_all('Accept-Encoding'):
+        for part in value.split(','):
+            coding, _, params = part.partition(';')
+            weight = 1.0
+            name, _, q = params.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    weight = float(q)
+                except ValueError:
+                    weight = 0.0
+            accepted[coding.strip().lower()] = weight
+    for coding in ENCODINGS:
+        if accepted.get(coding, accepted.get('*', 0)) > 0:
+            return coding
+    return None
+
+
+class Decoder:
+    # incremental decompression of a body in one of ENCODINGS
+    def __init__(self, encoding):
+        self.encoding = encoding
+        self.started = False
+        if encoding == 'br':
+            self.obj = brotli.Decompressor()
+        elif encoding == 'gzip':
+            self.obj = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            self.obj = zlib.decompressobj()
+
+    def decompress(self, data):
+        # yields the decoded data piece by piece, a small compressed piece may
+        # expand a lot and only one piece of it is held at a time
+        try:
+            if self.encoding == 'br':
+                if not BROTLI_OUTPUT_LIMIT:
+                    yield self.obj.process(bytes(data))
+                    return
+                yield self.obj.process(bytes(data), output_buffer_limit=MAX_PIECE)
+                while not self.obj.can_accept_more_data():
+                    yield self.obj.process(b'', output_buffer_limit=MAX_PIECE)
+                return
+            if self.encoding == 'deflate' and not self.started:
+                # deflate is meant to be zlib wrapped, some servers send it raw
+                self.started = True
+                header = bytes(data[:2])
+                if len(header) == 2 and (header[0] & 0x0f != 8 or (header[0] << 8 | header[1]) % 31):
+                    self.obj = zlib.decompressobj(-zlib.MAX_WBITS)
+            while data:
+                yield self.obj.decompress(data, MAX_PIECE)
+                data = self.obj.unconsumed_tail
+        except DECODE_ERRORS:
+            raise ParseError('bad compressed body') from None
+
+    def flush(self):
+        if self.encoding == 'br':
+            return b''
+        return self.obj.flush()
+
+
+class Encoder:
+    # incremental compression, level 1-9 (up to 11 for br)
+    def __init__(self, encoding, level):
+        self.encoding = encoding
+        if encoding == 'br':
+            self.obj = brotli.Compressor(quality=level)
+        elif encoding == 'gzip':
+            self.obj = zlib.compressobj(min(level, 9), zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        else:
+            self.obj = zlib.compressobj(min(level, 9))
+
+    def compress(self, data):
+        if self.encoding == 'br':
+            return self.obj.process(bytes(data))
+        return self.obj.compress(data)
+
+    def flush(self):
+        if self.encoding == 'br':
+            return self.obj.finish()
+        return self.obj.flush()
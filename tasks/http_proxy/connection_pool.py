@@ -0,0 +1,121 @@
+import time
+import socket
+import threading
+from collections import OrderedDict, deque
+
+
+class HostCache:
+    # gethostbyname results kept for ttl seconds, at most max_entries hosts
+    def __init__(self, ttl=60, max_entries=1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # host -> (address, deadline), least recently used first
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, host):
+        with self.lock:
+            entry = self.entries.get(host)
+            if entry is None:
+                return None
+            if entry[1] <= time.monotonic():
+                del self.entries[host]
+                return None
+            self.entries.move_to_end(host)
+            return entry[0]
+
+    def resolve(self, host):
+        address = self.get(host)
+        if address is not None:
+            return address
+        address = socket.gethostbyname(host)
+        with self.lock:
+            self.entries[host] = (address, time.monotonic() + self.ttl)
+            self.entries.move_to_end(host)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return address
+
+
+class ConnectionPool:
+    # Idle keep-alive connections per (address, port), newest reused first.
+    # Connections idle for longer than idle_timeout or failing the health check
+    # are closed instead of being handed out, past max_idle per host they're closed on release.
+    PRUNE_INTERVAL = 10
+
+    def __init__(self, max_idle=8, idle_timeout=30):
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        # addr -> deque of (connection, idle since)
+        self.idle = {}
+        self.lock = threading.Lock()
+        self.last_prune = time.monotonic()
+        self.reused = 0
+        self.opened = 0
+
+    def get(self, addr):
+        # an idle healthy connection to addr or None
+        now = time.monotonic()
+        while True:
+            with self.lock:
+                connections = self.idle.get(addr)
+                if not connections:
+                    self.opened += 1
+                    return None
+                connection, idle_since = connections.pop()
+            if now - idle_since < self.idle_timeout and self.is_healthy(connection):
+                with self.lock:
+                    self.reused += 1
+                return connection
+            self.close(connection)
+
+    def put(self, addr, connection):
+        now = time.monotonic()
+        expired = []
+        with self.lock:
+            connections = self.idle.setdefault(addr, deque())
+            connections.append((connection, now))
+            if len(connections) > self.max_idle:
+                expired.append(connections.popleft()[0])
+            if now - self.last_prune >= self.PRUNE_INTERVAL:
+                self.last_prune = now
+                expired.extend(self.take_expired(now))
+        for connection in expired:
+            self.close(connection)
+
+    def take_expired(self, now):
+        expired = []
+        for addr, connections in list(self.idle.items()):
+            while connections and now - connections[0][1] >= self.idle_timeout:
+                expired.append(connections.popleft()[0])
+            if not connections:
+                del self.idle[addr]
+        return expired
+
+    def is_healthy(self, sock):
+        # an idle connection should have nothing to read: EOF means the server
+        # closed it, data means the previous response wasn't read to the end
+        timeout = sock.gettimeout()
+        sock.settimeout(0)
+        try:
+            sock.recv(1, socket.MSG_PEEK)
+            return False
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+        finally:
+            sock.settimeout(timeout)
+
+    def close(self, sock):
+        sock.close()
+
+
+class AsyncConnectionPool(ConnectionPool):
+    # the same for (reader, writer) pairs of asyncio streams
+    def is_healthy(self, connection):
+        reader, writer = connection
+        return not writer.is_closing() and not reader.at_eof()
+
+    def close(self, connection):
+        connection[1].close()
@@ -0,0 +1,259 @@
+from collections import deque
+
+
+class ParseError(Exception):
+    pass
+
+
+class Headers:
+    # Header fields in the order received, duplicates included, with
+    # case-insensitive lookup. Indexing gives the first value of a field.
+    __slots__ = ('fields', 'index')
+
+    def __init__(self, fields=()):
+        self.fields = []
+        # lowercased name -> values
+        self.index = {}
+        for name, value in fields:
+            self.add(name, value)
+
+    def add(self, name, value):
+        self.fields.append((name, value))
+        self.index.setdefault(name.lower(), []).append(value)
+
+    def get(self, name, default=None):
+        values = self.index.get(name.lower())
+        return values[0] if values else default
+
+    def get_all(self, name):
+        return self.index.get(name.lower(), [])
+
+    def has_token(self, name, token):
+        # for comma separated fields like Connection and Transfer-Encoding
+        return any(
+            part.strip().lower() == token
+            for value in self.get_all(name) for part in value.split(',')
+        )
+
+    def remove(self, name):
+        key = name.lower()
+        if self.index.pop(key, None) is not None:
+            self.fields = [field for field in self.fields if field[0].lower() != key]
+
+    def items(self):
+        return list(self.fields)
+
+    def copy(self):
+        return Headers(self.fields)
+
+    def __getitem__(self, name):
+        return self.index[name.lower()][0]
+
+    def __setitem__(self, name, value):
+        self.remove(name)
+        self.add(name, value)
+
+    def __contains__(self, name):
+        return name.lower() in self.index
+
+    def __len__(self):
+        return len(self.fields)
+
+    def __repr__(self):
+        return repr(dict(self.fields))
+
+
+class HTTPParser:
+    # Resumable HTTP/1.1 parser: feed() takes whatever arrived and returns events
+    #   ('headers', message)  message is a dict like http_utils.parse_request/parse_response
+    #                         give, with Headers in 'header_fields', 'framing' instead of 'body'
+    #   ('body', memoryview)  a piece of the body, chunked encoding already removed
+    #   ('end', None)         the message is complete, the next one may follow
+    #   ('data', memoryview)  bytes after a CONNECT request, which aren't HTTP any more
+    # Only the head and chunk size lines are buffered, body pieces are views into
+    # the fed data, so they stay valid only as long as the caller keeps that data.
+    HEAD, BODY, CHUNK_SIZE, CHUNK_DATA, CHUNK_END, TRAILERS, BODY_UNTIL_EOF, TUNNEL = range(8)
+    MAX_HEAD_SIZE = 64 * 1024
+    MAX_LINE_SIZE = 8 * 1024
+
+    def __init__(self, response=False):
+        self.response = response
+        self.state = self.HEAD
+        self.buffer = bytearray()
+        self.remaining = 0
+        # methods of the requests whose responses are still to come, a response
+        # to HEAD has no body whatever its headers say
+        self.methods = deque()
+
+    def expect(self, method):
+        self.methods.append(method)
+
+    def feed(self, data):
+        events = []
+        view = memoryview(data)
+        pos = 0
+        while pos < len(data):
+            if self.state == self.HEAD:
+                pos = self.feed_head(data, pos, events)
+            elif self.state == self.TUNNEL:
+                events.append(('data', view[pos:]))
+                pos = len(data)
+            elif self.state in (self.BODY, self.CHUNK_DATA, self.BODY_UNTIL_EOF):
+                pos = self.feed_body(view, pos, events)
+            else:
+                pos = self.feed_line(data, pos, events)
+        return events
+
+    def feed_eof(self):
+        if self.state == self.BODY_UNTIL_EOF:
+            self.state = self.HEAD
+            return [('end', None)]
+        if self.state in (self.HEAD, self.TUNNEL) and not self.buffer:
+            return []
+        raise ParseError('connection closed in the middle of a message')
+
+    def is_idle(self):
+        # between messages with nothing buffered
+        return self.state == self.HEAD and not self.buffer
+
+    def take_until(self, data, pos, terminator, limit):
+        # (bytes up to the terminator, position after it) or (None, len(data)) after
+        # buffering the rest when the terminator hasn't arrived yet
+        if not self.buffer:
+            end = data.find(terminator, pos)
+            if end != -1:
+                return bytes(data[pos:end]), end + len(terminator)
+            self.buffer += data[pos:]
+        else:
+            start = max(len(self.buffer) - len(terminator) + 1, 0)
+            buffered = len(self.buffer)
+            self.buffer += data[pos:]
+            end = self.buffer.find(terminator, start)
+            if end != -1:
+                taken = bytes(self.buffer[:end])
+                # only what belongs to this line is consumed from data
+                pos += end + len(terminator) - buffered
+                self.buffer.clear()
+                return taken, pos
+        if len(self.buffer) > limit:
+            raise ParseError('line or head too long')
+        return None, len(data)
+
+    def feed_head(self, data, pos, events):
+        # empty lines between messages are allowed
+        while not self.buffer and data[pos:pos+2] == b'\r\n':
+            pos += 2
+        if pos >= len(data):
+            return pos
+        head, pos = self.take_until(data, pos, b'\r\n\r\n', self.MAX_HEAD_SIZE)
+        if head is None:
+            return pos
+        message = self.parse_head(head)
+        message['head_size'] = len(head) + 4
+        events.append(('headers', message))
+        framing = message['framing']
+        if message.get('method') == 'CONNECT':
+            events.append(('end', None))
+            self.state = self.TUNNEL
+        elif framing == 'none' or framing == 'length' and self.remaining == 0:
+            events.append(('end', None))
+        elif framing == 'length':
+            self.state = self.BODY
+        elif framing == 'chunked':
+            self.state = self.CHUNK_SIZE
+        else:
+            self.state = self.BODY_UNTIL_EOF
+        return pos
+
+    def feed_body(self, view, pos, events):
+        if self.state == self.BODY_UNTIL_EOF:
+            events.append(('body', view[pos:]))
+            return len(view)
+        size = min(self.remaining, len(view) - pos)
+        events.append(('body', view[pos:pos+size]))
+        self.remaining -= size
+        if self.remaining == 0:
+            if self.state == self.BODY:
+                self.state = self.HEAD
+                events.append(('end', None))
+            else:
+                self.state = self.CHUNK_END
+        return pos + size
+
+    def feed_line(self, data, pos, events):
+        line, pos = self.take_until(data, pos, b'\r\n', self.MAX_LINE_SIZE)
+        if line is None:
+            return pos
+        if self.state == self.CHUNK_SIZE:
+            try:
+                size = int(line.split(b';', 1)[0].strip(), 16)
+            except ValueError:
+                raise ParseError('bad chunk size') from None
+            if size == 0:
+                self.state = self.TRAILERS
+            else:
+                self.remaining = size
+                self.state = self.CHUNK_DATA
+        elif self.state == self.CHUNK_END:
+            if line:
+                raise ParseError('chunk data is longer than its size')
+            self.state = self.CHUNK_SIZE
+        elif not line:
+            # an empty line ends the trailer section, trailer fields themselves are dropped
+            self.state = self.HEAD
+            events.append(('end', None))
+        return pos
+
+    def parse_head(self, head):
+        # latin-1 maps every byte to a character, so any header bytes come through
+        start_line, *lines = head.decode('latin-1').split('\r\n')
+        try:
+            headers = Headers()
+            for line in lines:
+                name, colon, value = line.partition(':')
+                if not colon or not name or name[-1] in ' \t':
+                    raise ParseError('bad header field')
+                headers.add(name, value.strip())
+            if self.response:
+                protocol, status_code, *description = start_line.split(' ', 2)
+                message = {
+                    'protocol': protocol,
+                    'status_code': status_code,
+                    'status_code_desc': description[0] if description else '',
+                    'header_fields': headers,
+                }
+            else:
+                method, url, protocol = start_line.split()
+                message = {
+                    'method': method,
+                    'url': url,
+                    'protocol': protocol,
+                    'header_fields': headers,
+                }
+        except ValueError:
+            raise ParseError('bad start line') from None
+        message['framing'] = self.get_framing(message)
+        return message
+
+    def get_framing(self, message):
+        # how the body is delimited (RFC 7230 3.3.3): 'none', 'length', 'chunked'
+        # or, for responses only, 'eof'
+        headers = message['header_fields']
+        if self.response:
+            method = self.methods.popleft() if self.methods else None
+            status = message['status_code']
+            if method == 'HEAD' or status.startswith('1') or status in ('204', '304'):
+                return 'none'
+        if 'Transfer-Encoding' in headers:
+            if headers.has_token('Transfer-Encoding', 'chunked'):
+                return 'chunked'
+            if self.response:
+                return 'eof'
+            raise ParseError('request body length is unknown')
+        if 'Content-Length' in headers:
+            lengths = set(headers.get_all('Content-Length'))
+            if len(lengths) != 1 or not next(iter(lengths)).isdigit():
+                raise ParseError('bad Content-Length')
+            self.remaining = int(next(iter(lengths)))
+            return 'length'
+        return 'eof' if self.response else 'none'
@@ -74,3 +74,24 @@ def build_message(message, status_line):
 
 def build_header_fields(header_fields):
     return '\r\n'.join(f'{k}: {v}'for k, v in header_fields.items())
+
+
+def build_head(message):
+    # start line and header fields of a message from http_parser, the body goes separately
+    if 'method' in message:
+        start_line = f"{message['method']} {message['url']} {message['protocol']}"
+    else:
+        start_line = f"{message['protocol']} {message['status_code']} {message['status_code_desc']}"
+    lines = [start_line, *(f'{k}: {v}' for k, v in message['header_fields'].items()), '', '']
+    return '\r\n'.join(lines).encode('latin-1')
+
+
+def keeps_alive(message):
+    # whether the connection can carry another message after this one: its end
+    # has to be known without a close and neither side asked to close
+    if message.get('framing') == 'eof':
+        return False
+    headers = message['header_fields']
+    if message['protocol'] == 'HTTP/1.0':
+        return headers.has_token('Connection', 'keep-alive')
+    return not headers.has_token('Connection', 'close')
@@ -0,0 +1,179 @@
+import sys
+import json
+import math
+import time
+import threading
+import http.server
+
+
+class Histogram:
+    # durations in log spaced buckets, four per doubling from a microsecond up,
+    # so observing is a few float operations and percentiles are within 12%
+    SUBBUCKETS = 4
+    BUCKETS = 40 * SUBBUCKETS
+
+    __slots__ = ('counts', 'count', 'total')
+
+    def __init__(self):
+        self.counts = [0] * self.BUCKETS
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, seconds):
+        self.count += 1
+        self.total += seconds
+        mantissa, exponent = math.frexp(seconds * 1e6)
+        index = exponent * self.SUBBUCKETS + int((mantissa - 0.5) * 2 * self.SUBBUCKETS)
+        self.counts[min(max(index, 0), self.BUCKETS - 1)] += 1
+
+    def upper_bound(self, index):
+        exponent, subbucket = divmod(index, self.SUBBUCKETS)
+        return math.ldexp(0.5 + (subbucket + 1) / (2 * self.SUBBUCKETS), exponent) / 1e6
+
+    def percentile(self, share):
+        target = share * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= target:
+                return self.upper_bound(index)
+        return 0.0
+
+    def to_dict(self):
+        # milliseconds
+        if not self.count:
+            return {'count': 0}
+        return {
+            'count': self.count,
+            'mean': round(self.total / self.count * 1000, 3),
+            'p50': round(self.percentile(0.5) * 1000, 3),
+            'p90': round(self.percentile(0.9) * 1000, 3),
+            'p99': round(self.percentile(0.99) * 1000, 3),
+            'p999': round(self.percentile(0.999) * 1000, 3),
+        }
+
+
+class ProxyMetrics:
+    # Counters and histograms of one process, updated from the serving threads
+    # or the event loop once per connection and once per finished request.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.connections_total = 0
+        self.tunnels = 0
+        self.requests = 0
+        # '2xx' -> count, 'error' for requests that got no response
+        self.statuses = {}
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.injected = 0
+        # response cache outcomes
+        self.cache = {'hit': 0, 'miss': 0, 'revalidated': 0}
+        self.duration = Histogram()
+        self.ttfb = Histogram()
+        self.upstream_connect = Histogram()
+
+    def connection_opened(self):
+        with self.lock:
+            self.connections += 1
+            self.connections_total += 1
+
+    def connection_closed(self):
+        with self.lock:
+            self.connections -= 1
+
+    def tunnel_opened(self):
+        with self.lock:
+            self.tunnels += 1
+
+    def tunnel_closed(self):
+        with self.lock:
+            self.tunnels -= 1
+
+    def request_done(self, record):
+        status = f"{record['status'] // 100}xx" if record['status'] else 'error'
+        with self.lock:
+            self.requests += 1
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+            self.bytes_in += record['bytes_in']
+            self.bytes_out += record['bytes_out']
+            self.injected += record['injected']
+            if record['cache'] is not None:
+                self.cache[record['cache']] += 1
+            self.duration.observe(record['duration'])
+            if record['ttfb'] is not None:
+                self.ttfb.observe(record['ttfb'])
+            if record['connect'] is not None:
+                self.upstream_connect.observe(record['connect'])
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                'connections': self.connections,
+                'connections_total': self.connections_total,
+                'tunnels': self.tunnels,
+                'requests': self.requests,
+                'statuses': dict(self.statuses),
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out,
+                'injected': self.injected,
+                'cache': dict(self.cache),
+                'duration_ms': self.duration.to_dict(),
+                'ttfb_ms': self.ttfb.to_dict(),
+                'upstream_connect_ms': self.upstream_connect.to_dict(),
+            }
+
+
+class StatsReporter:
+    # serves collect() as JSON over HTTP (GET /) and/or writes it to stderr as
+    # a JSON line every interval seconds, both from daemon threads. rps is since
+    # the consumer's previous snapshot, so polling over HTTP doesn't shorten the
+    # window of the stderr lines
+    def __init__(self, collect):
+        self.collect = collect
+        # consumer -> (time, requests) of its previous snapshot
+        self.last = {}
+        self.lock = threading.Lock()
+
+    def snapshot(self, consumer):
+        stats = self.collect()
+        now = time.monotonic()
+        with self.lock:
+            last = self.last.get(consumer)
+            if last is not None and now > last[0]:
+                stats['rps'] = round((stats['requests'] - last[1]) / (now - last[0]), 1)
+            self.last[consumer] = (now, stats['requests'])
+        return stats
+
+    def dump(self, interval):
+        while True:
+            time.sleep(interval)
+            print(json.dumps(self.snapshot('dump')), file=sys.stderr, flush=True)
+
+    def start(self, host, port=None, interval=None):
+        if port is not None:
+            server = http.server.ThreadingHTTPServer((host, port), self.make_handler())
+            server.daemon_threads = True
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+        if interval is not None:
+            threading.Thread(target=self.dump, args=(interval,), daemon=True).start()
+
+    def make_handler(self):
+        reporter = self
+
+        class StatsHandler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/':
+                    self.send_error(404)
+                    return
+                body = json.dumps(reporter.snapshot('http'), indent=2).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return StatsHandler
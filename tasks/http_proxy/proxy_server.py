@@ -1,12 +1,50 @@
+import os
+import time
 import socket
 import concurrent.futures
+from collections import deque
 
 import http_utils
+import streaming
+from http_parser import HTTPParser, ParseError
+from connection_pool import ConnectionPool, HostCache
+from response_cache import ResponseCache
+from tunnel import Tunnel, SPLICE
+from metrics import ProxyMetrics, StatsReporter
+from access_log import AccessLog
 
 class ProxyServer:
-    def __init__(self, host, port):
+    BUFF_SIZE = 64 * 1024
+    ESTABLISHED = b'HTTP/1.1 200 Connection Established\r\n\r\n'
+    FORBIDDEN = b'HTTP/1.1 403 Forbidden\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'
+    BAD_GATEWAY = b'HTTP/1.1 502 Bad Gateway\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'
+
+    def __init__(
+        self, host, port, pool_max_idle=8, pool_idle_timeout=30, dns_ttl=60, cache_size=0,
+        cache_max_entry=8 * 2**20, cache_dir=None, cache_disk_size=1024 * 2**20, cache_injected=False,
+        compress=False, compression_level=6, connect_ports=(443,), splice=SPLICE, tunnel_idle_timeout=300,
+        access_log=None, access_log_max_bytes=64 * 2**20, stats_port=None, stats_interval=None
+    ):
         self.host = host
         self.port = port
+        self.pool = self.make_pool(pool_max_idle, pool_idle_timeout)
+        self.host_cache = HostCache(dns_ttl)
+        self.compress = compress
+        self.compression_level = compression_level
+        # ports CONNECT may reach, None for any
+        self.connect_ports = connect_ports
+        self.splice = splice
+        self.tunnel_idle_timeout = tunnel_idle_timeout
+        self.cache = None
+        if cache_size:
+            self.cache = ResponseCache(cache_size, cache_max_entry, cache_dir, cache_disk_size, cache_injected)
+        self.metrics = ProxyMetrics()
+        # access log path, '-' for stdout
+        self.access_log_path = access_log
+        self.access_log_max_bytes = access_log_max_bytes
+        self.access_log = None
+        self.stats_port = stats_port
+        self.stats_interval = stats_interval
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
@@ -14,63 +52,303 @@ class ProxyServer:
         self.sock.bind((self.host, self.port))
         self.sock.listen()
         print('Listening on 80 port...')
-        self.listen()
-    
+        self.start_reporting()
+        try:
+            self.listen()
+        finally:
+            self.stop_reporting()
+
+    def start_reporting(self, worker=None):
+        # in the serving process, its threads wouldn't survive a fork; every worker
+        # gets its own log file and stats port after the first one
+        if self.access_log_path is not None:
+            path = self.access_log_path
+            if worker is not None and path != '-':
+                root, ext = os.path.splitext(path)
+                path = f'{root}.{worker}{ext}'
+            self.access_log = AccessLog(path, self.access_log_max_bytes)
+            self.access_log.start()
+        if self.stats_port is not None or self.stats_interval is not None:
+            port = None if self.stats_port is None else self.stats_port + (worker or 0)
+            StatsReporter(self.get_stats).start(self.host, port, self.stats_interval)
+
+    def stop_reporting(self):
+        if self.access_log is not None:
+            self.access_log.close()
+
+    def get_stats(self):
+        stats = self.metrics.to_dict()
+        stats['pool'] = {'reused': self.pool.reused, 'opened': self.pool.opened}
+        if self.cache is not None:
+            stats['cache']['memory_bytes'] = self.cache.memory_bytes
+            stats['cache']['disk_bytes'] = self.cache.disk_bytes
+            stats['cache']['write_errors'] = self.cache.write_errors
+        if self.access_log is not None:
+            stats['access_log'] = {
+                'written': self.access_log.written,
+                'dropped': self.access_log.dropped,
+                'pending': self.access_log.pending + len(self.access_log.batch),
+            }
+        return stats
+
+    def start_record(self, address, request):
+        # what the metrics and the access log get about a request, filled in as it's served
+        return {
+            'time': time.time(),
+            'start': time.monotonic(),
+            'client': address[0] if address else None,
+            'method': request['method'],
+            'url': request['url'],
+            'status': None,
+            'bytes_in': request['head_size'],
+            'bytes_out': 0,
+            'duration': None,
+            'ttfb': None,
+            'connect': None,
+            'reused': None,
+            'cache': None,
+            'injected': False,
+        }
+
+    def finish_record(self, record):
+        record['duration'] = time.monotonic() - record['start']
+        self.metrics.request_done(record)
+        if self.access_log is not None:
+            self.access_log.log(record)
+
     def listen(self):
         with concurrent.futures.ThreadPoolExecutor(20) as executor:
             while True:
                 client_sock, address = self.sock.accept()
                 client_sock.settimeout(10)
+                self.set_nodelay(client_sock)
                 executor.submit(self.handle, client_sock, address)
 
     def handle(self, client_sock, address):
-        while True:
-            request = self.get_message(client_sock, http_utils.parse_request)
-            if request is None:
-                break
-            print(request)
+        # pipelined requests stay in the parser and events until their turn
+        parser = HTTPParser()
+        events = deque()
+        self.metrics.connection_opened()
+        try:
+            while True:
+                event = self.read_event(client_sock, parser, events)
+                if event is None:
+                    break
+                request = event[1]
+                record = self.start_record(address, request)
+                try:
+                    if request['method'] == 'CONNECT':
+                        self.open_tunnel(client_sock, request, events, record)
+                        break
+                    if not self.relay(client_sock, parser, events, request, record):
+                        break
+                finally:
+                    self.finish_record(record)
+        except (OSError, ParseError):
+            pass
+        finally:
+            self.metrics.connection_closed()
+            client_sock.close()
 
-            response = self.send_request(
-                request['header_fields']['Host'],
-                http_utils.build_request(request)
-            )
-            if response is None:
-                break
-            print(response)
+    def read_event(self, sock, parser, events):
+        # the next parser event, None once the peer has closed between messages
+        while not events:
+            data = sock.recv(self.BUFF_SIZE)
+            events.extend(parser.feed(data) if data else parser.feed_eof())
+            if not data and not events:
+                return None
+        return events.popleft()
 
-            modified_response = self.get_modified_response(response)
-            client_sock.send(
-                http_utils.build_response(modified_response)
-            )
+    def send(self, sock, buffers):
+        # gathers the pieces into as few sends as the kernel takes, returns the bytes sent
+        buffers = [buffer for buffer in buffers if len(buffer)]
+        total = sum(map(len, buffers))
+        while buffers:
+            sent = sock.sendmsg(buffers)
+            while buffers and sent >= len(buffers[0]):
+                sent -= len(buffers.pop(0))
+            if sent:
+                buffers[0] = memoryview(buffers[0])[sent:]
+        return total
 
-    def get_message(self, sock, parse):
-        BUFF_SIZE = 8192
-        try:
-            data = sock.recv(BUFF_SIZE)
-        except sock.timeout:
+    @staticmethod
+    def set_nodelay(sock):
+        # writes are gathered already, Nagle would only hold the next one back
+        # until the peer's delayed ACK, e.g. a body sent after its head
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def make_pool(self, max_idle, idle_timeout):
+        return ConnectionPool(max_idle, idle_timeout)
+
+    def get_upstream_addr(self, host):
+        host, _, port = host.partition(':')
+        return self.host_cache.resolve(host), int(port or 80)
+
+    def get_tunnel_addr(self, request):
+        # host and port of a CONNECT request, None when the port isn't allowed
+        host, _, port = request['url'].rpartition(':')
+        if not host or not port.isdigit():
             return None
-        try:
-            message = parse(data)
-        except Exception:
+        if self.connect_ports is not None and int(port) not in self.connect_ports:
             return None
-        if 'Content-Length' in message['header_fields']:
-            content_length = int(message['header_fields']['Content-Length'])
-            while content_length - len(message['body']) > 0:
-                message['body'] += sock.recv(BUFF_SIZE)
-        return message
-
-    def send_request(self, host, data):
-        sock = socket.create_connection((socket.gethostbyname(host), 80))
-        sock.send(data)
-        return self.get_message(sock, http_utils.parse_response)
-
-    def get_modified_response(self, response):
-        if 'body' not in response:
-            return response
-        header_fields = '<br>'.join(f'{k}: {v}'for k, v in response['header_fields'].items())
-        i = response['body'].find(b'</body>')
-        if i == -1:
-            return response
-        response['body'] = response['body'][:i] + header_fields.encode() + response['body'][i:]
-        response['header_fields']['Content-Length'] = str((len(response['body'])))
-        return response
\ No newline at end of file
+        return request['url']
+
+    def open_tunnel(self, client_sock, request, events, record):
+        # events may still hold bytes the client sent right after the request
+        authority = self.get_tunnel_addr(request)
+        if authority is None:
+            record['status'] = 403
+            record['bytes_out'] += self.send(client_sock, [self.FORBIDDEN])
+            return
+        try:
+            started = time.monotonic()
+            upstream = socket.create_connection(self.get_upstream_addr(authority), timeout=10)
+            record['connect'] = time.monotonic() - started
+        except (OSError, ValueError):
+            record['status'] = 502
+            record['bytes_out'] += self.send(client_sock, [self.BAD_GATEWAY])
+            return
+        with upstream:
+            record['status'] = 200
+            client_sock.sendall(self.ESTABLISHED)
+            for kind, data in events:
+                if kind == 'data':
+                    record['bytes_in'] += len(data)
+                    upstream.sendall(data)
+            events.clear()
+            tunnel = Tunnel(client_sock, upstream, self.splice, self.tunnel_idle_timeout)
+            self.metrics.tunnel_opened()
+            try:
+                tunnel.run()
+            finally:
+                self.metrics.tunnel_closed()
+                self.count_tunnel(tunnel, record)
+
+    def count_tunnel(self, tunnel, record):
+        to_upstream, to_client = tunnel.directions
+        record['bytes_in'] += to_upstream.transferred
+        record['bytes_out'] += len(self.ESTABLISHED) + to_client.transferred
+
+    def relay(self, client_sock, client_parser, client_events, request, record):
+        # forwards a request with its body and streams the response back, or answers
+        # from the cache, False when the client connection shouldn't be used any further
+        cached = self.cache.lookup(request) if self.cache is not None else None
+        if cached is not None and cached.is_fresh(request, time.time()):
+            record['cache'] = 'hit'
+            return self.send_cached(client_sock, request, cached, record)
+        if self.cache is not None:
+            record['cache'] = 'miss'
+        upstream_request = request
+        if cached is not None:
+            # stale, asks upstream whether it's still good if it can
+            upstream_request = self.cache.conditional_request(request, cached)
+            if upstream_request is None:
+                cached, upstream_request = None, request
+
+        host = request['header_fields'].get('Host')
+        if host is None:
+            return False
+        try:
+            addr = self.get_upstream_addr(host)
+        except (OSError, ValueError):
+            return False
+        request_time = time.time()
+        head = http_utils.build_head(upstream_request)
+        # the client's side of the request is read only by the first attempt,
+        # a retry sends the head again
+        retrying = False
+        while True:
+            sock = self.pool.get(addr)
+            reused = sock is not None
+            parser = HTTPParser(response=True)
+            events = deque()
+            try:
+                if sock is None:
+                    started = time.monotonic()
+                    sock = socket.create_connection(addr, timeout=10)
+                    record['connect'] = time.monotonic() - started
+                    self.set_nodelay(sock)
+                record['reused'] = reused
+                if retrying:
+                    self.send(sock, [head])
+                else:
+                    retrying = True
+                    self.send_request(sock, head, request, client_sock, client_parser, client_events, record)
+                response = self.read_response(sock, parser, events, request)
+            except (OSError, ParseError):
+                response = None
+            if response is not None:
+                break
+            if sock is not None:
+                sock.close()
+            # the server may have closed a pooled connection just as it was reused,
+            # the request can be sent again unless its body is gone already
+            if not reused or request['framing'] != 'none':
+                return False
+        record['ttfb'] = time.monotonic() - record['start']
+
+        stream = None
+        if cached is None or response['status_code'] != '304':
+            recorder = self.cache.record(request, response, request_time) if self.cache is not None else None
+            stream = streaming.ResponseStream(
+                request, response, recorder=recorder, compress=self.compress, level=self.compression_level)
+            record['status'] = int(response['status_code'])
+        else:
+            record['cache'] = 'revalidated'
+        try:
+            if stream is not None:
+                record['bytes_out'] += self.send(client_sock, [stream.head])
+            while True:
+                kind, piece = self.read_event(sock, parser, events)
+                if kind == 'end':
+                    if stream is not None:
+                        record['bytes_out'] += self.send(client_sock, stream.end())
+                        record['injected'] = stream.injected
+                    break
+                record['bytes_out'] += self.send(client_sock, stream.body(piece))
+        except (OSError, ParseError):
+            sock.close()
+            return False
+        if http_utils.keeps_alive(response) and not events and parser.is_idle():
+            self.pool.put(addr, sock)
+        else:
+            sock.close()
+        if stream is None:
+            cached = self.cache.update(request, cached, response, request_time)
+            return self.send_cached(client_sock, request, cached, record)
+        return not stream.close
+
+    def send_cached(self, client_sock, request, cached, record):
+        response = cached.to_response(request, time.time())
+        stream = streaming.ResponseStream(
+            request, response, inject=not cached.injected, compress=self.compress, level=self.compression_level)
+        body = stream.body(cached.body) if response['framing'] == 'length' else []
+        record['status'] = int(response['status_code'])
+        record['bytes_out'] += self.send(client_sock, [stream.head, *body, *stream.end()])
+        record['injected'] = stream.injected
+        return not stream.close
+
+    def send_request(self, sock, head, request, client_sock, client_parser, client_events, record):
+        chunked = request['framing'] == 'chunked'
+        buffers = [head]
+        while True:
+            kind, piece = self.read_event(client_sock, client_parser, client_events)
+            if kind == 'end':
+                break
+            record['bytes_in'] += len(piece)
+            self.send(sock, buffers + streaming.frame([piece], chunked))
+            buffers = []
+        self.send(sock, buffers + [streaming.LAST_CHUNK] if chunked else buffers)
+
+    def read_response(self, sock, parser, events, request):
+        # the final response head, interim 1xx responses are dropped as the
+        # request body is sent without waiting for 100 Continue
+        while True:
+            parser.expect(request['method'])
+            event = self.read_event(sock, parser, events)
+            if event is None:
+                return None
+            response = event[1]
+            if not response['status_code'].startswith('1') or response['status_code'] == '101':
+                return response
+            self.read_event(sock, parser, events)
@@ -0,0 +1,429 @@
+import os
+import json
+import time
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+
+from http_parser import Headers
+
+
+# statuses a response may be stored with without explicit freshness (RFC 9110 15.1)
+HEURISTIC_STATUSES = {'200', '203', '204', '300', '301', '308', '404', '405', '410', '414', '501'}
+# the only statuses stored at all, with explicit freshness for the rest; 206 isn't one of
+# them, a part of the body stored under the URL's key would be served as the whole
+CACHEABLE_STATUSES = HEURISTIC_STATUSES | {'302', '303', '307'}
+# a successful request with one of these makes stored responses for its URL outdated
+UNSAFE_METHODS = {'POST', 'PUT', 'DELETE', 'PATCH'}
+MAX_HEURISTIC_LIFETIME = 24 * 3600
+# lookup() result for a response that has to be read from the disk tier
+ON_DISK = object()
+
+
+def parse_cache_control(headers):
+    directives = {}
+    for value in headers.get_all('Cache-Control'):
+        for part in value.split(','):
+            name, _, argument = part.strip().partition('=')
+            if name:
+                directives[name.lower()] = argument.strip('"') or None
+    return directives
+
+
+def parse_seconds(value):
+    try:
+        return max(int(value), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_date(value):
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+def freshness_lifetime(response, response_time):
+    # seconds the response is fresh for from its Date (RFC 9111 4.2.1)
+    headers = response['header_fields']
+    directives = parse_cache_control(headers)
+    for name in ('s-maxage', 'max-age'):
+        seconds = parse_seconds(directives.get(name))
+        if seconds is not None:
+            return seconds
+    date = parse_date(headers.get('Date')) or response_time
+    if 'Expires' in headers:
+        # an invalid Expires means already expired
+        expires = parse_date(headers['Expires'])
+        return max(expires - date, 0) if expires is not None else 0
+    last_modified = parse_date(headers.get('Last-Modified'))
+    if last_modified is not None and response['status_code'] in HEURISTIC_STATUSES:
+        return min(max(date - last_modified, 0) / 10, MAX_HEURISTIC_LIFETIME)
+    return 0
+
+
+class CachedResponse:
+    # A stored response: its head with Content-Length set, the whole body and what's
+    # needed to tell its age. injected is whether the body already has the header fields in.
+    def __init__(self, response, body, request_time, response_time, injected):
+        self.response = response
+        self.body = body
+        self.request_time = request_time
+        self.response_time = response_time
+        self.injected = injected
+        self.lifetime = freshness_lifetime(response, response_time)
+        self.size = len(body) + sum(len(k) + len(v) + 4 for k, v in response['header_fields'].items())
+
+    def age(self, now):
+        # RFC 9111 4.2.3
+        headers = self.response['header_fields']
+        date = parse_date(headers.get('Date'))
+        apparent_age = max(self.response_time - date, 0) if date is not None else 0
+        age = (parse_seconds(headers.get('Age')) or 0) + self.response_time - self.request_time
+        return max(apparent_age, age) + now - self.response_time
+
+    def is_fresh(self, request, now):
+        request_headers = request['header_fields']
+        request_directives = parse_cache_control(request_headers)
+        if 'no-cache' in request_directives:
+            return False
+        if 'Cache-Control' not in request_headers and request_headers.has_token('Pragma', 'no-cache'):
+            return False
+        if 'no-cache' in parse_cache_control(self.response['header_fields']):
+            return False
+        age = self.age(now)
+        max_age = parse_seconds(request_directives.get('max-age'))
+        if max_age is not None and age > max_age:
+            return False
+        return age < self.lifetime
+
+    def to_response(self, request, now):
+        # the head to send for request: a 304 when the client's own validator
+        # matches, otherwise the stored response with its current Age
+        headers = self.response['header_fields'].copy()
+        headers['Age'] = str(int(self.age(now)))
+        etag = headers.get('ETag')
+        if_none_match = request['header_fields'].get_all('If-None-Match')
+        if etag is not None and any(
+            tag.strip() in ('*', etag) for value in if_none_match for tag in value.split(',')
+        ):
+            headers.remove('Content-Length')
+            return {
+                **self.response, 'status_code': '304', 'status_code_desc': 'Not Modified',
+                'header_fields': headers, 'framing': 'none'
+            }
+        return {**self.response, 'header_fields': headers}
+
+
+class Recorder:
+    # Collects a response body while it's relayed and stores the response once
+    # the body is complete, gives up on it past max_entry_bytes
+    def __init__(self, cache, request, response, request_time):
+        self.cache = cache
+        self.request = request
+        self.response = response
+        self.request_time = request_time
+        self.injected = cache.cache_injected
+        self.pieces = []
+        self.size = 0
+
+    def add(self, pieces):
+        if self.pieces is None:
+            return
+        self.size += sum(map(len, pieces))
+        if self.size > self.cache.max_entry_bytes:
+            self.pieces = None
+            return
+        # copies, the pieces are views into receive buffers
+        self.pieces.extend(bytes(piece) for piece in pieces)
+
+    def finish(self):
+        if self.pieces is None:
+            return
+        body = b''.join(self.pieces)
+        headers = self.response['header_fields'].copy()
+        headers.remove('Transfer-Encoding')
+        headers['Content-Length'] = str(len(body))
+        response = {**self.response, 'header_fields': headers, 'framing': 'length'}
+        self.cache.store(self.request, response, body, self.request_time, time.time(), self.injected)
+
+
+class ResponseCache:
+    # Shared cache (RFC 9111) of GET responses. Responses are kept in memory, least
+    # recently used first, past max_bytes they move to files in disk_path when it's
+    # given and are dropped from there past disk_max_bytes. Entries are keyed by
+    # method, URL and the values of the request header fields named by Vary.
+    # The disk tier is written by a background thread and outlives restarts.
+    def __init__(
+        self, max_bytes=64 * 2**20, max_entry_bytes=8 * 2**20, disk_path=None,
+        disk_max_bytes=1024 * 2**20, cache_injected=False
+    ):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.disk_path = disk_path
+        self.disk_max_bytes = disk_max_bytes
+        self.cache_injected = cache_injected
+        # key -> CachedResponse, least recently used first
+        self.memory = OrderedDict()
+        self.memory_bytes = 0
+        # key -> file size
+        self.disk = OrderedDict()
+        self.disk_bytes = 0
+        # method and URL -> lowercased names of the fields the stored response varies on
+        self.vary = {}
+        self.lock = threading.Lock()
+        self.writer = None
+        # disk tier writes and deletes that failed
+        self.write_errors = 0
+        if disk_path is not None:
+            os.makedirs(disk_path, exist_ok=True)
+            self.writer = ThreadPoolExecutor(max_workers=1)
+            self.load_index()
+
+    @staticmethod
+    def primary_key(request):
+        url = request['url']
+        if url.startswith('/'):
+            url = f"http://{request['header_fields'].get('Host', '')}{url}"
+        return f"GET {url}"
+
+    @staticmethod
+    def make_key(primary, names, request):
+        headers = request['header_fields']
+        return primary + ''.join(f"\n{name}: {', '.join(headers.get_all(name))}" for name in names)
+
+    def lookup(self, request, read_disk=True):
+        # the stored response for request or None; with read_disk=False a response
+        # that is only on disk gives ON_DISK, for callers that can't block on a file
+        if request['method'] != 'GET' or request['framing'] != 'none':
+            return None
+        primary = self.primary_key(request)
+        with self.lock:
+            names = self.vary.get(primary)
+            if names is None:
+                return None
+            key = self.make_key(primary, names, request)
+            entry = self.memory.get(key)
+            if entry is not None:
+                self.memory.move_to_end(key)
+                return entry
+            if key not in self.disk:
+                return None
+            if not read_disk:
+                return ON_DISK
+            self.disk.move_to_end(key)
+        entry = self.read_file(key)
+        with self.lock:
+            if entry is None:
+                self.forget_file(key)
+            else:
+                self.put_memory(key, entry)
+        return entry
+
+    def conditional_request(self, request, entry):
+        # request with the stored validators added, None when there are none
+        # or the client sent its own
+        headers = request['header_fields']
+        if 'If-None-Match' in headers or 'If-Modified-Since' in headers:
+            return None
+        etag = entry.response['header_fields'].get('ETag')
+        last_modified = entry.response['header_fields'].get('Last-Modified')
+        if etag is None and last_modified is None:
+            return None
+        headers = headers.copy()
+        if etag is not None:
+            headers['If-None-Match'] = etag
+        if last_modified is not None:
+            headers['If-Modified-Since'] = last_modified
+        return {**request, 'header_fields': headers}
+
+    def update(self, request, entry, not_modified, request_time):
+        # a 304 for a stored response: its header fields replace the stored ones (RFC 9111 4.3.4)
+        updates = not_modified['header_fields']
+        skipped = {'content-length', 'transfer-encoding', 'connection', 'keep-alive'}
+        headers = Headers()
+        replaced = set()
+        # in place, so the stored order stays
+        for name, value in entry.response['header_fields'].items():
+            key = name.lower()
+            if key in skipped or key not in updates:
+                headers.add(name, value)
+            elif key not in replaced:
+                replaced.add(key)
+                for value in updates.get_all(name):
+                    headers.add(name, value)
+        for name, value in updates.items():
+            if name.lower() not in skipped and name not in entry.response['header_fields']:
+                headers.add(name, value)
+        response = {**entry.response, 'header_fields': headers}
+        return self.store(request, response, entry.body, request_time, time.time(), entry.injected)
+
+    def record(self, request, response, request_time):
+        # a Recorder for a response that may be stored, None otherwise; a successful
+        # unsafe request makes what's stored for its URL unreachable
+        if request['method'] in UNSAFE_METHODS and response['status_code'][0] in '23':
+            with self.lock:
+                self.vary.pop(self.primary_key(request), None)
+            return None
+        if request['method'] != 'GET' or response['framing'] == 'none':
+            return None
+        if response['status_code'] not in CACHEABLE_STATUSES or 'Range' in request['header_fields']:
+            return None
+        request_directives = parse_cache_control(request['header_fields'])
+        directives = parse_cache_control(response['header_fields'])
+        if 'no-store' in request_directives or 'no-store' in directives or 'private' in directives:
+            return None
+        if 'Authorization' in request['header_fields'] and not (
+            {'public', 's-maxage', 'must-revalidate'} & directives.keys()
+        ):
+            return None
+        if response['header_fields'].has_token('Vary', '*'):
+            return None
+        explicit = 'max-age' in directives or 's-maxage' in directives or 'public' in directives
+        if not explicit and 'Expires' not in response['header_fields'] and \
+                response['status_code'] not in HEURISTIC_STATUSES:
+            return None
+        return Recorder(self, request, response, request_time)
+
+    def store(self, request, response, body, request_time, response_time, injected):
+        names = sorted({
+            part.strip().lower()
+            for value in response['header_fields'].get_all('Vary') for part in value.split(',')
+            if part.strip()
+        })
+        primary = self.primary_key(request)
+        key = self.make_key(primary, names, request)
+        entry = CachedResponse(response, body, request_time, response_time, injected)
+        with self.lock:
+            self.vary[primary] = names
+            # the file has the previous version
+            self.forget_file(key, delete=True)
+            self.put_memory(key, entry)
+        return entry
+
+    def put_memory(self, key, entry):
+        previous = self.memory.pop(key, None)
+        if previous is not None:
+            self.memory_bytes -= previous.size
+        if entry.size > self.max_bytes:
+            if self.writer is not None and key not in self.disk:
+                self.put_file(key, entry)
+            return
+        self.memory[key] = entry
+        self.memory_bytes += entry.size
+        while self.memory_bytes > self.max_bytes:
+            key, entry = self.memory.popitem(last=False)
+            self.memory_bytes -= entry.size
+            if self.writer is not None and key not in self.disk:
+                self.put_file(key, entry)
+
+    def put_file(self, key, entry):
+        self.disk[key] = entry.size
+        self.disk_bytes += entry.size
+        self.submit(self.write_file, key, entry)
+        while self.disk_bytes > self.disk_max_bytes:
+            self.forget_file(next(iter(self.disk)), delete=True)
+
+    def forget_file(self, key, delete=False):
+        size = self.disk.pop(key, None)
+        if size is None:
+            return
+        self.disk_bytes -= size
+        if delete:
+            self.submit(self.delete_file, key)
+
+    def submit(self, fn, *args):
+        self.writer.submit(fn, *args).add_done_callback(self.check_done)
+
+    def check_done(self, future):
+        # the file is missing then, read_file finds out and forgets the key
+        if future.exception() is not None:
+            with self.lock:
+                self.write_errors += 1
+
+    def get_path(self, key):
+        return os.path.join(self.disk_path, hashlib.sha256(key.encode()).hexdigest() + '.cache')
+
+    # A file is a JSON line with the key and the head followed by the body, written
+    # to a temporary file of its own and renamed so readers never see half of it,
+    # even with several processes sharing the directory.
+    def write_file(self, key, entry):
+        meta = {
+            'key': key,
+            'primary': key.split('\n', 1)[0],
+            'vary': [line.split(':', 1)[0] for line in key.split('\n')[1:]],
+            'protocol': entry.response['protocol'],
+            'status_code': entry.response['status_code'],
+            'status_code_desc': entry.response['status_code_desc'],
+            'header_fields': entry.response['header_fields'].items(),
+            'request_time': entry.request_time,
+            'response_time': entry.response_time,
+            'injected': entry.injected,
+        }
+        fd, temp_path = tempfile.mkstemp(suffix='.tmp', dir=self.disk_path)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(json.dumps(meta).encode() + b'\n')
+                f.write(entry.body)
+            os.replace(temp_path, self.get_path(key))
+        except OSError:
+            os.remove(temp_path)
+            raise
+
+    def delete_file(self, key):
+        try:
+            os.remove(self.get_path(key))
+        except OSError:
+            pass
+
+    def read_file(self, key):
+        try:
+            with open(self.get_path(key), 'rb') as f:
+                meta = json.loads(f.readline())
+                body = f.read()
+        except (OSError, ValueError):
+            return None
+        headers = Headers(meta['header_fields'])
+        # a torn file would be sent with the wrong length
+        if meta['key'] != key or headers.get('Content-Length') != str(len(body)):
+            return None
+        response = {
+            'protocol': meta['protocol'],
+            'status_code': meta['status_code'],
+            'status_code_desc': meta['status_code_desc'],
+            'header_fields': headers,
+            'framing': 'length',
+        }
+        return CachedResponse(response, body, meta['request_time'], meta['response_time'], meta['injected'])
+
+    def load_index(self):
+        # what earlier runs left on disk, oldest first
+        files = []
+        for name in os.listdir(self.disk_path):
+            if not name.endswith('.cache'):
+                continue
+            path = os.path.join(self.disk_path, name)
+            try:
+                with open(path, 'rb') as f:
+                    meta = json.loads(f.readline())
+                files.append((os.path.getmtime(path), os.path.getsize(path), meta))
+            except (OSError, ValueError):
+                continue
+        for _, size, meta in sorted(files, key=lambda file: file[0]):
+            self.disk[meta['key']] = size
+            self.disk_bytes += size
+            self.vary[meta['primary']] = meta['vary']
+        # removed here rather than by the writer, which should only start in the
+        # process that uses it as its thread wouldn't survive a fork
+        while self.disk_bytes > self.disk_max_bytes:
+            key = next(iter(self.disk))
+            self.forget_file(key)
+            self.delete_file(key)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.shutdown(wait=True)
@@ -0,0 +1,158 @@
+import re
+
+import http_utils
+import compression
+
+
+LAST_CHUNK = b'0\r\n\r\n'
+
+
+def frame(pieces, chunked):
+    # body pieces ready to be sent, as one chunk when the body is chunked
+    pieces = [piece for piece in pieces if len(piece)]
+    if not chunked or not pieces:
+        return pieces
+    return [b'%x\r\n' % sum(map(len, pieces)), *pieces, b'\r\n']
+
+
+class BodyInjector:
+    # Inserts data before the first marker in a body that arrives piece by piece.
+    # The last len(marker) - 1 bytes seen are held back until the next piece, so
+    # a marker split between pieces is found too, the rest is passed on as is.
+    def __init__(self, marker, data):
+        self.pattern = re.compile(re.escape(marker))
+        self.keep = len(marker) - 1
+        self.data = data
+        self.carry = b''
+        self.done = False
+
+    def feed(self, piece):
+        if self.done:
+            return [piece]
+        if len(piece) < self.keep:
+            window = self.carry + bytes(piece)
+            match = self.pattern.search(window)
+            if match:
+                self.done = True
+                self.carry = b''
+                return [window[:match.start()], self.data, window[match.start():]]
+            self.carry = window[-self.keep:]
+            return [window[:-self.keep]]
+        pieces = []
+        if self.carry:
+            # a marker starting in the carry ends within the first keep bytes of the piece
+            match = self.pattern.search(self.carry + bytes(piece[:self.keep]))
+            carry, self.carry = self.carry, b''
+            if match:
+                self.done = True
+                return [carry[:match.start()], self.data, carry[match.start():], piece]
+            pieces.append(carry)
+        match = self.pattern.search(piece)
+        if match:
+            self.done = True
+            pieces += [piece[:match.start()], self.data, piece[match.start():]]
+        else:
+            pieces.append(piece[:len(piece) - self.keep])
+            self.carry = bytes(piece[len(piece) - self.keep:])
+        return pieces
+
+    def finish(self):
+        carry, self.carry = self.carry, b''
+        return [carry]
+
+
+class ResponseStream:
+    # A response from upstream as it goes to the client: the head, then the body
+    # piece by piece, with the response header fields put before </body> of HTML.
+    # gzip, deflate and br bodies are decoded for that and encoded again at level,
+    # with compress uncompressed text is encoded for clients that accept it.
+    # When the length can't be known before the whole body has passed (it's rewritten,
+    # or upstream sent it chunked or until close) the body is sent chunked, or until
+    # close to an HTTP/1.0 client. Only the injector's few bytes and the codecs'
+    # windows are held between pieces.
+    # A recorder (response_cache.Recorder) gets the body as received or, when it
+    # keeps injected bodies, as sent.
+    MARKER = b'</body>'
+    COMPRESSIBLE = (
+        'text/', 'application/json', 'application/javascript', 'application/xml', 'image/svg+xml'
+    )
+
+    def __init__(self, request, response, inject=True, recorder=None, compress=False, level=6):
+        headers = response['header_fields']
+        framing = response['framing']
+        content_type = headers.get('Content-Type', 'text/html').lower()
+        encoding = headers.get('Content-Encoding', 'identity').strip().lower()
+        self.recorder = recorder
+        self.decoder = self.injector = self.encoder = None
+        if inject and framing != 'none' and 'html' in content_type and (
+            encoding == 'identity' or encoding in compression.ENCODINGS
+        ):
+            data = '<br>'.join(f'{k}: {v}' for k, v in headers.items()).encode('latin-1')
+            self.injector = BodyInjector(self.MARKER, data)
+            if encoding != 'identity':
+                self.decoder = compression.Decoder(encoding)
+                self.encoder = compression.Encoder(encoding, level)
+        if framing != 'none' and (framing != 'length' or self.injector is not None):
+            headers = headers.copy()
+            headers.remove('Content-Length')
+        coding = None
+        if compress and framing != 'none' and encoding == 'identity' and response['status_code'] == '200' \
+                and content_type.startswith(self.COMPRESSIBLE) and not headers.has_token('Cache-Control', 'no-transform'):
+            coding = compression.choose_encoding(request['header_fields'])
+        if coding is not None:
+            self.encoder = compression.Encoder(coding, level)
+            headers = headers.copy()
+            headers.remove('Content-Length')
+            headers['Content-Encoding'] = coding
+            if not headers.has_token('Vary', 'accept-encoding'):
+                headers.add('Vary', 'Accept-Encoding')
+            # the encoded body is a different representation
+            etag = headers.get('ETag')
+            if etag is not None and not etag.startswith('W/'):
+                headers['ETag'] = 'W/' + etag
+        if recorder is not None and recorder.injected:
+            recorder.response = {**response, 'header_fields': headers}
+
+        self.chunked = False
+        self.close = not http_utils.keeps_alive(request) or headers.has_token('Connection', 'close')
+        if framing != 'none' and 'Content-Length' not in headers:
+            headers = headers.copy()
+            headers.remove('Transfer-Encoding')
+            if request['protocol'] == 'HTTP/1.0':
+                headers['Connection'] = 'close'
+                self.close = True
+            else:
+                headers['Transfer-Encoding'] = 'chunked'
+                self.chunked = True
+        self.head = http_utils.build_head({**response, 'header_fields': headers})
+
+    @property
+    def injected(self):
+        return self.injector is not None and self.injector.done
+
+    def body(self, piece):
+        pieces = self.decoder.decompress(piece) if self.decoder is not None else [piece]
+        if self.injector is not None:
+            pieces = (out for part in pieces for out in self.injector.feed(part))
+        if self.encoder is not None:
+            pieces = (self.encoder.compress(part) for part in pieces)
+        # decoded pieces pass one at a time, only the encoded output adds up
+        pieces = list(pieces)
+        if self.recorder is not None:
+            self.recorder.add(pieces if self.recorder.injected else [piece])
+        return frame(pieces, self.chunked)
+
+    def end(self):
+        pieces = [self.decoder.flush()] if self.decoder is not None else []
+        if self.injector is not None:
+            pieces = [out for part in pieces for out in self.injector.feed(part)] + self.injector.finish()
+        if self.encoder is not None:
+            pieces = [self.encoder.compress(part) for part in pieces] + [self.encoder.flush()]
+        if self.recorder is not None:
+            if self.recorder.injected:
+                self.recorder.add(pieces)
+            self.recorder.finish()
+        pieces = frame(pieces, self.chunked)
+        if self.chunked:
+            pieces.append(LAST_CHUNK)
+        return pieces
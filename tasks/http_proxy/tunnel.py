@@ -0,0 +1,188 @@
+import os
+import time
+import socket
+import asyncio
+import selectors
+
+
+# os.splice moves data between a socket and a pipe inside the kernel (Linux, Python 3.10+)
+SPLICE = hasattr(os, 'splice')
+BUFF_SIZE = 64 * 1024
+
+
+class Direction:
+    # Bytes from src to dst, at most BUFF_SIZE in flight: spliced into a pipe and from
+    # it to dst, or received into one reused buffer and sent from it. Either way
+    # nothing is parsed or copied into new Python objects.
+    def __init__(self, src, dst, splice):
+        self.src = src
+        self.dst = dst
+        self.splice = splice
+        self.pending = 0
+        self.eof = False
+        self.transferred = 0
+        if splice:
+            self.pipe_r, self.pipe_w = os.pipe()
+        else:
+            self.buffer = memoryview(bytearray(BUFF_SIZE))
+            self.start = 0
+
+    def wants_read(self):
+        return not self.eof and self.pending == 0
+
+    def wants_write(self):
+        return self.pending > 0
+
+    def fill(self):
+        try:
+            if self.splice:
+                n = os.splice(self.src.fileno(), self.pipe_w, BUFF_SIZE, flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+            else:
+                n = self.src.recv_into(self.buffer)
+                self.start = 0
+        except BlockingIOError:
+            return
+        if n == 0:
+            self.eof = True
+            self.dst.shutdown(socket.SHUT_WR)
+        self.pending = n
+
+    def drain(self):
+        try:
+            if self.splice:
+                n = os.splice(self.pipe_r, self.dst.fileno(), self.pending, flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+            else:
+                n = self.dst.send(self.buffer[self.start:self.start+self.pending])
+                self.start += n
+        except BlockingIOError:
+            return
+        self.pending -= n
+        self.transferred += n
+
+    def close(self):
+        if self.splice:
+            os.close(self.pipe_r)
+            os.close(self.pipe_w)
+
+
+class Tunnel:
+    # Relays a CONNECT tunnel between two connected sockets in both directions
+    # until both sides have closed, either side fails or nothing moves for idle_timeout.
+    # run() blocks its thread on a selector, run_async() uses the event loop's.
+    def __init__(self, client, upstream, splice=SPLICE, idle_timeout=300):
+        client.setblocking(False)
+        upstream.setblocking(False)
+        self.socks = (client, upstream)
+        self.directions = (Direction(client, upstream, splice), Direction(upstream, client, splice))
+        self.idle_timeout = idle_timeout
+        self.last_activity = time.monotonic()
+
+    def is_done(self):
+        return all(direction.eof and not direction.pending for direction in self.directions)
+
+    def get_interest(self, sock):
+        # (wants to read, wants to write) for sock
+        return (
+            any(direction.src is sock and direction.wants_read() for direction in self.directions),
+            any(direction.dst is sock and direction.wants_write() for direction in self.directions)
+        )
+
+    def step(self, sock, readable, writable):
+        self.last_activity = time.monotonic()
+        for direction in self.directions:
+            if writable and direction.dst is sock and direction.wants_write():
+                direction.drain()
+            if readable and direction.src is sock and direction.wants_read():
+                direction.fill()
+                # the other side is usually writable, no need to wait for the selector
+                if direction.wants_write():
+                    direction.drain()
+
+    def run(self):
+        selector = selectors.DefaultSelector()
+        masks = {}
+        try:
+            while not self.is_done():
+                self.update_selector(selector, masks)
+                events = selector.select(self.idle_timeout)
+                if not events:
+                    break
+                for key, mask in events:
+                    self.step(key.fileobj, mask & selectors.EVENT_READ, mask & selectors.EVENT_WRITE)
+        except OSError:
+            pass
+        finally:
+            selector.close()
+            self.close()
+
+    def update_selector(self, selector, masks):
+        for sock in self.socks:
+            readable, writable = self.get_interest(sock)
+            mask = (selectors.EVENT_READ if readable else 0) | (selectors.EVENT_WRITE if writable else 0)
+            if mask == masks.get(sock, 0):
+                continue
+            if not mask:
+                selector.unregister(sock)
+            elif sock in masks and masks[sock]:
+                selector.modify(sock, mask)
+            else:
+                selector.register(sock, mask)
+            masks[sock] = mask
+
+    async def run_async(self):
+        loop = asyncio.get_running_loop()
+        done = loop.create_future()
+        # sock -> (reading, writing) as registered with the loop
+        registered = {sock: (False, False) for sock in self.socks}
+
+        def update():
+            if self.is_done():
+                if not done.done():
+                    done.set_result(None)
+                return
+            for sock in self.socks:
+                readable, writable = self.get_interest(sock)
+                reading, writing = registered[sock]
+                if readable != reading:
+                    if readable:
+                        loop.add_reader(sock, on_event, sock, True, False)
+                    else:
+                        loop.remove_reader(sock)
+                if writable != writing:
+                    if writable:
+                        loop.add_writer(sock, on_event, sock, False, True)
+                    else:
+                        loop.remove_writer(sock)
+                registered[sock] = (readable, writable)
+
+        def on_event(sock, readable, writable):
+            try:
+                self.step(sock, readable, writable)
+            except OSError:
+                if not done.done():
+                    done.set_result(None)
+                return
+            update()
+
+        def check_idle():
+            if time.monotonic() - self.last_activity >= self.idle_timeout:
+                if not done.done():
+                    done.set_result(None)
+            elif not done.done():
+                loop.call_later(self.idle_timeout / 4, check_idle)
+
+        update()
+        loop.call_later(self.idle_timeout / 4, check_idle)
+        try:
+            await done
+        finally:
+            for sock in self.socks:
+                loop.remove_reader(sock)
+                loop.remove_writer(sock)
+            self.close()
+
+    def close(self):
+        for direction in self.directions:
+            direction.close()
+        for sock in self.socks:
+            sock.close()
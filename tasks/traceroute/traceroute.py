@@ -1,8 +1,10 @@
-import sys
 import os
 import json
+import time
 import socket
 import struct
+import argparse
+from concurrent.futures import ThreadPoolExecutor
 
 from urllib.request import urlopen
 from urllib.error import URLError, HTTPError
@@ -11,6 +13,11 @@ from urllib.error import URLError, HTTPError
 PORT = 33458
 MAX_HOPS = 25
 MAX_ATTEMPS = 3
+TIMEOUT = 3
+
+ICMP_DEST_UNREACHABLE = 3
+ICMP_PORT_UNREACHABLE = 3
+ICMP_TIME_EXCEEDED = 11
 
 RIPE_API_URL = (
     'https://rest.db.ripe.net/search.json?'
@@ -48,6 +55,89 @@ def traceroute(destination):
         ttl += 1
 
 
+def parallel_traceroute(destination, timeout=TIMEOUT, attempts=MAX_ATTEMPS):
+    # All probes at once: attempts UDP probes for every TTL, told apart by their
+    # destination port, and one raw socket for the ICMP replies, matched to the probes
+    # by the UDP header quoted in them. Takes about the round trip to the farthest
+    # hop, or timeout when some hop before the destination stays silent.
+    dest_ip = socket.gethostbyname(destination)
+    recv_sock = socket.socket(
+        socket.AF_INET,
+        socket.SOCK_RAW,
+        socket.getprotobyname('icmp')
+    )
+    send_sock = socket.socket(
+        socket.AF_INET,
+        socket.SOCK_DGRAM,
+        socket.getprotobyname('udp')
+    )
+    send_sock.bind(('', 0))
+    src_port = send_sock.getsockname()[1]
+    # ttl -> address of the first reply
+    hops = {}
+    # the destination's TTL once it has answered
+    last_hop = MAX_HOPS
+    try:
+        for attempt in range(attempts):
+            for ttl in range(1, MAX_HOPS + 1):
+                send_sock.setsockopt(socket.SOL_IP, socket.IP_TTL, ttl)
+                send_sock.sendto(b'', (dest_ip, PORT + attempt * MAX_HOPS + ttl))
+        deadline = time.monotonic() + timeout
+        while any(ttl not in hops for ttl in range(1, last_hop + 1)):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            recv_sock.settimeout(remaining)
+            try:
+                data, addr = recv_sock.recvfrom(512)
+            except socket.timeout:
+                break
+            reply = parse_reply(data, dest_ip, src_port)
+            if reply is None:
+                continue
+            port, reached = reply
+            if not PORT < port <= PORT + attempts * MAX_HOPS:
+                continue
+            ttl = (port - PORT - 1) % MAX_HOPS + 1
+            hops.setdefault(ttl, addr[0])
+            if reached:
+                last_hop = min(last_hop, ttl)
+    finally:
+        recv_sock.close()
+        send_sock.close()
+
+    def get_hop_info(ttl):
+        return get_ip_info(hops[ttl]) if ttl in hops else None
+
+    with ThreadPoolExecutor(8) as executor:
+        yield from executor.map(get_hop_info, range(1, last_hop + 1))
+
+
+def parse_reply(packet, dest_ip, src_port):
+    # (destination port of the probe, whether it reached the destination) for an
+    # ICMP Time Exceeded or Destination Unreachable quoting one of our UDP probes;
+    # a router's host unreachable or admin prohibited doesn't end the trace
+    header_len = (packet[0] & 0x0f) * 4
+    if len(packet) < header_len + 8 + 20:
+        return None
+    icmp_type = packet[header_len]
+    if icmp_type not in (ICMP_TIME_EXCEEDED, ICMP_DEST_UNREACHABLE):
+        return None
+    original = packet[header_len + 8:]
+    original_len = (original[0] & 0x0f) * 4
+    if len(original) < original_len + 4 or original[9] != socket.IPPROTO_UDP:
+        return None
+    if socket.inet_ntoa(original[16:20]) != dest_ip:
+        return None
+    sport, dport = struct.unpack('!HH', original[original_len:original_len + 4])
+    if sport != src_port:
+        return None
+    reached = icmp_type == ICMP_DEST_UNREACHABLE and (
+        packet[header_len + 1] == ICMP_PORT_UNREACHABLE or socket.inet_ntoa(packet[12:16]) == dest_ip
+    )
+    return dport, reached
+
+
 def get_socks(ttl):
     recv_sock = socket.socket(
         socket.AF_INET,
@@ -114,7 +204,15 @@ def get_json_response(request_url):
 
 
 if __name__ == '__main__':
-    for x in traceroute(sys.argv[1]):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('destination')
+    parser.add_argument(
+        '--parallel', action='store_true',
+        help='probe all hops at once, the trace takes about one round trip plus the timeout'
+    )
+    args = parser.parse_args()
+    trace = parallel_traceroute if args.parallel else traceroute
+    for x in trace(args.destination):
         if x:
             if 'origin' in x:
                 print('{ip} {role} {country} {origin}'.format(**x))